@@ -574,9 +574,8 @@ if __name__ == "__main__":
         # is silently dropped.
         status_thread.join(10)
 
-    pageData = res.read()
-
     if res.status != httplib.OK:
+        pageData = res.read()
         print("%s: %s" % (httplib.responses.get(res.status, res.status),
                           pageData), file=sys.stderr)
         if res.status == httplib.MULTI_STATUS and \
@@ -587,6 +586,7 @@ if __name__ == "__main__":
     exit_status = 0
 
     if transport.expect == 'command':
+        pageData = res.read()
         if not globalOptions.get('exec'):
             print(pageData)
         else:
@@ -599,13 +599,26 @@ if __name__ == "__main__":
 
             exit_status = proc.wait()
     elif transport.expect == 'sandbox':
+        pageData = res.read()
         noexec = not globalOptions.get('exec')
         exit_status = create_sandbox(pageData, noexec=noexec)
     else:
+        # Large outputs are sent using chunked encoding while the broker is
+        # still generating them, so print the chunks as they arrive
+        have_output = False
+        try:
+            while res.fp:
+                pageData = res.read_chunk()
+                if pageData:
+                    sys.stdout.write(pageData)
+                    have_output = True
+        except (httplib.HTTPException, socket.error) as e:
+            print("\nError: incomplete response from the broker: %r" % e,
+                  file=sys.stderr)
+            sys.exit(1)
+
         format = globalOptions.get("format", None)
-        if format == "proto" or format == "csv":
-            sys.stdout.write(pageData)
-        elif pageData:
-            print(pageData)
+        if have_output and format != "proto" and format != "csv":
+            sys.stdout.write("\n")
 
     sys.exit(exit_status)
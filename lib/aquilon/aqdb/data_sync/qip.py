@@ -16,7 +16,10 @@
 # limitations under the License.
 """ Routines to query information from QIP """
 
-import heapq
+from collections import defaultdict
+from operator import attrgetter
+
+from six import iteritems, itervalues
 
 from ipaddr import (IPv4Address, IPv4Network, AddressValueError,
                     NetmaskValueError)
@@ -28,20 +31,13 @@ from aquilon.aqdb.model import (NetworkEnvironment, Network, RouterAddress,
 from aquilon.worker.dbwrappers.dns import delete_dns_record
 from aquilon.worker.dbwrappers.network import fix_foreign_links
 from aquilon.worker.templates import Plenary, PlenaryCollection
+from aquilon.utils import chunk
 
 from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import update, and_, or_
 
 
-# Add a wrapper around heapq.heappop because handling None is simpler than
-# adding try/except blocks everywhere
-def heap_pop(heap):
-    try:
-        return heapq.heappop(heap)
-    except IndexError:
-        return None
-
-
 class QIPInfo(object):
     __slots__ = ("name", "address", "location", "network_type", "side",
                  "routers", "compartment")
@@ -242,45 +238,58 @@ class QIPRefresh(object):
                        network_type=network_type, side=side,
                        routers=routers, compartment=compartment)
 
-    def update_network(self, dbnetwork, qipinfo):
-        """ Update the network parameters except the netmask """
+    def network_changes(self, dbnetwork, qipinfo):
+        """
+        Collect the differences between AQDB and QIP, except the netmask
 
-        # We don't want to add the plenary to self.plenaries if we aren't going
-        # to change anything
-        plenary = Plenary.get_plenary(dbnetwork)
-        updated = False
+        Returns a tuple of the attributes to set, the routers to remove, and
+        the router IPs to add. Nothing is modified here.
+        """
 
+        attrs = []
+
+        # Compare IDs rather than objects, so relations do not have to be
+        # loaded
         if dbnetwork.name != qipinfo.name:
-            self.logger.client_info("Setting network {0!s} name to {1}"
-                                    .format(dbnetwork, qipinfo.name))
-            dbnetwork.name = qipinfo.name
+            attrs.append(("name", qipinfo.name,
+                          "Setting network {0!s} name to {1}"
+                          .format(dbnetwork, qipinfo.name)))
         if dbnetwork.network_type != qipinfo.network_type:
-            self.logger.client_info("Setting network {0!s} type to {1}"
-                                    .format(dbnetwork, qipinfo.network_type))
-            dbnetwork.network_type = qipinfo.network_type
-        if dbnetwork.location != qipinfo.location:
-            self.logger.client_info("Setting network {0!s} location to {1:l}"
-                                    .format(dbnetwork, qipinfo.location))
-            dbnetwork.location = qipinfo.location
+            attrs.append(("network_type", qipinfo.network_type,
+                          "Setting network {0!s} type to {1}"
+                          .format(dbnetwork, qipinfo.network_type)))
+        if dbnetwork.location_id != qipinfo.location.id:
+            attrs.append(("location", qipinfo.location,
+                          "Setting network {0!s} location to {1:l}"
+                          .format(dbnetwork, qipinfo.location)))
         if dbnetwork.side != qipinfo.side:
-            self.logger.client_info("Setting network {0!s} side to {1}"
-                                    .format(dbnetwork, qipinfo.side))
-            dbnetwork.side = qipinfo.side
-        if dbnetwork.network_compartment != qipinfo.compartment:
-            self.logger.client_info("Setting network {0!s} compartment to {1!s}"
-                                    .format(dbnetwork, qipinfo.compartment))
-            dbnetwork.network_compartment = qipinfo.compartment
-
-        if dbnetwork in self.session.dirty:
-            updated = True
+            attrs.append(("side", qipinfo.side,
+                          "Setting network {0!s} side to {1}"
+                          .format(dbnetwork, qipinfo.side)))
+        compartment_id = qipinfo.compartment.id if qipinfo.compartment else None
+        if dbnetwork.network_compartment_id != compartment_id:
+            attrs.append(("network_compartment", qipinfo.compartment,
+                          "Setting network {0!s} compartment to {1!s}"
+                          .format(dbnetwork, qipinfo.compartment)))
 
         old_rtrs = set(dbnetwork.router_ips)
         new_rtrs = set(qipinfo.routers)
 
-        del_routers = []
-        for router in dbnetwork.routers:
-            if router.ip in old_rtrs - new_rtrs:
-                del_routers.append(router)
+        del_routers = [router for router in dbnetwork.routers
+                       if router.ip in old_rtrs - new_rtrs]
+        add_ips = new_rtrs - old_rtrs
+
+        return attrs, del_routers, add_ips
+
+    def update_network(self, dbnetwork, changes):
+        """ Apply the changes returned by network_changes() """
+
+        attrs, del_routers, add_ips = changes
+        plenary = Plenary.get_plenary(dbnetwork)
+
+        for attr, value, msg in attrs:
+            self.logger.client_info(msg)
+            setattr(dbnetwork, attr, value)
 
         for router in del_routers:
             self.logger.client_info("Removing router {0:s} from "
@@ -289,19 +298,14 @@ class QIPRefresh(object):
                 if dns_rec.is_unused:
                     delete_dns_record(dns_rec)
             dbnetwork.routers.remove(router)
-            updated = True
 
-        for ip in new_rtrs - old_rtrs:
+        for ip in add_ips:
             self.add_router(dbnetwork, ip)
-            updated = True
 
-        if updated:
-            self.plenaries.append(plenary)
+        self.plenaries.append(plenary)
 
         # TODO: add support for updating router locations
 
-        return dbnetwork.netmask == qipinfo.address.netmask
-
     def add_network(self, qipinfo):
         dbnetwork = Network(name=qipinfo.name, network=qipinfo.address,
                             network_type=qipinfo.network_type,
@@ -313,7 +317,6 @@ class QIPRefresh(object):
         for ip in qipinfo.routers:
             self.add_router(dbnetwork, ip)
         self.plenaries.add(dbnetwork)
-        self.session.flush()
         return dbnetwork
 
     def del_network(self, dbnetwork):
@@ -366,52 +369,25 @@ class QIPRefresh(object):
                             ARecord.ip > dbnetwork.broadcast)))
         )
 
-    def refresh(self, filehandle):
-        linecnt = 0
-        qipnetworks = {}
-        for line in filehandle:
-            linecnt += 1
-            line = line.rstrip("\n")
-            try:
-                qipinfo = self.parse_line(line)
-                if not qipinfo:
-                    continue
-                if self.building and qipinfo.location.building != self.building:
-                    continue
-                qipnetworks[qipinfo.address.ip] = qipinfo
-            except ValueError as err:
-                self.error("%s; skipping line %d: %s" % (err, linecnt, line))
-
-        # Check/update network attributes that do not affect other objects. Do
-        # this in a single transaction, even in incremental mode
-        ips = list(self.aqnetworks.keys())[:]
-        for ip in ips:
-            if ip not in qipnetworks:
-                # "Forget" networks not inside the requested building to prevent
-                # them being deleted
-                if self.building and self.aqnetworks[ip].location.building != self.building:
-                    del self.aqnetworks[ip]
-                continue
-            if self.update_network(self.aqnetworks[ip], qipnetworks[ip]):
-                # If the netmask did not change, then we're done with this
-                # network
-                del self.aqnetworks[ip]
-                del qipnetworks[ip]
-        self.commit_if_needed()
+    def plan_changes(self, aqnets, qipnets):
+        """
+        Compute the additions, deletions, splits and merges
 
-        # What is left after this point is additions, deletions, splits and
-        # merges
+        Both lists must be sorted by the network address. Returns a list of
+        actions, in the order they should be applied. Every action is a tuple,
+        starting with the name of the method implementing it, followed by the
+        AQDB network being looked at when the action was decided, and the
+        arguments of the method.
+        """
 
-        aqnets = self.aqnetworks.values()
-        heapq.heapify(aqnets)
-        qipnets = qipnetworks.values()
-        heapq.heapify(qipnets)
+        actions = []
+        aqnets = iter(aqnets)
+        qipnets = iter(qipnets)
 
-        aqnet = heap_pop(aqnets)
-        qipinfo = heap_pop(qipnets)
+        aqnet = next(aqnets, None)
+        qipinfo = next(qipnets, None)
         while aqnet or qipinfo:
-            if aqnet:
-                self.plenaries.add(aqnet)
+            current = aqnet
 
             # We have 3 cases regarding aqnet/qipinfo:
             # - One contains the other: this is a split or a merge
@@ -421,88 +397,194 @@ class QIPRefresh(object):
             #   network was added to QIP
             if aqnet and qipinfo and (aqnet.ip in qipinfo.address or
                                       qipinfo.address.ip in aqnet.network):
-                # This is a split or a merge. The trick here is to perform
-                # multiple network additions/deletions inside the same
-                # transaction even in incremental mode, to maintain relational
-                # integrity
-
                 startip = min(aqnet.ip, qipinfo.address.ip)
                 prefixlen = min(aqnet.cidr, qipinfo.address.prefixlen)
                 supernet = IPv4Network("%s/%s" % (startip, prefixlen))
-                # We may modify aqnet.network below, so save the original value
-                orig_net = aqnet.network
 
                 # Always deleting & possibly recreating aqnet would make things
                 # simpler, but we can't do that due to the unique constraint on
                 # the IP address and the non-null foreign key constraints in
                 # other tables. So we need a flag to remember if we want to keep
-                # the original object or not
-                if aqnet.ip == qipinfo.address.ip:
-                    self.logger.client_info("Setting network {0!s} prefix "
-                                            "length to {1}"
-                                            .format(aqnet,
-                                                    qipinfo.address.prefixlen))
-                    aqnet.cidr = qipinfo.address.prefixlen
-                    keep_aqnet = True
-                else:
-                    # This can happen if the network was split, and then the
-                    # first subnet was deleted
-                    keep_aqnet = False
+                # the original object or not. If the IP addresses differ, then
+                # the network was split, and then the first subnet was deleted
+                keep_aqnet = aqnet.ip == qipinfo.address.ip
 
                 # Here we rely heavily on network sizes being a power of two, so
                 # supernet is either equal to aqnet or to qipinfo - partial
                 # overlap is not possible
-                if orig_net == supernet:
+                if aqnet.network == supernet:
                     # Split:
                     #  AQ:  ******** (one big network)
                     #  QIP: --**++++ (smaller networks, some may be missing)
                     if keep_aqnet:
-                        # The first subnet was handled above by setting
-                        # aqnet.cidr
-                        qipinfo = heap_pop(qipnets)
+                        first = qipinfo
+                        qipinfo = next(qipnets, None)
                     else:
-                        # The first subnet was deleted
-                        pass
-                    while qipinfo and qipinfo.address.ip in orig_net:
-                        newnet = self.add_network(qipinfo)
-                        # Redirect addresses from the split network to the new
-                        # subnet
-                        fix_foreign_links(self.session, aqnet, newnet)
-                        qipinfo = heap_pop(qipnets)
-                    if keep_aqnet:
-                        self.check_split_network(aqnet)
-                    else:
-                        self.del_network(aqnet)
-                    aqnet = heap_pop(aqnets)
+                        first = None
+                    subnets = []
+                    while qipinfo and qipinfo.address.ip in aqnet.network:
+                        subnets.append(qipinfo)
+                        qipinfo = next(qipnets, None)
+                    actions.append(("split_network", current, aqnet, first,
+                                    subnets))
+                    aqnet = next(aqnets, None)
                 else:
                     # Merge:
                     #  AQ:  --++**** (smaller networks, some may be missing)
                     #  QIP: ******** (one big network)
                     if keep_aqnet:
-                        # The first subnet was handled above by setting
-                        # aqnet.cidr
-                        newnet = aqnet
-                        aqnet = heap_pop(aqnets)
+                        kept = aqnet
+                        aqnet = next(aqnets, None)
                     else:
-                        # The first subnet was missing from AQDB before
-                        newnet = self.add_network(qipinfo)
-                    while aqnet and aqnet.ip in newnet.network:
-                        # Redirect addresses from the subnet to the merged
-                        # network
-                        fix_foreign_links(self.session, aqnet, newnet)
-                        self.del_network(aqnet)
-                        aqnet = heap_pop(aqnets)
-                    qipinfo = heap_pop(qipnets)
+                        kept = None
+                    subnets = []
+                    while aqnet and aqnet.ip in qipinfo.address:
+                        subnets.append(aqnet)
+                        aqnet = next(aqnets, None)
+                    actions.append(("merge_networks", current, qipinfo, kept,
+                                    subnets))
+                    qipinfo = next(qipnets, None)
             elif aqnet and (not qipinfo or aqnet.ip < qipinfo.address.ip):
                 # Network is deleted
-                self.del_network(aqnet)
-                aqnet = heap_pop(aqnets)
+                actions.append(("del_network", current, aqnet))
+                aqnet = next(aqnets, None)
             else:
                 # New network
-                self.add_network(qipinfo)
-                qipinfo = heap_pop(qipnets)
+                actions.append(("add_network", current, qipinfo))
+                qipinfo = next(qipnets, None)
+
+        return actions
+
+    def set_prefixlen(self, dbnetwork, prefixlen):
+        self.logger.client_info("Setting network {0!s} prefix length to {1}"
+                                .format(dbnetwork, prefixlen))
+        dbnetwork.cidr = prefixlen
+
+    def split_network(self, aqnet, first, subnets):
+        # The trick here is to perform multiple network additions/deletions
+        # inside the same transaction even in incremental mode, to maintain
+        # relational integrity
+        if first:
+            # The first subnet re-uses the original network
+            self.set_prefixlen(aqnet, first.address.prefixlen)
+
+        newnets = [self.add_network(qipinfo) for qipinfo in subnets]
+        if newnets:
+            self.session.flush()
+        for newnet in newnets:
+            # Redirect addresses from the split network to the new subnet
+            fix_foreign_links(self.session, aqnet, newnet)
+
+        if first:
+            self.check_split_network(aqnet)
+        else:
+            self.del_network(aqnet)
+
+    def merge_networks(self, qipinfo, kept, subnets):
+        # See split_network() about doing everything in one transaction
+        if kept:
+            self.set_prefixlen(kept, qipinfo.address.prefixlen)
+            newnet = kept
+        else:
+            # The first subnet was missing from AQDB before
+            newnet = self.add_network(qipinfo)
+            self.session.flush()
+
+        for aqnet in subnets:
+            # Redirect addresses from the subnet to the merged network
+            fix_foreign_links(self.session, aqnet, newnet)
+            self.del_network(aqnet)
+
+    def preload_deletions(self, actions):
+        """ Load the data del_network() needs in bulk """
+
+        networks = {action[2].id: action[2] for action in actions
+                    if action[0] == "del_network"}
+        assignments = defaultdict(list)
+        dns_records = defaultdict(list)
+        for id_chunk in chunk(sorted(networks), 1000):
+            q = self.session.query(AddressAssignment)
+            q = q.filter(AddressAssignment.network_id.in_(id_chunk))
+            # Keep the order of the Network.assignments relation
+            q = q.order_by(AddressAssignment.ip)
+            for addr in q:
+                assignments[addr.network_id].append(addr)
+
+            q = self.session.query(ARecord)
+            q = q.filter(ARecord.network_id.in_(id_chunk))
+            for dns_rec in q:
+                dns_records[dns_rec.network_id].append(dns_rec)
+
+        for net_id, dbnetwork in iteritems(networks):
+            set_committed_value(dbnetwork, "assignments",
+                                assignments.get(net_id, []))
+            set_committed_value(dbnetwork, "dns_records",
+                                dns_records.get(net_id, []))
+
+    def refresh(self, filehandle):
+        linecnt = 0
+        qipnetworks = {}
+        for line in filehandle:
+            linecnt += 1
+            line = line.rstrip("\n")
+            try:
+                qipinfo = self.parse_line(line)
+                if not qipinfo:
+                    continue
+                if self.building and qipinfo.location.building != self.building:
+                    continue
+                qipnetworks[qipinfo.address.ip] = qipinfo
+            except ValueError as err:
+                self.error("%s; skipping line %d: %s" % (err, linecnt, line))
+
+        # Check/update network attributes that do not affect other objects.
+        # Collect all the differences first, and apply them in a single
+        # transaction, even in incremental mode
+        updates = []
+        ips = list(self.aqnetworks.keys())[:]
+        for ip in ips:
+            if ip not in qipnetworks:
+                # "Forget" networks not inside the requested building to prevent
+                # them being deleted
+                if self.building and self.aqnetworks[ip].location.building != self.building:
+                    del self.aqnetworks[ip]
+                continue
 
+            dbnetwork = self.aqnetworks[ip]
+            qipinfo = qipnetworks[ip]
+            attrs, del_routers, add_ips = self.network_changes(dbnetwork,
+                                                               qipinfo)
+            if attrs or del_routers or add_ips:
+                updates.append((dbnetwork, (attrs, del_routers, add_ips)))
+
+            if dbnetwork.cidr == qipinfo.address.prefixlen:
+                # If the netmask did not change, then we're done with this
+                # network
+                del self.aqnetworks[ip]
+                del qipnetworks[ip]
+
+        for dbnetwork, changes in updates:
+            self.update_network(dbnetwork, changes)
+        self.commit_if_needed()
+
+        # What is left after this point is additions, deletions, splits and
+        # merges
+        actions = self.plan_changes(sorted(itervalues(self.aqnetworks),
+                                           key=attrgetter("ip")),
+                                    sorted(itervalues(qipnetworks)))
+
+        # Committing expires everything, so bulk loading is only useful if
+        # the changes are applied in a single transaction
+        if not self.incremental:
+            self.preload_deletions(actions)
+
+        for action in actions:
+            method, current = action[0:2]
+            if current:
+                self.plenaries.add(current)
+            getattr(self, method)(*action[2:])
             self.commit_if_needed()
+
         self.session.flush()
         self.plenaries.flatten()
         self.plenaries.write()
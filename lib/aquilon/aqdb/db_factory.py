@@ -23,13 +23,15 @@ import logging
 import time
 import hashlib
 import struct
+import threading
+import traceback
 
 from aquilon.aqdb import depends  # pylint: disable=W0611
 from aquilon.config import Config
 from aquilon.exceptions_ import AquilonError
 
 from sqlalchemy.exc import DatabaseError
-from sqlalchemy import create_engine, text, event
+from sqlalchemy import create_engine, text, event, select, func
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -39,6 +41,9 @@ from sqlalchemy.schema import Sequence
 # logging
 query_hashes = None
 
+# The StatementStats object collecting statistics for the current thread
+_active_stats = threading.local()
+
 
 def sqlite_foreign_keys(dbapi_con, con_record):  # pylint: disable=W0613
     dbapi_con.execute('pragma foreign_keys=ON')
@@ -216,6 +221,107 @@ def timer_stop(conn, cursor, statement, parameters, context, executemany):
     log.info("Query running time: %f", total)
 
 
+class StatementStats(object):
+    """
+    Collect statistics about the SQL statements executed by a request.
+
+    Statements are grouped by their text. SQLAlchemy uses bind variables, so
+    the same text being executed many times with different parameters is
+    usually the sign of an attribute being lazy-loaded in a loop. For every
+    distinct statement, the number of executions, the total time spent, and
+    the place in the code which issued it first is recorded.
+
+    Statistics are collected about the statements executed by the current
+    thread between calling start() and stop(). The object can also be used
+    as a context manager.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        # Statement text -> [count, total time, call site]
+        self.statements = {}
+        self._saved = None
+
+    def start(self):
+        self._saved = getattr(_active_stats, "stats", None)
+        _active_stats.stats = self
+
+    def stop(self):
+        _active_stats.stats = self._saved
+        self._saved = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        try:
+            stmt_stats = self.statements[statement]
+        except KeyError:
+            stmt_stats = [0, 0.0, call_site()]
+            self.statements[statement] = stmt_stats
+        stmt_stats[0] += 1
+        stmt_stats[1] += elapsed
+
+    @property
+    def repeated(self):
+        """ Number of executions of statements already seen """
+        return self.count - len(self.statements)
+
+    def worst_offenders(self, limit):
+        """
+        Return the statements executed the most times.
+
+        The result is a list of (count, total time, call site, statement)
+        tuples. Statements executed only once are not included.
+        """
+        offenders = [(stmt_stats[0], stmt_stats[1], stmt_stats[2], statement)
+                     for statement, stmt_stats in self.statements.items()
+                     if stmt_stats[0] > 1]
+        offenders.sort(key=lambda item: (-item[0], -item[1]))
+        return offenders[:limit]
+
+    def audit_results(self):
+        return [("sql_statements", self.count),
+                ("sql_repeated", self.repeated),
+                ("sql_time", "%.3f" % self.total_time)]
+
+
+def call_site():
+    """ Find the innermost frame of our code, outside of this module """
+    this_module = os.path.splitext(__file__)[0]
+    for filename, lineno, funcname, _ in reversed(traceback.extract_stack()):
+        if "/aquilon/" not in filename or \
+           os.path.splitext(filename)[0] == this_module:
+            continue
+        return "%s:%d (%s)" % (filename, lineno, funcname)
+    return "unknown"
+
+
+def stats_start(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=W0613
+    # Keep the start time in the execution context rather than in conn.info,
+    # so a failing statement does not leave a stale entry behind
+    if context is not None and getattr(_active_stats, "stats", None):
+        context._stats_start_time = time.time()
+
+
+def stats_stop(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=W0613
+    stats = getattr(_active_stats, "stats", None)
+    start_time = getattr(context, "_stats_start_time", None)
+    if stats is None or start_time is None:
+        return
+    stats.add(statement, time.time() - start_time)
+
+
 class DbFactory(object):
     __shared_state = {}
     __started = False  # at the class definition, that is
@@ -261,6 +367,11 @@ class DbFactory(object):
             event.listen(engine, "before_cursor_execute", timer_start)
             event.listen(engine, "after_cursor_execute", timer_stop)
 
+        # Statistics are only collected if a StatementStats object is active,
+        # the overhead is negligible otherwise
+        event.listen(engine, "before_cursor_execute", stats_start)
+        event.listen(engine, "after_cursor_execute", stats_stop)
+
         return engine
 
     def __init__(self, verbose=False):
@@ -331,10 +442,16 @@ class DbFactory(object):
         else:
             self.NLSession = self.Session
 
-    def login(self, config, raw_dsn, pool_options):
+        self.ReplicaSession = None
+        self.replica_engine = None
+        if config.has_option("database", "replica_dsn") and \
+           config.get("database", "replica_dsn").strip():
+            self.setup_replica(config, config.get("database", "replica_dsn"),
+                               pool_options)
+
+    def get_passwords(self, config):
         # Default: no password
         passwords = [""]
-        pswd_re = re.compile('PASSWORD')
 
         if config.has_option("database", "password_file"):
             passwd_file = config.get("database", "password_file")
@@ -346,6 +463,111 @@ class DbFactory(object):
                     raise AquilonError("Password file %s is empty." %
                                        passwd_file)
 
+        return passwords
+
+    def setup_replica(self, config, raw_dsn, pool_options):
+        """
+        Set up the engine and the session factory of the read-only replica.
+
+        The replica is not contacted here - if it is not available, then
+        replica_session() will fall back to the primary database.
+        """
+        log = logging.getLogger(__name__)
+
+        dialect = make_url(raw_dsn).get_dialect()
+        if dialect.name == "sqlite":
+            # SQLite does not use connection pooling
+            pool_options = {}
+        # The password file is shared with the primary database, so use the
+        # first password, which is the current one
+        dsn = re.sub('PASSWORD', self.get_passwords(config)[0], raw_dsn)
+
+        self.replica_engine = self.create_engine(config, dsn, **pool_options)
+        self.ReplicaSession = scoped_session(sessionmaker(
+            bind=self.replica_engine))
+
+        self.replica_max_lag = config.getint("database", "replica_max_lag")
+        self.replica_check_interval = config.getint("database",
+                                                    "replica_check_interval")
+        self.replica_lock = threading.Lock()
+        self.replica_checked = 0
+        self.replica_usable = False
+        log.info("Read-only commands will use the replica database %s",
+                 repr(self.replica_engine.url))
+
+    def check_replica(self):
+        """
+        Decide if the replica is close enough to the primary database.
+
+        The lag is measured by comparing the start time of the last
+        transaction recorded in the audit log of the two databases. That works
+        the same way for all database backends and replication methods.
+        """
+        # Circular import
+        from aquilon.aqdb.model import Xtn
+
+        log = logging.getLogger(__name__)
+        query = select([func.max(Xtn.__table__.c.start_time)])
+        try:
+            primary_last = self.engine.execute(query).scalar()
+        except DatabaseError as err:  # pragma: no cover
+            log.warning("Failed to check the primary database: %s", err)
+            return False
+        try:
+            replica_last = self.replica_engine.execute(query).scalar()
+        except DatabaseError as err:
+            log.warning("Replica database is not available: %s", err)
+            return False
+
+        if primary_last is None:
+            return True
+        if replica_last is None:
+            log.warning("Replica database has no transactions recorded.")
+            return False
+
+        lag = (primary_last - replica_last).total_seconds()
+        if lag > self.replica_max_lag:
+            log.warning("Replica database is %.0f seconds behind the "
+                        "primary.", lag)
+            return False
+        return True
+
+    def replica_session(self):
+        """
+        Return a session using the replica, or None if it should not be used.
+
+        The state of the replica is re-checked every replica_check_interval
+        seconds. While one thread is checking, the others keep using the
+        result of the previous check.
+        """
+        if not self.ReplicaSession:
+            return None
+
+        if time.time() - self.replica_checked > self.replica_check_interval \
+           and self.replica_lock.acquire(False):
+            try:
+                usable = self.check_replica()
+                if usable != self.replica_usable:
+                    log = logging.getLogger(__name__)
+                    if usable:
+                        log.info("Using the replica database for read-only "
+                                 "commands.")
+                    else:
+                        log.warning("Falling back to the primary database "
+                                    "for read-only commands.")
+                self.replica_usable = usable
+                self.replica_checked = time.time()
+            finally:
+                self.replica_lock.release()
+
+        if not self.replica_usable:
+            return None
+        return self.ReplicaSession()
+
+    def login(self, config, raw_dsn, pool_options):
+        passwords = self.get_passwords(config)
+        pswd_re = re.compile('PASSWORD')
+
         errs = []
         for p in passwords:
             dsn = re.sub(pswd_re, p, raw_dsn)
@@ -17,8 +17,10 @@
 """ The module governing tables and objects that represent IP networks in
     Aquilon. """
 
+from bisect import bisect_right
 from datetime import datetime
 import logging
+from threading import Lock
 
 from ipaddr import (IPv4Address, IPv4Network, AddressValueError,
                     NetmaskValueError)
@@ -36,6 +38,7 @@ from aquilon.aqdb.model import (Base, Location, NetworkEnvironment,
                                 NetworkCompartment)
 from aquilon.aqdb.column_types import AqStr, IPV4
 from aquilon.config import Config
+from aquilon.utils import chunk
 
 LOGGER = logging.getLogger(__name__)
 _TN = "network"
@@ -381,17 +384,75 @@ class Network(Base):
         return cnt
 
 
-def get_net_id_from_ip(session, ip, network_environment=None):
-    """Requires a session, and will return the Network for a given ip."""
-    if ip is None:
-        return None
+class NetworkIndex(object):
+    """
+    Map IP addresses to networks, without going to the database.
 
-    if isinstance(network_environment, NetworkEnvironment):
-        dbnet_env = network_environment
-    else:
-        dbnet_env = NetworkEnvironment.get_unique_or_default(session,
-                                                             network_environment)
+    Networks inside a network environment do not overlap, so a sorted list
+    of network addresses, and bisection, is enough to find the network
+    containing an address. The lists are built lazily for every network
+    environment, and hold only IDs and integers, so they can be shared
+    between sessions.
 
+    The index may be stale, e.g. if another broker modified the networks,
+    so callers must verify the result against the database.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # Network environment ID -> (network addresses, broadcast
+        # addresses, network IDs)
+        self.environments = {}
+
+    def invalidate(self, net_env_id=None):
+        with self.lock:
+            if net_env_id is None:
+                self.environments.clear()
+            else:
+                self.environments.pop(net_env_id, None)
+
+    def _build(self, session, net_env_id):
+        q = session.query(Network.id, Network.ip, Network.cidr)
+        q = q.filter_by(network_environment_id=net_env_id)
+        q = q.order_by(Network.ip)
+
+        starts = []
+        ends = []
+        ids = []
+        for net_id, ip, cidr in q:
+            starts.append(int(ip))
+            ends.append(int(ip) + (1 << (32 - cidr)) - 1)
+            ids.append(net_id)
+        return starts, ends, ids
+
+    def lookup(self, session, net_env_id, ips):
+        """
+        Return the IDs of the networks containing the given addresses.
+
+        The result is a dict indexed by the address. Addresses not covered by
+        any network are left out.
+        """
+        with self.lock:
+            entry = self.environments.get(net_env_id)
+        if entry is None:
+            entry = self._build(session, net_env_id)
+            with self.lock:
+                self.environments[net_env_id] = entry
+
+        starts, ends, ids = entry
+        result = {}
+        for ip in ips:
+            value = int(ip)
+            idx = bisect_right(starts, value) - 1
+            if idx >= 0 and value <= ends[idx]:
+                result[ip] = ids[idx]
+        return result
+
+
+network_index = NetworkIndex()
+
+
+def _query_net_from_ip(session, ip, dbnet_env):
     # Query the last network having an address smaller than the given ip. There
     # is no guarantee that the returned network does in fact contain the given
     # ip, so this must be checked separately.
@@ -404,9 +465,70 @@ def get_net_id_from_ip(session, ip, network_environment=None):
     q = q.filter(Network.ip == subq.as_scalar())
     net = q.first()
     if not net or ip not in net.network:
+        return None
+    return net
+
+
+def get_nets_from_ips(session, ips, network_environment=None):
+    """
+    Look up the networks containing the given IP addresses.
+
+    Returns a dict indexed by the IP addresses. Addresses which are not
+    covered by any network are left out.
+    """
+    if isinstance(network_environment, NetworkEnvironment):
+        dbnet_env = network_environment
+    else:
+        dbnet_env = NetworkEnvironment.get_unique_or_default(session,
+                                                             network_environment)
+
+    ips = set(ip for ip in ips if ip is not None)
+    net_ids = network_index.lookup(session, dbnet_env.id, ips)
+
+    nets_by_id = {}
+    id_list = sorted(set(net_ids.values()))
+    if len(id_list) == 1:
+        # Use the identity map if possible
+        net = session.query(Network).get(id_list[0])
+        if net:
+            nets_by_id[net.id] = net
+    else:
+        for id_chunk in chunk(id_list, 1000):
+            q = session.query(Network)
+            q = q.filter(Network.id.in_(id_chunk))
+            for net in q:
+                nets_by_id[net.id] = net
+
+    result = {}
+    stale = False
+    for ip in ips:
+        net = nets_by_id.get(net_ids.get(ip))
+        if not net or net.network_environment_id != dbnet_env.id or \
+           ip not in net.network:
+            # Either the address is not covered by any network, or the index
+            # is out of date - ask the database to be sure
+            net = _query_net_from_ip(session, ip, dbnet_env)
+            if net:
+                stale = True
+        if net:
+            result[ip] = net
+
+    if stale:
+        network_index.invalidate(dbnet_env.id)
+
+    return result
+
+
+def get_net_id_from_ip(session, ip, network_environment=None):
+    """Requires a session, and will return the Network for a given ip."""
+    if ip is None:
+        return None
+
+    nets = get_nets_from_ips(session, [ip], network_environment)
+    if ip not in nets:
         raise NotFoundException("Could not determine network containing IP "
                                 "address %s." % ip)
-    return net
+    return nets[ip]
 
 
 # This is a hack. We have to call discover_network_types() after the
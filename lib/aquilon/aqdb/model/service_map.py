@@ -19,19 +19,21 @@
 from collections import defaultdict
 from datetime import datetime
 from sys import maxsize
+from threading import Lock
 
 from sqlalchemy import (Column, Integer, Sequence, DateTime, ForeignKey,
                         UniqueConstraint, CheckConstraint)
 from sqlalchemy.orm import (relation, deferred, backref, defer, undefer,
                             lazyload, contains_eager, object_session)
-from sqlalchemy.sql import and_, or_, null, case
-from sqlalchemy.sql.functions import coalesce
+from sqlalchemy.sql import and_, null, case, func
 
 from aquilon.exceptions_ import InternalError, AquilonError
 from aquilon.aqdb.model import (Base, Location, Desk, Rack, Room, Bunker,
                                 Building, City, Campus, Country, Continent, Hub,
                                 Organization, ServiceInstance, Network, Personality,
-                                PersonalityServiceListItem, HostEnvironment)
+                                HostEnvironment)
+from aquilon.aqdb.utils.transaction import set_transaction_info
+from aquilon.utils import chunk
 
 _TN = 'service_map'
 
@@ -63,6 +65,25 @@ _TARGET_ENVIRONMENT = 100
 _TARGET_GLOBAL = 1000
 
 
+def _scope_priority(location_cls):
+    if location_cls is None:
+        return _NETWORK_PRIORITY
+    try:
+        return _LOCATION_PRIORITY[location_cls]
+    except KeyError:  # pragma: no cover
+        raise InternalError("The service map is not prepared to handle "
+                            "location class %r" % location_cls)
+
+
+def _object_priority(personality, host_environment):
+    if personality is not None:
+        return _TARGET_PERSONALITY
+    elif host_environment is not None:
+        return _TARGET_ENVIRONMENT
+    else:
+        return _TARGET_GLOBAL
+
+
 class ServiceMap(Base):
     """ Service Map: mapping a service_instance to a location.
         The rows in this table assert that an instance is a valid useable
@@ -123,22 +144,13 @@ class ServiceMap(Base):
     @property
     def scope_priority(self):
         if self.network:
-            return _NETWORK_PRIORITY
+            return _scope_priority(None)
         else:
-            try:
-                return _LOCATION_PRIORITY[type(self.location)]
-            except KeyError:  # pragma: no cover
-                raise InternalError("The service map is not prepared to handle "
-                                    "location class %r" % type(self.location))
+            return _scope_priority(type(self.location))
 
     @property
     def object_priority(self):
-        if self.personality:
-            return _TARGET_PERSONALITY
-        elif self.host_environment:
-            return _TARGET_ENVIRONMENT
-        else:
-            return _TARGET_GLOBAL
+        return _object_priority(self.personality, self.host_environment)
 
     @property
     def priority(self):
@@ -214,48 +226,174 @@ class ServiceMap(Base):
         location_ids = [loc.id for loc in dblocation.parents]
         location_ids.append(dblocation.id)
 
-        PSLI = PersonalityServiceListItem
+        services_by_id = {srv.id: srv for srv in dbservices}
+
+        # Maps bound to a host environment apply if the environment matches
+        # the one the personality requests for the service
+        psli_envs = {}
+        for dbsrv, item in dbstage.required_services.items():
+            if item.host_environment_id is not None:
+                psli_envs[dbsrv.id] = item.host_environment_id
+        default_env_id = dbstage.personality.host_environment_id
+
+        si_ids = service_map_index.lookup(session, services_by_id.keys(),
+                                          dbstage.personality_id,
+                                          psli_envs, default_env_id,
+                                          location_ids,
+                                          dbnetwork.id if dbnetwork else None)
+
+        instances_by_id = {}
+        id_list = sorted(set(si_id for ids in si_ids.values() for si_id in ids))
+        for id_chunk in chunk(id_list, 1000):
+            q = session.query(ServiceInstance)
+            q = q.filter(ServiceInstance.id.in_(id_chunk))
+            q = q.options(defer('comments'),
+                          undefer('_client_count'),
+                          lazyload('service'))
+            for si in q:
+                instances_by_id[si.id] = si
 
-        q = session.query(ServiceMap)
-        q = q.join(ServiceInstance)
-        q = q.filter(ServiceInstance.service_id.in_(srv.id for srv in dbservices))
-
-        q = q.outerjoin(PSLI, and_(PSLI.personality_stage_id == dbstage.id,
-                                   PSLI.service_id == ServiceInstance.service_id))
-
-        # Rules for filtering by target object
-        q = q.filter(or_(
-            and_(ServiceMap.personality_id == null(),
-                 ServiceMap.host_environment_id == null()),
-            ServiceMap.personality == dbstage.personality,
-            ServiceMap.host_environment_id == coalesce(
-                PSLI.host_environment_id,
-                dbstage.personality.host_environment.id)))
-
-        # Rules for filtering by location/scope
-        if dbnetwork:
-            q = q.filter(or_(ServiceMap.location_id.in_(location_ids),
-                             ServiceMap.network_id == dbnetwork.id))
-        else:
-            q = q.filter(ServiceMap.location_id.in_(location_ids))
+        instance_cache = {}
+        for service_id, ids in si_ids.items():
+            instances = [instances_by_id[si_id] for si_id in ids
+                         if si_id in instances_by_id]
+            if instances:
+                instance_cache[services_by_id[service_id]] = instances
 
-        q = q.options(contains_eager('service_instance'),
-                      defer('service_instance.comments'),
-                      undefer('service_instance._client_count'),
-                      lazyload('service_instance.service'))
+        return instance_cache
 
-        instance_cache = {}
-        instance_priority = defaultdict(lambda: (maxsize,))
 
-        # For every service, we want the instance(s) with the lowest priority
-        for map in q:
-            si = map.service_instance
-            service = si.service
+class ServiceMapIndex(object):
+    """
+    Resolve service maps without going to the database.
+
+    The index holds every service map, keyed by the location and the network
+    it applies to. Resolving the maps of a host then needs no queries beyond
+    loading the chosen service instances, no matter how many different
+    locations and personalities are involved. Only IDs are stored, so the
+    index can be shared between sessions.
+
+    Changes made by this broker invalidate the index through the exporter
+    framework. Changes made by others are caught by comparing the number of
+    service maps and the highest map ID with the values seen when the index
+    was built, once per transaction. Maps are never updated in place, so
+    this is enough to detect any change.
+    """
 
-            if instance_priority[service] > map.priority:
-                instance_cache[service] = [si]
-                instance_priority[service] = map.priority
-            elif instance_priority[service] == map.priority:
-                instance_cache[service].append(si)
+    def __init__(self):
+        self.lock = Lock()
+        self.fingerprint = None
+        # Location ID -> list of entries
+        self.by_location = None
+        # Network ID -> list of entries
+        self.by_network = None
 
-        return instance_cache
+    def invalidate(self):
+        with self.lock:
+            self.fingerprint = None
+            self.by_location = None
+            self.by_network = None
+
+    @staticmethod
+    def _fingerprint(session):
+        q = session.query(func.count(ServiceMap.id), func.max(ServiceMap.id))
+        return tuple(q.one())
+
+    def _build(self, session):
+        by_location = defaultdict(list)
+        by_network = defaultdict(list)
+        polymorphic_map = Location.__mapper__.polymorphic_map
+
+        q = session.query(ServiceMap.location_id, ServiceMap.network_id,
+                          ServiceMap.personality_id,
+                          ServiceMap.host_environment_id,
+                          ServiceMap.service_instance_id,
+                          ServiceInstance.service_id, Location.location_type)
+        q = q.join(ServiceInstance)
+        q = q.outerjoin(Location, ServiceMap.location_id == Location.id)
+        for (location_id, network_id, personality_id, host_environment_id,
+             si_id, service_id, location_type) in q:
+            if location_id is not None:
+                location_cls = polymorphic_map[location_type].class_
+            else:
+                location_cls = None
+            priority = (_object_priority(personality_id, host_environment_id),
+                        _scope_priority(location_cls))
+            entry = (service_id, si_id, personality_id, host_environment_id,
+                     priority)
+            if location_id is not None:
+                by_location[location_id].append(entry)
+            else:
+                by_network[network_id].append(entry)
+
+        return dict(by_location), dict(by_network)
+
+    def _get(self, session):
+        if not session.info.get("service_map_index_checked"):
+            fingerprint = self._fingerprint(session)
+            with self.lock:
+                if self.fingerprint != fingerprint:
+                    self.fingerprint = None
+                    self.by_location = None
+                    self.by_network = None
+            set_transaction_info(session, "service_map_index_checked", True)
+        else:
+            fingerprint = None
+
+        with self.lock:
+            if self.by_location is not None:
+                return self.by_location, self.by_network
+
+        if fingerprint is None:
+            fingerprint = self._fingerprint(session)
+        by_location, by_network = self._build(session)
+        with self.lock:
+            self.fingerprint = fingerprint
+            self.by_location = by_location
+            self.by_network = by_network
+        return by_location, by_network
+
+    def lookup(self, session, service_ids, personality_id, psli_envs,
+               default_env_id, location_ids, network_id=None):
+        """
+        Return the IDs of the closest mapped instances of the given services.
+
+        psli_envs maps service IDs to the host environment the personality
+        requests for that service, default_env_id is used for services not
+        listed there. The result is a dict indexed by the service ID, services
+        with no maps are left out.
+        """
+        by_location, by_network = self._get(session)
+
+        entries = []
+        for location_id in location_ids:
+            entries.extend(by_location.get(location_id, ()))
+        if network_id is not None:
+            entries.extend(by_network.get(network_id, ()))
+
+        service_ids = set(service_ids)
+        result = {}
+        best_priority = defaultdict(lambda: (maxsize,))
+
+        # For every service, we want the instance(s) with the lowest priority
+        for (service_id, si_id, map_personality_id, map_env_id,
+             priority) in entries:
+            if service_id not in service_ids:
+                continue
+            if map_personality_id is not None:
+                if map_personality_id != personality_id:
+                    continue
+            elif map_env_id is not None:
+                if map_env_id != psli_envs.get(service_id, default_env_id):
+                    continue
+
+            if best_priority[service_id] > priority:
+                result[service_id] = [si_id]
+                best_priority[service_id] = priority
+            elif best_priority[service_id] == priority:
+                result[service_id].append(si_id)
+
+        return result
+
+
+service_map_index = ServiceMapIndex()
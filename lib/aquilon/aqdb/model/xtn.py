@@ -15,8 +15,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """ Xtn (transaction) is an audit trail of all broker activity """
+import atexit
 import logging
 from datetime import datetime
+from threading import Condition, Lock, Thread
+
 from dateutil.tz import tzutc
 from six.moves.urllib_parse import quote  # pylint: disable=F0401
 from six import iteritems
@@ -138,16 +141,11 @@ if config.has_option('database', 'audit_schema'):  # pragma: no cover
     XtnDetail.__table__.schema = schema
 
 
-def start_xtn(session, xtn_id, username, command, is_readonly, details, ignore):
-    """ Wrapper to log the start of a transaction (or running command).
-
-    Takes a dictionary with the transaction parameters.  The keys are
-    command, usename, readonly, and details.  The details parameter
-    is itself a a dictionary of option names to option values provided
-    for the command.
+def xtn_records(xtn_id, username, command, is_readonly, details, ignore):
+    """ Build the rows describing the start of a transaction.
 
-    The options_to_split is a list of any options that need to be
-    split on newlines.  Typically this is --list and/or --hostlist.
+    Returns the row of the xtn table, and the list of rows of the xtn_detail
+    table, as dictionaries suitable for insert statements.
 
     """
     # TODO: one day we should be able to handle non-ASCII characters..
@@ -157,11 +155,9 @@ def start_xtn(session, xtn_id, username, command, is_readonly, details, ignore):
         except UnicodeDecodeError:
             return quote(value)
 
-    # TODO: (maybe) use sql inserts instead of objects to avoid added overhead?
-    # We would be able to exploit executemany() for all the xtn_detail rows
-    x = Xtn(id=xtn_id, command=command, username=username,
-            is_readonly=is_readonly)
-    session.add(x)
+    xtn_row = {"id": xtn_id, "command": command, "username": username,
+               "is_readonly": is_readonly, "start_time": utcnow(None)}
+    detail_rows = []
 
     for key, value in iteritems(details):
         if key in ignore:
@@ -190,12 +186,46 @@ def start_xtn(session, xtn_id, username, command, is_readonly, details, ignore):
             value = '-'
 
         if isinstance(value, list):
-            for item in value:
-                session.add(XtnDetail(xtn_id=xtn_id, name=key,
-                                      value=sanitized_string(item)))
+            detail_rows.extend({"xtn_id": xtn_id, "name": key,
+                                "value": sanitized_string(item)}
+                               for item in value)
         else:
-            session.add(XtnDetail(xtn_id=xtn_id, name=key,
-                                  value=sanitized_string(value)))
+            detail_rows.append({"xtn_id": xtn_id, "name": key,
+                                "value": sanitized_string(value)})
+
+    return xtn_row, detail_rows
+
+
+def xtn_end_records(xtn_id, return_code, results=None):
+    """ Build the rows describing the completion of a transaction. """
+    end_row = {"xtn_id": xtn_id, "return_code": return_code,
+               "end_time": utcnow(None)}
+    result_rows = [{"xtn_id": xtn_id, "name": '__RESULT__:' + str(name),
+                    "value": str(value)}
+                   for name, value in results or []]
+    return end_row, result_rows
+
+
+def start_xtn(session, xtn_id, username, command, is_readonly, details, ignore):
+    """ Wrapper to log the start of a transaction (or running command).
+
+    Takes a dictionary with the transaction parameters.  The keys are
+    command, usename, readonly, and details.  The details parameter
+    is itself a a dictionary of option names to option values provided
+    for the command.
+
+    The options_to_split is a list of any options that need to be
+    split on newlines.  Typically this is --list and/or --hostlist.
+
+    """
+    xtn_row, detail_rows = xtn_records(xtn_id, username, command,
+                                       is_readonly, details, ignore)
+
+    # Using core inserts lets us exploit executemany() for all the xtn_detail
+    # rows, which matters for commands taking a --list
+    session.execute(Xtn.__table__.insert(), xtn_row)
+    if detail_rows:
+        session.execute(XtnDetail.__table__.insert(), detail_rows)
 
     try:
         session.commit()
@@ -209,11 +239,10 @@ def start_xtn(session, xtn_id, username, command, is_readonly, details, ignore):
 def end_xtn(session, xtn_id, return_code, results=None):
     """ Take an audit message and commit the transaction completion. """
 
-    session.add(XtnEnd(xtn_id=xtn_id, return_code=return_code))
-    if results:
-        for name, value in results:
-            session.add(XtnDetail(xtn_id=xtn_id, name='__RESULT__:' + str(name),
-                                  value=str(value)))
+    end_row, result_rows = xtn_end_records(xtn_id, return_code, results)
+    session.execute(XtnEnd.__table__.insert(), end_row)
+    if result_rows:
+        session.execute(XtnDetail.__table__.insert(), result_rows)
 
     try:
         session.commit()
@@ -222,3 +251,127 @@ def end_xtn(session, xtn_id, return_code, results=None):
         log.error(e)
         # Swallow the error - can't do anything about this, and the
         # user really can't do anything about this.
+
+
+class AuditWriter(object):
+    """ Write audit records from a background thread, in batches.
+
+    Read-only commands do not change anything, so their audit records are not
+    needed for consistency, only for reporting. Instead of two commits for
+    every such command, the records are queued when the command completes,
+    and a background thread writes them in a single transaction every
+    interval seconds, or when batch_size records are waiting.
+
+    Records still in the queue are lost if the broker dies. At a clean
+    shutdown, the queue is written out before exiting.
+
+    """
+
+    def __init__(self, engine, interval=5, batch_size=1000):
+        self.engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self.cond = Condition()
+        self.pending = []
+        self.thread = None
+        self.stopping = False
+        self.written = 0
+        self.dropped = 0
+
+    def submit(self, records, return_code, results=None):
+        """ Queue the records returned by xtn_records() for writing. """
+        xtn_row, detail_rows = records
+        end_row, result_rows = xtn_end_records(xtn_row["id"], return_code,
+                                               results)
+        with self.cond:
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="audit writer")
+                self.thread.daemon = True
+                self.thread.start()
+            self.pending.append((xtn_row, detail_rows + result_rows, end_row))
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def _write(self, batch):
+        with self.engine.begin() as conn:
+            conn.execute(Xtn.__table__.insert(),
+                         [xtn_row for xtn_row, _, _ in batch])
+            detail_rows = [row for _, rows, _ in batch for row in rows]
+            if detail_rows:
+                conn.execute(XtnDetail.__table__.insert(), detail_rows)
+            conn.execute(XtnEnd.__table__.insert(),
+                         [end_row for _, _, end_row in batch])
+
+    def flush(self):
+        """ Write out everything queued so far. """
+        with self.cond:
+            batch = self.pending
+            self.pending = []
+        if not batch:
+            return
+
+        try:
+            self._write(batch)
+            self.written += len(batch)
+            return
+        except Exception as err:
+            log.warning("Failed to write %d audit records in a batch, "
+                        "retrying one by one: %s", len(batch), err)
+
+        # Do not let a single bad record take the whole batch with it
+        for record in batch:
+            try:
+                self._write([record])
+                self.written += 1
+            except Exception as err:
+                self.dropped += 1
+                log.error("Audit record of request %s is lost: %s",
+                          record[0]["id"], err)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.stopping and len(self.pending) < self.batch_size:
+                    self.cond.wait(self.interval)
+                stopping = self.stopping
+            self.flush()
+            if stopping:
+                break
+
+    def stop(self):
+        """ Write out the queue, and stop the background thread. """
+        with self.cond:
+            self.stopping = True
+            thread = self.thread
+            self.cond.notify()
+        if thread:
+            thread.join()
+        self.flush()
+        log.info("Audit writer stopped, %d records written, %d lost.",
+                 self.written, self.dropped)
+
+
+_audit_writer = None
+_audit_writer_lock = Lock()
+
+
+def get_audit_writer(engine):
+    """ Return the audit writer, or None if asynchronous writing is off. """
+    global _audit_writer
+
+    if not config.has_option("database", "audit_async_readonly") or \
+       not config.getboolean("database", "audit_async_readonly"):
+        return None
+
+    with _audit_writer_lock:
+        if _audit_writer is None:
+            interval = config.getint("database", "audit_flush_interval")
+            batch_size = config.getint("database", "audit_batch_size")
+            _audit_writer = AuditWriter(engine, interval=interval,
+                                        batch_size=batch_size)
+            atexit.register(_audit_writer.stop)
+            log.warning("Audit records of read-only commands are written "
+                        "asynchronously, in batches of up to %d records. "
+                        "Records queued in the last %d seconds are lost if "
+                        "the broker dies.", batch_size, interval)
+        return _audit_writer
@@ -0,0 +1,45 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Keep data in the session for the duration of a transaction """
+
+from sqlalchemy import event
+
+_TRANSACTION_KEYS = "transaction_info_keys"
+
+
+def _drop_transaction_info(session, transaction):
+    # Only the end of the outermost transaction matters, not the end of
+    # subtransactions and savepoints. SessionTransaction.parent is not
+    # available before SQLAlchemy 1.0.16.
+    if transaction._parent is not None:  # pylint: disable=W0212
+        return
+    for key in session.info.pop(_TRANSACTION_KEYS, ()):
+        session.info.pop(key, None)
+
+
+def set_transaction_info(session, key, value):
+    """
+    Store value in session.info until the end of the current transaction.
+
+    Use it for data which is valid only as long as the locks or the snapshot
+    of the transaction are held.
+    """
+    session.info[key] = value
+    session.info.setdefault(_TRANSACTION_KEYS, set()).add(key)
+    if not event.contains(session, "after_transaction_end",
+                          _drop_transaction_info):
+        event.listen(session, "after_transaction_end", _drop_transaction_info)
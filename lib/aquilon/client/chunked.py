@@ -15,7 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from six.moves.http_client import HTTPResponse, HTTPConnection  # pylint: disable=F0401
+from six.moves.http_client import (HTTPResponse, HTTPConnection,  # pylint: disable=F0401
+                                   IncompleteRead)
 
 
 class ChunkedHTTPResponse(HTTPResponse):
@@ -36,7 +37,13 @@ class ChunkedHTTPResponse(HTTPResponse):
             i = line.find(';')
             if i >= 0:
                 line = line[:i]  # strip chunk-extensions
-            chunk_left = int(line, 16)
+            try:
+                chunk_left = int(line, 16)
+            except ValueError:
+                # The server dropped the connection in the middle of the
+                # response
+                self.close()
+                raise IncompleteRead(value)
             if chunk_left == 0:
                 # read and discard trailer up to the CRLF terminator
                 # note: we shouldn't have any trailers!
@@ -16,8 +16,9 @@
 # limitations under the License.
 
 import logging
-from threading import Condition
-from collections import defaultdict
+import time
+from threading import Condition, Lock
+from collections import defaultdict, OrderedDict
 from itertools import chain
 from six import iteritems, itervalues, string_types
 
@@ -26,6 +27,94 @@ from aquilon.exceptions_ import InternalError
 LOGGER = logging.getLogger('aquilon.locks')
 
 
+class LockHistogram(object):
+    """Distribution of time intervals, using fixed buckets."""
+
+    # Upper bounds of the buckets, in seconds. The last bucket collects
+    # everything larger than the last bound.
+    bounds = (0.001, 0.01, 0.1, 1.0, 10.0, 60.0, 600.0)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        for idx, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.buckets[idx] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def copy(self):
+        histogram = LockHistogram()
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        histogram.buckets = self.buckets[:]
+        return histogram
+
+
+class LockNamespaceStats(object):
+    """Wait and hold time statistics of a single lock namespace."""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.wait = LockHistogram()
+        self.hold = LockHistogram()
+
+    def copy(self):
+        stats = LockNamespaceStats(self.namespace)
+        stats.wait = self.wait.copy()
+        stats.hold = self.hold.copy()
+        return stats
+
+
+class LockStats(object):
+    """Aggregate the timestamps recorded by released lock keys.
+
+    Every key is accounted for in every namespace it contains items from, so
+    e.g. a CompileKey for a single profile counts for the "profile", "domain"
+    and "misc" namespaces.
+
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.namespaces = {}
+
+    def add(self, key):
+        if key.requested_at is None or key.acquired_at is None or \
+           key.released_at is None:
+            return
+
+        wait = key.acquired_at - key.requested_at
+        hold = key.released_at - key.acquired_at
+        names = set(key.exclusive)
+        names.update(key.shared)
+        with self.lock:
+            for name in names:
+                try:
+                    stats = self.namespaces[name]
+                except KeyError:
+                    stats = LockNamespaceStats(name)
+                    self.namespaces[name] = stats
+                stats.wait.add(wait)
+                stats.hold.add(hold)
+
+    def snapshot(self):
+        """Return a consistent copy of the statistics, sorted by name."""
+        with self.lock:
+            return [self.namespaces[name].copy()
+                    for name in sorted(self.namespaces)]
+
+
 class LockQueue(object):
     """Provide a layered (namespaced?) locking mechanism.
 
@@ -38,49 +127,129 @@ class LockQueue(object):
     As a convenience, ignore undefined keys.  This essentially
     equates a key of None with a no-op request.
 
+    Conflicts are found using an index of the queued keys by lock namespace
+    and item, so the cost of acquiring a lock does not depend on the length of
+    the queue. Since new keys are always added to the end of the queue, the
+    set of keys blocking a waiter can only shrink; each waiter has its own
+    condition variable, and it is woken up only when its last blocker goes
+    away.
+
     """
 
     def __init__(self):
-        self.queue_condition = Condition()
-        self.queue = []
+        self.queue_lock = Lock()
+        self.keys = OrderedDict()
+        # (name, item) => set of keys holding the item in exclusive mode
+        self.exclusive_index = defaultdict(set)
+        # (name, item) => set of keys holding the item in shared mode
+        self.shared_index = defaultdict(set)
+        # key => set of keys preceeding it in the queue which block it
+        self.blocked_by = {}
+        # key => set of keys waiting for it
+        self.waiters = defaultdict(set)
+        # key => condition used to wake up the key
+        self.conditions = {}
+        self.stats = LockStats()
+
+    @property
+    def queue(self):
+        """The keys in the queue, in the order they were requested."""
+        with self.queue_lock:
+            return list(self.keys)
 
     def acquire(self, key):
         key.transition("acquiring")
-        with self.queue_condition:
-            if key in self.queue:
+        with self.queue_lock:
+            if key in self.keys:
                 raise InternalError("Duplicate attempt to aquire %s with the "
                                     "same key." % key)
-            self.queue.append(key)
-            while self.blocked(key):  # pragma: no cover
-                self.queue_condition.wait()
+            blockers = self.find_blockers(key)
+            self.keys[key] = True
+            for name, item in key.exclusive_items():
+                self.exclusive_index[(name, item)].add(key)
+            for name, item in key.shared_items():
+                self.shared_index[(name, item)].add(key)
+
+            if blockers:  # pragma: no cover
+                self.log_blockers(key, blockers)
+                self.blocked_by[key] = blockers
+                for blocker in blockers:
+                    self.waiters[blocker].add(key)
+                condition = Condition(self.queue_lock)
+                self.conditions[key] = condition
+                while self.blocked_by[key]:
+                    condition.wait()
+                del self.blocked_by[key]
+                del self.conditions[key]
             key.transition("acquired")
 
+    def find_blockers(self, key):
+        """Return the set of queued keys that would block this key.
+
+        The key is blocked if:
+            - its exclusive set intersects with the shared or exclusive set of
+              a queued key
+            - its shared set intersects with the exclusive set of a queued key
+
+        """
+        blockers = set()
+        for name_item in key.exclusive_items():
+            if name_item in self.exclusive_index:
+                blockers.update(self.exclusive_index[name_item])
+            if name_item in self.shared_index:
+                blockers.update(self.shared_index[name_item])
+        for name_item in key.shared_items():
+            if name_item in self.exclusive_index:
+                blockers.update(self.exclusive_index[name_item])
+        blockers.discard(key)
+        return blockers
+
     def blocked(self, key):
         """Indicate whether the lock for this key can be acquired.
 
-        As a side effect, reset the key's knowledge of external
-        blockers and let it know if it is in line.
+        If the key is in the queue, then the answer depends on the keys
+        preceeding it; otherwise, the question is "would queued keys block
+        this one?"
 
         """
-        blocker_count = 0
-        for k in self.queue:
-            if k == key:
-                break
-            blockers = k.blocks(key)
-            if blockers:
-                blocker_count += 1
-                key.log("Blocking on %s" % ", ".join(sorted(list(blockers))))
-        # Can only get here if the key is not in the queue - seems
-        # like a valid theoretical question to ask - in which case
-        # the method is "would queued keys block this one?"
-        return blocker_count > 0
+        with self.queue_lock:
+            if key in self.keys:
+                return bool(self.blocked_by.get(key))
+            return bool(self.find_blockers(key))
+
+    def log_blockers(self, key, blockers):
+        # Formatting the blocker list can be expensive, so only do that if
+        # the message will really be logged
+        if not key.logger.isEnabledFor(key.loglevel):
+            return
+        items = set()
+        for blocker in blockers:
+            items.update(blocker.blocks(key))
+        key.log("Blocking on %s" % ", ".join(sorted(items)))
 
     def release(self, key):
         key.transition("releasing")
-        with self.queue_condition:
-            self.queue.remove(key)
-            self.queue_condition.notifyAll()
+        with self.queue_lock:
+            del self.keys[key]
+            for name_item in key.exclusive_items():
+                self._unindex(self.exclusive_index, name_item, key)
+            for name_item in key.shared_items():
+                self._unindex(self.shared_index, name_item, key)
+
+            for waiter in self.waiters.pop(key, ()):
+                blockers = self.blocked_by[waiter]
+                blockers.discard(key)
+                if not blockers:
+                    self.conditions[waiter].notify()
         key.transition("released")
+        self.stats.add(key)
+
+    @staticmethod
+    def _unindex(index, name_item, key):
+        keys = index[name_item]
+        keys.discard(key)
+        if not keys:
+            del index[name_item]
 
 
 class LockKey(object):
@@ -98,6 +267,9 @@ class LockKey(object):
         self.loglevel = loglevel
         self.lock_queue = lock_queue
         self.state = None
+        self.requested_at = None
+        self.acquired_at = None
+        self.released_at = None
 
     def __str__(self):
         exc_items = []
@@ -123,6 +295,16 @@ class LockKey(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.lock_queue.release(self)
 
+    def exclusive_items(self):
+        for name, items in iteritems(self.exclusive):
+            for item in items:
+                yield (name, item)
+
+    def shared_items(self):
+        for name, items in iteritems(self.shared):
+            for item in items:
+                yield (name, item)
+
     def log(self, *args, **kwargs):
         self.logger.log(self.loglevel, *args, **kwargs)
 
@@ -138,6 +320,13 @@ class LockKey(object):
                     if not isinstance(key, string_types):
                         raise ValueError("Lock key contains %r" % key)
 
+        if state == "acquiring":
+            self.requested_at = time.time()
+        elif state == "acquired":
+            self.acquired_at = time.time()
+        elif state == "releasing":
+            self.released_at = time.time()
+
         self.state = state
         self.logger.debug('%s %s', state, self)
 
@@ -21,12 +21,18 @@ import time
 import socket
 import logging
 import gzip
+from tempfile import mkstemp
+from threading import Lock, Thread
 
 from xml.etree import ElementTree
 
+from six import iteritems
+from six.moves.queue import Queue, Empty  # pylint: disable=F0401
+
 from aquilon.exceptions_ import AquilonError
+from aquilon.config import Config
 from aquilon.aqdb.model import Service
-from aquilon.utils import write_file, remove_file
+from aquilon.utils import remove_file, chunk
 
 LOGGER = logging.getLogger(__name__)
 
@@ -41,44 +47,59 @@ except:  # pragma: no cover
     CDPPORT = 7777
 
 
-def build_index(config, session, logger=LOGGER):
-    '''
-    Create an index of what profiles are available
+class ProfileIndex(object):
+    """
+    In-memory copy of the index of available profiles (profiles-info.xml)
 
-    Compare the mtimes of everything in profiledir against
-    an index file (profiles-info.xml). Produce a new index
-    and send out notifications to "server modules" (as defined
-    within the broker configuration).
-    '''
-    gzip_output = config.getboolean('panc', 'gzip_output')
-    transparent_gzip = config.getboolean('panc', 'transparent_gzip')
-    gzip_index = gzip_output and transparent_gzip
+    The index is built by scanning the whole profilesdir when rescan() is
+    called. After that, update() can be used to apply changes to a known set
+    of objects, which needs to look only at the files of those objects.
+    """
 
-    profilesdir = config.get("broker", "profilesdir")
+    def __init__(self, config, logger=LOGGER):
+        self.config = config
+        self.logger = logger
 
-    # Profiles are xml or json files, and can be configured to (additionally) be gzip'd
-    if config.getboolean('panc', 'gzip_output'):
-        compress_suffix = ".gz"
-    else:
-        compress_suffix = ""
+        gzip_output = config.getboolean('panc', 'gzip_output')
+        self.transparent_gzip = config.getboolean('panc', 'transparent_gzip')
+        self.gzip_index = gzip_output and self.transparent_gzip
+
+        self.profilesdir = config.get("broker", "profilesdir")
+
+        # Profiles are xml or json files, and can be configured to
+        # (additionally) be gzip'd
+        if gzip_output:
+            compress_suffix = ".gz"
+        else:
+            compress_suffix = ""
+
+        self.suffixes = [".xml" + compress_suffix, ".json" + compress_suffix]
 
-    suffixes = [".xml" + compress_suffix, ".json" + compress_suffix]
+        # The profile should be .xml, unless webserver trickery is going to
+        # redirect all requests for .xml files to be .xml.gz requests. :)
+        self.profile_index = 'profiles-info.xml'
+        if self.gzip_index:
+            self.profile_index += '.gz'
+        self.index_path = os.path.join(self.profilesdir, self.profile_index)
 
-    # The profile should be .xml, unless webserver trickery is going to
-    # redirect all requests for .xml files to be .xml.gz requests. :)
-    profile_index = 'profiles-info.xml'
-    if gzip_index:
-        profile_index += '.gz'
+        # objects stores the (mtime, suffix) pairs we discovered. Its purpose
+        # is de-duplicating if there are multiple suffixes (say, both .json
+        # and .xml) for the same object - we want to advertise only the
+        # newest.
+        self.objects = None
+
+    def read_index(self):
+        """ Return the object => mtime mapping stored in the index file """
+        old_object_index = {}
+        source = None
+        if not os.path.exists(self.index_path):
+            return old_object_index
 
-    old_object_index = {}
-    index_path = os.path.join(profilesdir, profile_index)
-    source = None
-    if os.path.exists(index_path):
         try:
-            if gzip_index:
-                source = gzip.open(index_path)
+            if self.gzip_index:
+                source = gzip.open(self.index_path)
             else:
-                source = open(index_path)
+                source = open(self.index_path)
             tree = ElementTree.parse(source)
             for profile in tree.getiterator("profile"):
                 if not profile.text or "mtime" not in profile.attrib:
@@ -101,95 +122,213 @@ def build_index(config, session, logger=LOGGER):
                 if obj not in old_object_index or old_object_index[obj] < mtime:
                     old_object_index[obj] = mtime
         except Exception as e:  # pragma: no cover
-            logger.info("Error processing %s, continuing: %s",
-                        index_path, e)
+            self.logger.info("Error processing %s, continuing: %s",
+                             self.index_path, e)
         finally:
             if source:
                 source.close()
 
-    # modified_index stores the subset of namespaced names that
-    # have changed since the last index. The values are unused.
-    modified_index = {}
+        return old_object_index
+
+    def advertise_suffix(self, suffix):
+        # The index generally just lists whatever is produced.  However,
+        # the webserver may be configured to transparently serve up
+        # .xml.gz files when just the .xml is requested.  In this case,
+        # the index should just list (advertise) the profile as a .xml
+        # file.
+        if self.transparent_gzip:
+            return suffix.rstrip(".gz")
+        else:
+            return suffix
+
+    def rescan(self):
+        """
+        Rebuild the index by walking the whole profilesdir.
+
+        Compare the mtimes of everything in profiledir against the previous
+        state of the index - the in-memory copy if there is one, or the index
+        file otherwise. Returns the subset of object names that have changed
+        since the last index.
+        """
+        if self.objects is None:
+            old_object_index = self.read_index()
+        else:
+            old_object_index = dict((obj, mtime) for obj, (mtime, _) in
+                                    iteritems(self.objects))
+
+        # modified_index stores the subset of namespaced names that
+        # have changed since the last index. The values are unused.
+        modified_index = {}
+
+        objects = {}
+
+        # Old profiles that should be cleaned up, if the profile extension changes
+        cleanup = []
+
+        for root, _, files in os.walk(self.profilesdir):
+            for profile in files:
+                if profile == self.profile_index:
+                    continue
+
+                for suffix in self.suffixes:
+                    if not profile.endswith(suffix):
+                        continue
+
+                    obj = os.path.join(root, profile[:-len(suffix)])
+
+                    # Remove the common prefix: our profilesdir, so that the
+                    # remaining object name is relative to that root (+1 in order
+                    # to remove the slash separator)
+                    obj = obj[len(self.profilesdir) + 1:]
+
+                    # This operation is not done with a lock, and it's possible
+                    # that the file has been removed since calling os.walk().
+                    # If that's the case, no need to add it to the modified_index.
+                    try:
+                        mtime = os.path.getmtime(os.path.join(root, profile))
+                    except OSError as e:
+                        continue
+
+                    if obj in old_object_index:
+                        if mtime > old_object_index[obj]:
+                            modified_index[obj] = mtime
+
+                        # Note this test means stale profiles will be cleaned up the
+                        # second time the index is rebuilt: the first time the
+                        # profile's mtime will still match the old index
+                        if mtime < old_object_index[obj]:
+                            cleanup.append(os.path.join(root, profile))
+
+                    if obj not in objects or objects[obj][0] < mtime:
+                        objects[obj] = (mtime, self.advertise_suffix(suffix))
+
+        self.objects = objects
+        self.cleanup(cleanup)
+        return modified_index
+
+    def update(self, names):
+        """
+        Update the index entries of the given objects only.
+
+        The object names are relative to profilesdir, without any extension.
+        Objects which no longer have a profile are removed from the index.
+        Returns the subset of object names that have changed, same as
+        rescan().
+        """
+        if self.objects is None:
+            return self.rescan()
+
+        modified_index = {}
+        cleanup = []
+
+        for obj in set(names):
+            old = self.objects.get(obj)
+            newest = None
+            for suffix in self.suffixes:
+                filename = os.path.join(self.profilesdir, obj + suffix)
+                try:
+                    mtime = os.path.getmtime(filename)
+                except OSError:
+                    continue
+
+                # Same logic as in rescan()
+                if old:
+                    if mtime > old[0]:
+                        modified_index[obj] = mtime
+                    if mtime < old[0]:
+                        cleanup.append(filename)
 
-    # objects stores the (mtime, suffix) pairs we discovered. Its purpose is
-    # de-duplicating if there are multiple suffixes (say, both .json and .xml)
-    # for the same object - we want to advertise only the newest.
-    objects = {}
+                if not newest or newest[0] < mtime:
+                    newest = (mtime, self.advertise_suffix(suffix))
 
-    # Old profiles that should be cleaned up, if the profile extension changes
-    cleanup = []
+            if newest:
+                self.objects[obj] = newest
+            else:
+                self.objects.pop(obj, None)
 
-    for root, _, files in os.walk(profilesdir):
-        for profile in files:
-            if profile == profile_index:
-                continue
+        self.cleanup(cleanup)
+        return modified_index
 
-            for suffix in suffixes:
-                if not profile.endswith(suffix):
-                    continue
+    def cleanup(self, filenames):
+        for filename in filenames:
+            self.logger.debug("Cleaning up %s", filename)
+            remove_file(filename, logger=self.logger)
 
-                obj = os.path.join(root, profile[:-len(suffix)])
+    def write(self):
+        """
+        Write out the index file.
 
-                # Remove the common prefix: our profilesdir, so that the
-                # remaining object name is relative to that root (+1 in order
-                # to remove the slash separator)
-                obj = obj[len(profilesdir) + 1:]
+        The content is streamed into a temporary file, which is then renamed
+        into place, same as write_file() does.
+        """
+        dirname, basename = os.path.split(self.index_path)
+        try:
+            old_mode = os.stat(self.index_path).st_mode
+        except OSError:
+            old_mode = 0o644
 
-                # This operation is not done with a lock, and it's possible
-                # that the file has been removed since calling os.walk().
-                # If that's the case, no need to add it to the modified_index.
-                try:
-                    mtime = os.path.getmtime(os.path.join(root, profile))
-                except OSError as e:
-                    continue
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
 
-                if obj in old_object_index:
-                    if mtime > old_object_index[obj]:
-                        modified_index[obj] = mtime
+            fd, fpath = mkstemp(prefix=basename, dir=dirname)
+        except OSError as err:
+            raise AquilonError("Failed to write %s: %s" % (self.index_path, err))
 
-                    # Note this test means stale profiles will be cleaned up the
-                    # second time the index is rebuilt: the first time the
-                    # profile's mtime will still match the old index
-                    if mtime < old_object_index[obj]:
-                        cleanup.append(os.path.join(root, profile))
-
-                # The index generally just lists whatever is produced.  However,
-                # the webserver may be configured to transparently serve up
-                # .xml.gz files when just the .xml is requested.  In this case,
-                # the index should just list (advertise) the profile as a .xml
-                # file.
-                if transparent_gzip:
-                    advertise_suffix = suffix.rstrip(".gz")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                if self.gzip_index:
+                    out = gzip.GzipFile(self.index_path, 'wb',
+                                        self.config.getint('broker',
+                                                           'gzip_level'),
+                                        f)
                 else:
-                    advertise_suffix = suffix
+                    out = f
+
+                out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+                out.write("<profiles>\n")
+                for obj, (mtime, advertise_suffix) in iteritems(self.objects):
+                    out.write("<profile mtime='%d'>%s%s</profile>\n" %
+                              (mtime, obj, advertise_suffix))
+                out.write("</profiles>")
+
+                if self.gzip_index:
+                    out.close()
+            os.chmod(fpath, old_mode)
+            os.rename(fpath, self.index_path)
+        except (IOError, OSError) as err:
+            raise AquilonError("Failed to write %s: %s" % (self.index_path, err))
+        finally:
+            if os.path.exists(fpath):
+                os.remove(fpath)
 
-                if obj not in objects or objects[obj][0] < mtime:
-                    objects[obj] = (mtime, advertise_suffix)
 
-    content = []
-    content.append("<?xml version='1.0' encoding='utf-8'?>")
-    content.append("<profiles>")
-    for obj, (mtime, advertise_suffix) in objects.items():
-        content.append("<profile mtime='%d'>%s%s</profile>" %
-                       (mtime, obj, advertise_suffix))
-    content.append("</profiles>")
+def build_index(config, session, logger=LOGGER, index=None, objects=None):
+    '''
+    Create an index of what profiles are available
 
-    compress = None
-    if gzip_index:
-        compress = 'gzip'
+    Compare the mtimes of everything in profiledir against
+    an index file (profiles-info.xml). Produce a new index
+    and send out notifications to "server modules" (as defined
+    within the broker configuration).
 
-    try:
-        write_file(index_path, "\n".join(content), logger=logger,
-                   compress=compress, create_directory=True)
-    except OSError as err:
-        raise AquilonError("Failed to write %s: %s" % (index_path, err))
+    If an existing ProfileIndex is passed in, then it is updated instead of
+    starting from the index file. In that case, if objects is not None, then
+    only the listed objects are checked, instead of walking the whole
+    profilesdir.
+    '''
+    if not index:
+        index = ProfileIndex(config, logger=logger)
 
-    logger.info("Updated %s, %d objects modified", index_path,
-                len(modified_index))
+    if objects is None:
+        modified_index = index.rescan()
+    else:
+        modified_index = index.update(objects)
 
-    for filename in cleanup:
-        logger.debug("Cleaning up %s", filename)
-        remove_file(filename, logger=logger)
+    index.write()
+
+    logger.info("Updated %s, %d objects modified", index.index_path,
+                len(modified_index))
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
@@ -217,60 +356,207 @@ def build_index(config, session, logger=LOGGER):
                 except Exception as e:
                     logger.info("failed to lookup up server module %s: %s",
                                 service, e)
-        count = send_notification(CDB_NOTIF, servers, sock=sock,
-                                  logger=logger)
-        logger.info("sent %d server notifications", count)
+        stats = send_notification(CDB_NOTIF, servers, sock=sock,
+                                  logger=logger, config=config)
+        logger.info("server notifications: %s", stats)
 
     if (config.has_option("broker", "client_notifications")
             and config.getboolean("broker", "client_notifications")):  # pragma: no cover
-        count = send_notification(CCM_NOTIF, modified_index.keys(), sock=sock,
-                                  logger=logger)
-        logger.info("sent %d client notifications", count)
+        stats = send_notification(CCM_NOTIF, modified_index.keys(), sock=sock,
+                                  logger=logger, config=config)
+        logger.info("client notifications: %s", stats)
 
     sock.close()
 
 
-def send_notification(ntype, modified, sock=None, logger=LOGGER):
-    '''send CDP notification messages to a list of hosts.
+class NotificationStats(object):
+    """ Outcome of sending a set of notifications """
 
-    This are sent synchronously, but we don't wait (or care) for any
-    reply, so it shouldn't be a problem. type should be CCM_NOTIF or CDB_NOTIF.
-    'modified' is a dict of object names that may be namespaced. Object
-    names that cannot be looked up in DNS are silently ignored.
-    Returns the number of notifications that were sent.
-    '''
+    def __init__(self):
+        self.sent = 0
+        self.unresolved = 0
+        self.failed = 0
 
-    success = 0
-    for obj in modified:
-        # We need to clean the name, since it might
-        # be namespaced. This (in effect) globalizes
-        # all names. Perhaps we might want to do some
-        # checks based on the namespace. Not for now.
-        (_, _, host) = obj.rpartition('/')
+    def __str__(self):
+        return "%d sent, %d unresolved, %d failed" % (self.sent,
+                                                      self.unresolved,
+                                                      self.failed)
 
-        try:
-            # If you think it would be a good idea to look up the IP address
-            # from the DB directly, then think about the case when the IP
-            # address of a host changes: the DB contains the new address, but
-            # the host still uses the old. Relying on DNS here means that the
-            # notification goes to the right place.
-            ip = socket.gethostbyname(host)
-            packet = NOTIFICATION_TYPES[ntype] + "\0" + str(int(time.time()))
-            sock.sendto(packet, (ip, CDPPORT))
-            success = success + 1
 
+class HostResolver(object):
+    """
+    Resolve host names using a pool of threads, caching the results.
+
+    Both successful and failed lookups are cached for ttl seconds, so a burst
+    of notifications for the same hosts does not hit the resolver again. A
+    lookup that fails for any other reason than the name being unknown is
+    not cached.
+    """
+
+    def __init__(self, threads=8, ttl=300):
+        self.threads = max(threads, 1)
+        self.ttl = ttl
+        self.cache = {}
+        self.lock = Lock()
+
+    def _gethostbyname(self, host):
+        return socket.gethostbyname(host)
+
+    def _lookup(self, host, now):
+        with self.lock:
+            entry = self.cache.get(host)
+        if entry and entry[1] > now:
+            return entry[0]
+
+        # If you think it would be a good idea to look up the IP address
+        # from the DB directly, then think about the case when the IP
+        # address of a host changes: the DB contains the new address, but
+        # the host still uses the old. Relying on DNS here means that the
+        # notification goes to the right place.
+        try:
+            ip = self._gethostbyname(host)
         except socket.gaierror:
-            # This hostname is unknown, so we silently
-            # discard the notification.
-            pass
+            ip = None
+
+        with self.lock:
+            self.cache[host] = (ip, now + self.ttl)
+        return ip
+
+    def resolve(self, hosts, logger=LOGGER):
+        """
+        Resolve the given names.
+
+        Returns a tuple of a name => IP address dictionary, a list of names
+        that could not be resolved, and a list of names where the lookup
+        failed with an unexpected error.
+        """
+        now = time.time()
+        work = Queue()
+        for host in hosts:
+            work.put(host)
+
+        resolved = {}
+        unresolved = []
+        failed = []
+        results_lock = Lock()
+
+        def worker():
+            while True:
+                try:
+                    host = work.get_nowait()
+                except Empty:
+                    return
+                try:
+                    ip = self._lookup(host, now)
+                except Exception as e:  # pylint: disable=W0703
+                    logger.info("Error resolving %s: %s", host, e)
+                    with results_lock:
+                        failed.append(host)
+                    continue
+                with results_lock:
+                    if ip:
+                        resolved[host] = ip
+                    else:
+                        unresolved.append(host)
+
+        workers = [Thread(target=worker)
+                   for _ in range(min(self.threads, work.qsize()))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        # Drop expired entries, so the cache does not grow without bounds
+        with self.lock:
+            expired = [host for host, (_, expiry) in iteritems(self.cache)
+                       if expiry <= now]
+            for host in expired:
+                del self.cache[host]
+
+        return resolved, unresolved, failed
+
 
-        except Exception as e:
-            logger.info("Error notifying %s: %s", host, e)
+_resolver = None
 
-    return success
 
+def get_resolver(config):
+    global _resolver
+    if not _resolver:
+        _resolver = HostResolver(
+            threads=config.getint("broker", "cdp_resolver_threads"),
+            ttl=config.getint("broker", "cdp_resolver_cache_ttl"))
+    return _resolver
+
+
+def send_notification(ntype, modified, sock=None, logger=LOGGER,
+                      config=None, resolver=None):
+    '''send CDP notification messages to a list of hosts.
+
+    The names are resolved in parallel, and then the notifications are sent
+    out in batches; we don't wait (or care) for any reply. type should be
+    CCM_NOTIF or CDB_NOTIF.  'modified' is a list of object names that may be
+    namespaced. Object names that cannot be looked up in DNS are counted as
+    unresolved, but otherwise ignored. If resolver is not given, the shared
+    HostResolver is used.
+    Returns a NotificationStats object.
+    '''
+
+    if not config:
+        config = Config()
+    batch_size = config.getint("broker", "cdp_batch_size")
+    batch_interval = config.getfloat("broker", "cdp_batch_interval")
+
+    # We need to clean the name, since it might
+    # be namespaced. This (in effect) globalizes
+    # all names. Perhaps we might want to do some
+    # checks based on the namespace. Not for now.
+    hosts = set(obj.rpartition('/')[2] for obj in modified)
+
+    if not resolver:
+        resolver = get_resolver(config)
+
+    stats = NotificationStats()
+    resolved, unresolved, failed = resolver.resolve(hosts, logger=logger)
+    stats.unresolved = len(unresolved)
+    stats.failed = len(failed)
+
+    for idx, batch in enumerate(chunk(sorted(resolved), batch_size)):
+        # Pause before every batch but the first, even if nothing could be
+        # sent so far
+        if idx and batch_interval > 0:
+            time.sleep(batch_interval)
+        packet = NOTIFICATION_TYPES[ntype] + "\0" + str(int(time.time()))
+        for host in batch:
+            try:
+                sock.sendto(packet, (resolved[host], CDPPORT))
+                stats.sent += 1
+            except Exception as e:
+                logger.info("Error notifying %s: %s", host, e)
+                stats.failed += 1
+
+    return stats
+
+
+def trigger_notifications(config, logger=LOGGER, loglevel=logging.INFO,
+                          objects=None):
+    """
+    Ask aq_notifyd to update the index and send out notifications.
+
+    If objects is None, then the whole profilesdir will be rescanned.
+    Otherwise, it should be a list of object names (relative to profilesdir,
+    without an extension) whose profiles have changed, and only the index
+    entries of those objects will be updated.
+    """
+    if objects is None:
+        lines = ["update\n"]
+    else:
+        # Keep the lines well below the maximum line length of aq_notifyd
+        lines = ["update %s\n" % " ".join(names)
+                 for names in chunk(sorted(objects), 100)]
+        if not lines:
+            return
 
-def trigger_notifications(config, logger=LOGGER, loglevel=logging.INFO):
     sockname = os.path.join(config.get("broker", "sockdir"), "notifysock")
     sd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sd.settimeout(1.0)
@@ -281,7 +567,7 @@ def trigger_notifications(config, logger=LOGGER, loglevel=logging.INFO):
         logger.error("Failed to connect to notification socket: %s", err)
 
     try:
-        sd.send("update\n")
+        sd.sendall("".join(lines))
     except socket.error as err:
         logger.error("Failed to send to notification socket: %s", err)
 
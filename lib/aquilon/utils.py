@@ -312,7 +312,12 @@ def write_file(filename, content, mode=None, compress=None,
     dirname, basename = os.path.split(filename)
 
     if not os.path.exists(dirname) and create_directory:
-        os.makedirs(dirname)
+        try:
+            os.makedirs(dirname)
+        except OSError as err:
+            # Someone else may have created it in the meantime
+            if err.errno != errno.EEXIST:
+                raise
 
     fd, fpath = mkstemp(prefix=basename, dir=dirname)
     try:
@@ -20,6 +20,8 @@ import sys
 from inspect import isclass
 from types import NoneType
 
+from six import string_types
+
 from sqlalchemy import event
 from sqlalchemy.sql import text
 from sqlalchemy.exc import DatabaseError
@@ -34,17 +36,24 @@ from aquilon.worker.exporter import Exporter
 from aquilon.worker.authorization import AuthorizationBroker
 from aquilon.worker.messages import StatusCatalog
 from aquilon.worker.logger import RequestLogger
-from aquilon.aqdb.db_factory import DbFactory
-from aquilon.aqdb.model.xtn import start_xtn, end_xtn
+from aquilon.aqdb.db_factory import DbFactory, StatementStats
+from aquilon.aqdb.model.xtn import (start_xtn, end_xtn, xtn_records,
+                                    get_audit_writer)
 from aquilon.worker.formats.formatters import ResponseFormatter
+from aquilon.worker.result_cache import get_result_cache
 from aquilon.worker.dbwrappers.user_principal import (
     get_or_create_user_principal)
 from aquilon.locks import LockKey
-from aquilon.worker.templates.base import Plenary, PlenaryCollection
+from aquilon.notify.index import trigger_notifications
+from aquilon.worker.templates.base import (Plenary, PlenaryCollection,
+                                           pop_removed_profiles)
 from aquilon.worker.templates.domain import TemplateDomain
 from aquilon.worker.services import Chooser
 from aquilon.worker.dbwrappers.branch import sync_domain
 
+# Number of statements to log if a command goes over its statement budget
+_STATEMENT_REPORT_COUNT = 5
+
 # Things we don't need cluttering up the transaction details table
 _IGNORED_AUDIT_ARGS = ('requestid', 'bundle', 'debug', 'session', 'dbuser')
 
@@ -119,6 +128,15 @@ class BrokerCommand(object):
 
     """
 
+    cache_dependencies = None
+    """ DB classes the output of the command depends on.
+
+    If set, and the result cache is enabled, then the formatted output of
+    read-only commands is cached, and it is dropped if an object of one of
+    the listed classes (or their subclasses) is changed.
+
+    """
+
     # Override to indicate whether the command will generally take a
     # lock during execution.
     #
@@ -135,6 +153,13 @@ class BrokerCommand(object):
     # to True if requires_transaction.
     defer_to_thread = True
 
+    # Override to select the scheduler queue used to run the command, one
+    # of "readonly", "lockfree", "plenary" and "compile".
+    #
+    # If set to None (the default), the request_class property will
+    # derive the value from the other flags of the command and cache it.
+    _request_class = None
+
     def __init__(self):
         """ Provides some convenient variables for commands.
 
@@ -161,6 +186,17 @@ class BrokerCommand(object):
         # self.command is set correctly in resources.py after parsing input.xml
         self.command = self.action
 
+        self.audit_statement_stats = \
+            self.config.has_option("database", "audit_statement_stats") and \
+            self.config.getboolean("database", "audit_statement_stats")
+        if self.config.has_option("database", "statement_budget") and \
+           self.config.get("database", "statement_budget").strip():
+            self.statement_budget = self.config.getint("database",
+                                                       "statement_budget")
+        else:
+            self.statement_budget = None
+        self.audit_writer = get_audit_writer(self.dbf.engine)
+
         # Simplify the initialization of common command categories
         if self.action.startswith("show") or \
            self.action.startswith("search") or \
@@ -204,7 +240,12 @@ class BrokerCommand(object):
         rollback_failed = False
         dbuser = None
         session = None
+        replica_session = None
         exporter = None
+        stats = None
+        audit_records = None
+        cache = None
+        cache_key = None
 
         if not self.requires_readonly \
            and self.config.get('broker', 'mode') != 'readwrite':
@@ -251,9 +292,17 @@ class BrokerCommand(object):
                 # We should therefore avoid looking up anything in the DB
                 # before this point which might be used later.
                 status = request.status
-                start_xtn(session, status.requestid, status.user,
-                          status.command, self.requires_readonly,
-                          kwargs, _IGNORED_AUDIT_ARGS)
+                if self.requires_readonly and self.audit_writer:
+                    # The record is written by the audit writer once the
+                    # command completes
+                    audit_records = xtn_records(status.requestid,
+                                                status.user, status.command,
+                                                True, kwargs,
+                                                _IGNORED_AUDIT_ARGS)
+                else:
+                    start_xtn(session, status.requestid, status.user,
+                              status.command, self.requires_readonly,
+                              kwargs, _IGNORED_AUDIT_ARGS)
 
                 dbuser = get_or_create_user_principal(session, user,
                                                       commitoncreate=True,
@@ -263,22 +312,64 @@ class BrokerCommand(object):
                               action=self.action, resource=request.path)
 
                 if self.requires_readonly:
+                    replica_session = self.dbf.replica_session()
+                if replica_session:
+                    # Only the audit record is written to the primary
+                    # database. Copy the user before the commit expires it,
+                    # and give the connection back to the pool while the
+                    # command runs.
+                    dbuser = replica_session.merge(dbuser, load=False)
+                    replica_session.info['exporter'] = exporter
+                    session.commit()
+                    self._set_readonly(replica_session)
+                elif self.requires_readonly:
                     self._set_readonly(session)
                 # begin() is only required if session transactional=False
                 # session.begin()
 
+                if self.audit_statement_stats or \
+                   self.statement_budget is not None:
+                    stats = StatementStats()
+                    stats.start()
+
             if self.requires_plenaries:
                 plenaries = PlenaryCollection(logger=logger)
             else:
                 plenaries = None
 
-            retval = self.render(user=user, dbuser=dbuser, request=request,
-                                 requestid=requestid, logger=logger,
-                                 plenaries=plenaries,
-                                 session=session, **kwargs)
-            if self.requires_format:
-                style = kwargs.get("style", None)
-                retval = self.formatter.format(style, retval, request)
+            if self.cache_dependencies and self.requires_readonly and \
+               self.requires_format:
+                cache = get_result_cache()
+                cache_key = self._result_cache_key(kwargs)
+
+            retval = None
+            if cache and cache_key:
+                retval, generation = cache.lookup(cache_key,
+                                                  self.cache_dependencies)
+
+            if retval is None:
+                retval = self.render(user=user, dbuser=dbuser,
+                                     request=request, requestid=requestid,
+                                     logger=logger, plenaries=plenaries,
+                                     session=replica_session or session,
+                                     **kwargs)
+                if self.requires_format:
+                    style = kwargs.get("style", None)
+                    stream = getattr(request, "response_stream", None)
+                    if stream:
+                        retval = self._stream_result(stream, style, retval,
+                                                     request)
+                    else:
+                        retval = self.formatter.format(style, retval,
+                                                       request)
+                # Streamed results are not kept. Neither are results computed
+                # on the replica, since it may not have seen the commits the
+                # cache was invalidated for yet.
+                if cache and cache_key and not replica_session and \
+                   isinstance(retval, string_types):
+                    cache.store(cache_key, retval, generation)
+            if replica_session:
+                replica_session.commit()
             if session:
                 with exporter:
                     session.commit()
@@ -294,32 +385,117 @@ class BrokerCommand(object):
                     rollback_failed = True
                     raise
                 session.close()
+            if replica_session:
+                replica_session.close()
             if logger:
                 # Knowing which exception class was thrown might be useful
                 logger.info("%s: %s", type(e).__name__, e)
             raise
         finally:
+            if stats:
+                stats.stop()
+                self._report_statement_stats(stats, request, logger)
+
             # Obliterating the scoped_session - next call to session()
             # will create a new one.
+            if replica_session:
+                self.dbf.ReplicaSession.remove()
             if session:
                 # Complete the transaction. We really want to get rid of the
                 # session, even if end_xtn() fails
                 try:
-                    if not rollback_failed:
+                    return_code = get_code_for_error_class(
+                        raising_exception.__class__)
+                    results = getattr(request, '_audit_result', None)
+                    if audit_records:
+                        self.audit_writer.submit(audit_records, return_code,
+                                                 results)
+                    elif not rollback_failed:
                         # If session.rollback() failed for whatever reason,
                         # our best bet is to avoid touching the session
-                        end_xtn(session, requestid,
-                                get_code_for_error_class(
-                                    raising_exception.__class__),
-                                getattr(request, '_audit_result', None))
+                        end_xtn(session, requestid, return_code, results)
                 finally:
                     if self.is_lock_free:
                         self.dbf.NLSession.remove()
                     else:
                         self.dbf.Session.remove()
+
+            # Removed profiles are not restored if the command fails, so
+            # aq_notifyd has to know about them in either case
+            removed_profiles = pop_removed_profiles()
             if logger:
+                if removed_profiles:
+                    trigger_notifications(self.config, logger,
+                                          objects=removed_profiles)
                 self._cleanup_logger(logger)
 
+    def _report_statement_stats(self, stats, request, logger):
+        """Record the SQL statistics, and complain if there were too many."""
+        if self.audit_statement_stats:
+            if not hasattr(request, "_audit_result"):
+                request._audit_result = []
+            request._audit_result.extend(stats.audit_results())
+
+        if logger:
+            logger.debug("Command %s executed %d SQL statements (%d repeated) "
+                         "in %.3fs.", self.command, stats.count,
+                         stats.repeated, stats.total_time)
+
+        budget = self.statement_budget
+        if not logger or budget is None or stats.count <= budget:
+            return
+
+        logger.info("Command %s executed %d SQL statements (%d repeated) "
+                    "in %.3fs, exceeding the budget of %d.", self.command,
+                    stats.count, stats.repeated, stats.total_time, budget)
+        for count, total_time, caller, statement in \
+                stats.worst_offenders(_STATEMENT_REPORT_COUNT):
+            logger.info("  %d executions, %.3fs, first issued from %s: %s",
+                        count, total_time, caller,
+                        " ".join(statement.split())[:200])
+
+    def _stream_result(self, stream, style, result, request):
+        """Format the result, sending it to the client while it is produced.
+
+        Returns the formatted result if it fits into a single chunk, so small
+        responses are still sent with a content-length, and an error can
+        still be reported using the HTTP status. Otherwise the chunks are
+        sent as they are generated, and the stream itself is returned.
+
+        Most commands return a list of objects, which is fully loaded before
+        formatting starts, so only the formatted output is not held in memory.
+        Commands returning a lazy result, like StringAttributeQuery, have the
+        rows loaded from the database while the chunks are sent.
+        """
+        chunk_size = self.config.getint("broker", "stream_chunk_size")
+        chunks = self.formatter.format_stream(style, result, request,
+                                              chunk_size=chunk_size)
+        first = next(chunks, "")
+        for chunk in chunks:
+            if first is not None:
+                stream.write(first)
+                first = None
+            stream.write(chunk)
+        if first is not None:
+            return first
+        return stream
+
+    def _result_cache_key(self, kwargs):
+        """Return the result cache key of the arguments, or None."""
+        args = []
+        for name, value in kwargs.items():
+            if name in _IGNORED_AUDIT_ARGS or value is None:
+                continue
+            if isinstance(value, list):
+                value = tuple(value)
+            args.append((name, value))
+        key = (self.command, tuple(sorted(args)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def _set_readonly(self, session):
         if session.bind.dialect.name == "oracle" or \
            session.bind.dialect.name == "postgresql":
@@ -364,6 +540,30 @@ class BrokerCommand(object):
             self._is_lock_free = self.is_class_lock_free()
         return self._is_lock_free
 
+    @property
+    def request_class(self):
+        if self._request_class is None:
+            if self.requires_readonly:
+                self._request_class = "readonly"
+            elif self.is_lock_free:
+                self._request_class = "lockfree"
+            elif self.is_class_compiling():
+                self._request_class = "compile"
+            else:
+                self._request_class = "plenary"
+        return self._request_class
+
+    @classmethod
+    def is_class_compiling(cls):
+        """ Check if the command (or its superclass) compiles templates """
+        for item in cls.__mro__:
+            if item == BrokerCommand or not issubclass(item, BrokerCommand):
+                continue
+            module = sys.modules.get(item.__module__)
+            if module and TemplateDomain in module.__dict__.values():
+                return True
+        return False
+
     # A set of heuristics is provided as a default that works well
     # enough for most commands to set the _is_lock_free flag used
     # above.
@@ -14,43 +14,63 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Initialize each broker command and make it easy to load by installing
-   an instance of the command as broker_command in the module.
+"""Locate the broker commands, and load them when they are first used.
 
-   This ends up importing everything... any script in this directory
-   will end up being triggered any time any module in this directory is
-   loaded - side effects and all.
+   Every module in this directory implementing a command contains a
+   subclass of BrokerCommand. Importing all of them takes a long time, so
+   __all__ is built from the list of files, and a module is only imported
+   when get_broker_command() is first called for it. The subclass of
+   BrokerCommand is then instantiated and installed as broker_command in the
+   module.
 
-   Once loaded, this iterates through each module, finds the subclass of
-   BrokerCommand and installs it as broker_command.  The module name is
-   then added to __all__.
+   Keep in mind that importing a module also imports everything it depends
+   on - side effects and all.
 
    """
 
 
 import os
+import sys
 import logging
+from threading import RLock
 from traceback import format_exc
 from inspect import isclass
 
 from twisted.python import log
 
 
-__all__ = []
-
 _thisdir = os.path.dirname(os.path.realpath(__file__))
-for f in os.listdir(_thisdir):
-    full = os.path.join(_thisdir, f)
-    if os.path.isfile(full) and f.endswith('.py') and f != '__init__.py':
-        moduleshort = f[:-3]
-        modulename = __name__ + '.' + moduleshort
+
+__all__ = sorted(f[:-3] for f in os.listdir(_thisdir)
+                 if f.endswith('.py') and f != '__init__.py')
+
+_modules = frozenset(__all__)
+_load_lock = RLock()
+
+
+def get_broker_command(moduleshort):
+    """
+    Return the instance of the command implemented by the given module.
+
+    The module is imported if needed. None is returned if the module does not
+    exist, cannot be imported, or does not implement a command.
+    """
+    if moduleshort not in _modules:
+        return None
+    modulename = __name__ + '.' + moduleshort
+
+    with _load_lock:
+        mymodule = sys.modules.get(modulename)
+        if mymodule and hasattr(mymodule, "broker_command"):
+            return mymodule.broker_command
+
         try:
             mymodule = __import__(modulename, fromlist=["BrokerCommand"])
         except Exception as e:  # pragma: no cover
             log.msg("Error importing %s: %s" % (modulename, format_exc()))
-            continue
+            return None
         if not hasattr(mymodule, "BrokerCommand"):  # pragma: no cover
-            continue
+            return None
         # This is just convenient... don't have to import the 'real'
         # BrokerCommand, since any file we care about will have already
         # had to import it.
@@ -66,5 +86,5 @@ for f in os.listdir(_thisdir):
                 mymodule.broker_command = item()
                 mymodule.broker_command.module_logger = \
                     logging.getLogger(modulename)
-                __all__.append(moduleshort)
                 break
+        return getattr(mymodule, "broker_command", None)
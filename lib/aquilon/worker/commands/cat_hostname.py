@@ -16,7 +16,7 @@
 # limitations under the License.
 """Contains the logic for `aq cat --hostname`."""
 
-from aquilon.aqdb.model import ResourceGroup
+from aquilon.aqdb.model import Base, ResourceGroup
 from aquilon.worker.broker import BrokerCommand
 from aquilon.worker.dbwrappers.host import hostname_to_host
 from aquilon.worker.dbwrappers.resources import get_resource
@@ -28,6 +28,10 @@ class CommandCatHostname(BrokerCommand):
 
     required_parameters = ["hostname"]
 
+    # Plenaries are written by the same commands which change the objects
+    # they describe
+    cache_dependencies = (Base,)
+
     # We do not lock the plenary while reading it
     _is_lock_free = True
 
@@ -22,7 +22,8 @@ from aquilon.notify.index import trigger_notifications
 from aquilon.worker.broker import BrokerCommand
 from aquilon.worker.dbwrappers.resources import walk_resources
 from aquilon.worker.dbwrappers.service_instance import check_no_provided_service
-from aquilon.worker.templates import PlenaryServiceInstanceServer
+from aquilon.worker.templates import (PlenaryServiceInstanceServer,
+                                      PlenaryClusterObject)
 
 
 def del_cluster(session, logger, plenaries, dbcluster, config):
@@ -66,13 +67,14 @@ def del_cluster(session, logger, plenaries, dbcluster, config):
 
     del dbcluster.services_used[:]
 
+    profile = PlenaryClusterObject.template_name(dbcluster)
     session.delete(dbcluster)
 
     session.flush()
 
     plenaries.write(remove_profile=True)
 
-    trigger_notifications(config, logger, CLIENT_INFO)
+    trigger_notifications(config, logger, CLIENT_INFO, objects=[profile])
 
     return
 
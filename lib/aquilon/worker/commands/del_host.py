@@ -34,6 +34,7 @@ class CommandDelHost(BrokerCommand):
         # Check dependencies, translate into user-friendly message
         dbhost = hostname_to_host(session, hostname)
         dbmachine = dbhost.hardware_entity
+        profile = str(dbhost.fqdn)
 
         if dbhost.virtual_machines:
             machines = ", ".join(sorted(m.label for m in
@@ -78,6 +79,7 @@ class CommandDelHost(BrokerCommand):
                 logger.client_info("WARNING: removing host %s from AQDB and "
                                    "*not* changing DSDB." % hostname)
 
-        trigger_notifications(self.config, logger, CLIENT_INFO)
+        trigger_notifications(self.config, logger, CLIENT_INFO,
+                              objects=[profile])
 
         return
@@ -17,36 +17,68 @@
 """Contains the logic for `aq flush`."""
 
 from collections import defaultdict
+from functools import partial
 import gc
-from six import iteritems
 
 from sqlalchemy.orm import (joinedload, subqueryload, lazyload, contains_eager,
                             undefer)
 from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import and_
 
-from aquilon.exceptions_ import PartialError, IncompleteError
+from aquilon.exceptions_ import ArgumentError, PartialError, IncompleteError
 from aquilon.aqdb.model import (Service, Machine, Chassis, Host,
                                 PersonalityStage, Archetype, Cluster, City,
                                 Rack, Bunker, Building, Resource, HostResource,
                                 ClusterResource, BundleResource, VirtualMachine,
+                                ResourceHolder,
                                 Filesystem, ServiceAddress, Share, Disk, Model,
                                 Interface, AddressAssignment, Network,
                                 NetworkEnvironment, NetworkCompartment,
                                 ServiceInstance, HardwareEntity, NetworkDevice,
                                 RouterAddress, VirtualSwitch,
-                                PortGroup, ParamDefHolder, Feature)
+                                PortGroup, ParamDefHolder, Feature,
+                                ResourceGroup)
 from aquilon.aqdb.data_sync.storage import StormapParser
 from aquilon.worker.broker import BrokerCommand
-from aquilon.worker.templates.base import Plenary
+from aquilon.worker.templates.base import Plenary, PlenaryWriter
+from aquilon.worker.templates.preload import load_interfaces, preload_objects
 from aquilon.worker.templates.switchdata import PlenarySwitchData
 from aquilon.worker.locks import CompileKey
-from aquilon.utils import ProgressReport
+from aquilon.utils import ProgressReport, chunk
+
+
+def id_windows(session, column, size, *criteria):
+    """
+    Return the values of a primary key column in ascending windows.
+
+    Every window is queried separately, so the list of all IDs does not have
+    to be kept in memory either.
+    """
+    last = None
+    while True:
+        q = session.query(column)
+        if criteria:
+            q = q.filter(*criteria)
+        if last is not None:
+            q = q.filter(column > last)
+        q = q.order_by(column)
+        ids = [row[0] for row in q.limit(size)]
+        if not ids:
+            return
+        last = ids[-1]
+        yield ids
+
+
+def in_filters(column, ids):
+    """Split up IN lists, since Oracle does not accept more than 1000 items."""
+    for ids_chunk in chunk(sorted(ids), 1000):
+        yield column.in_(ids_chunk)
 
 
 class CommandFlush(BrokerCommand):
 
-    def preload_resources(self, session, res_cache, holder_cache, classes=None):
+    def preload_resources(self, session, res_cache, holder_cache, classes=None,
+                          holder_ids=None, ids=None):
         # Load the most common resource types. Using
         # with_polymorphic('*') on Resource would generate a huge query,
         # so do something more targeted.
@@ -69,64 +101,237 @@ class CommandFlush(BrokerCommand):
         if Share in classes:
             parser = StormapParser()
 
-        for cls in classes:
-            q = session.query(cls)
-            q = q.options(joinedload('holder'))
-            if cls in extra_options:
-                q = q.options(*extra_options[cls])
-
-            for res in q:
-                res_cache[res.id] = res
-
-                if res.holder_id not in holder_cache:
-                    holder_cache[res.holder_id] = res.holder
+        # Restrict loading to the given holders or resources if asked
+        if holder_ids is not None:
+            criteria = list(in_filters(Resource.holder_id, holder_ids))
+        elif ids is not None:
+            criteria = list(in_filters(Resource.id, ids))
+        else:
+            criteria = [None]
 
-                if isinstance(res, Share):
-                    res.populate_share_info(parser)
-
-    def preload_interfaces(self, session, hosts, interfaces_by_id,
-                           interfaces_by_hwent):
-        addrs_by_iface = defaultdict(list)
-        slaves_by_id = defaultdict(list)
-
-        # Polymorphic loading cannot be applied to eager-loaded
-        # attributes, so load interfaces manually.
-        q = session.query(Interface)
+        for cls in classes:
+            for criterion in criteria:
+                q = session.query(cls)
+                if criterion is not None:
+                    q = q.filter(criterion)
+                q = q.options(joinedload('holder'))
+                if cls in extra_options:
+                    q = q.options(*extra_options[cls])
+
+                for res in q:
+                    res_cache[res.id] = res
+
+                    if res.holder_id not in holder_cache:
+                        holder_cache[res.holder_id] = res.holder
+
+                    if isinstance(res, Share):
+                        res.populate_share_info(parser)
+
+    def preload_holder_resources(self, session, holder_cls, column, ids,
+                                 res_cache, holder_cache, classes=None):
+        """
+        Load the resources of the given hosts or clusters.
+
+        The contents of resource groups are loaded as well.
+        """
+        holder_ids = set()
+        for criterion in in_filters(column, ids):
+            q = session.query(holder_cls.id).filter(criterion)
+            holder_ids.update(row[0] for row in q)
+
+        while holder_ids:
+            loaded = {}
+            self.preload_resources(session, loaded, holder_cache, classes,
+                                   holder_ids=holder_ids)
+            res_cache.update(loaded)
+
+            rg_ids = [res.id for res in loaded.values()
+                      if isinstance(res, ResourceGroup)]
+            holder_ids = set()
+            for criterion in in_filters(BundleResource.resourcegroup_id,
+                                        rg_ids):
+                q = session.query(BundleResource.id).filter(criterion)
+                holder_ids.update(row[0] for row in q)
+
+    def preload_resholders(self, session, holder_cache, clusters, hosts,
+                           ids=None):
+        # When flushing clusters/hosts, loading the resource holder is done
+        # as the query that loads those objects. But when flushing resources
+        # only, we need the holder and the object it belongs to.
+        if ids is not None:
+            criteria = list(in_filters(ResourceHolder.id, ids))
+        else:
+            criteria = [None]
+
+        for criterion in criteria:
+            if not clusters:
+                q = session.query(ClusterResource)
+                if criterion is not None:
+                    q = q.filter(criterion)
+                # Using joinedload('cluster') would generate an outer join
+                q = q.join(Cluster)
+                q = q.options(contains_eager('cluster'))
+                for resholder in q:
+                    holder_cache[resholder.id] = resholder
+            if not hosts:
+                q = session.query(HostResource)
+                if criterion is not None:
+                    q = q.filter(criterion)
+                # Using joinedload('host') would generate an outer join
+                q = q.join(Host)
+                q = q.options(contains_eager('host'),
+                              joinedload('host.hardware_entity'))
+                for resholder in q:
+                    holder_cache[resholder.id] = resholder
+
+    def flush_machines(self, session, logger, writer, failed, progress,
+                       disks_by_machine, interfaces_by_hwent, criteria=()):
+        q = session.query(Machine)
+        q = q.filter(*criteria)
+        q = q.options(lazyload("primary_name"),
+                      subqueryload("chassis_slot"))
+
+        for machine in q:
+            progress.step()
+
+            set_committed_value(machine, 'disks',
+                                disks_by_machine.get(machine.id, None))
+            set_committed_value(machine, 'interfaces',
+                                interfaces_by_hwent.get(machine.id, None))
+
+            try:
+                plenary_info = Plenary.get_plenary(machine, logger=logger)
+                writer.write(plenary_info)
+            except Exception as e:
+                failed.append("{0} failed: {1}".format(machine, e))
+                continue
+
+    def flush_hosts(self, session, logger, writer, failed, progress,
+                    criteria=()):
+        q = session.query(Host)
+        q = q.filter(*criteria)
+        q = q.options(joinedload("hardware_entity"),
+                      joinedload("hardware_entity.primary_name"),
+                      joinedload("hardware_entity.primary_name.fqdn"))
+        dbhosts = q.all()
+
+        # Use the preloader of the host plenaries, so flush loads the same
+        # data as other commands writing many hosts
+        preload_objects(session, dbhosts)
+
+        for h in dbhosts:
+            progress.step()
+
+            if not h.archetype.is_compileable:
+                continue
+
+            try:
+                plenary_host = Plenary.get_plenary(h, logger=logger)
+                writer.write(plenary_host,
+                             partial("{0} in {1:l}".format, h, h.branch))
+            except IncompleteError as e:
+                pass
+                # logger.client_info("Not flushing host: %s" % e)
+            except Exception as e:
+                failed.append("{0} in {1:l} failed: {2}".format(h, h.branch, e))
+
+    def flush_clusters(self, session, logger, writer, failed, progress,
+                       criteria=()):
+        q = session.query(Cluster)
         q = q.with_polymorphic('*')
-        for iface in q:
-            interfaces_by_hwent[iface.hardware_entity_id].append(iface)
-            interfaces_by_id[iface.id] = iface
-            if iface.master_id:
-                slaves_by_id[iface.master_id].append(iface)
-
-        # subqueryload() and with_polymorphic() do not play nice
-        # together, so do it by hand
-        q = session.query(AddressAssignment)
-        q = q.options(joinedload("network"),
-                      joinedload("dns_records"))
-        q = q.order_by(AddressAssignment.label)
-
-        if hosts:
-            q = q.options(subqueryload("network.static_routes"),
-                          subqueryload("network.routers"))
-
-        for addr in q:
-            addrs_by_iface[addr.interface_id].append(addr)
-
-        for iface_id, iface in iteritems(interfaces_by_id):
-            set_committed_value(iface, "assignments",
-                                addrs_by_iface.get(iface_id, None))
-            set_committed_value(iface, "slaves",
-                                slaves_by_id.get(iface_id, None))
-            set_committed_value(iface, "master",
-                                interfaces_by_id.get(iface.master_id, None))
-            if hasattr(iface, "parent"):
-                set_committed_value(iface, "parent",
-                                    interfaces_by_id.get(iface.parent_id, None))
+        q = q.filter(*criteria)
+        q = q.options(subqueryload('_hosts'),
+                      joinedload('_hosts.host'),
+                      joinedload('_hosts.host.hardware_entity'),
+                      subqueryload('metacluster'),
+                      joinedload('resholder'),
+                      subqueryload('resholder.resources'),
+                      subqueryload('services_used'),
+                      subqueryload('services_provided'),
+                      subqueryload('allowed_personalities'),
+                      subqueryload('virtual_switch'))
+        for clus in q:
+            progress.step()
+            try:
+                plenary = Plenary.get_plenary(clus, logger=logger)
+                writer.write(plenary)
+            except Exception as e:
+                failed.append("{0} failed: {1}".format(clus, e))
+
+    def flush_resources(self, session, logger, writer, failed, progress,
+                        ids):
+        for resid in ids:
+            progress.step()
+            dbresource = session.query(Resource).get(resid)
+            try:
+                plenary = Plenary.get_plenary(dbresource, logger=logger)
+                writer.write(plenary)
+            except Exception as e:
+                failed.append("{0} failed: {1}".format(dbresource, e))
+
+    def flush_machine_window(self, session, logger, writer, failed, progress,
+                             ids):
+        disks_by_machine = defaultdict(list)
+        resource_by_id = {}
+        resholder_by_id = {}
+
+        for criterion in in_filters(Disk.machine_id, ids):
+            q = session.query(Disk)
+            q = q.with_polymorphic('*')
+            q = q.filter(criterion)
+            for disk in q:
+                disks_by_machine[disk.machine_id].append(disk)
+
+        interfaces_by_hwent = load_interfaces(session, ids)
+        self.preload_holder_resources(session, HostResource,
+                                      HostResource.host_id, ids,
+                                      resource_by_id, resholder_by_id,
+                                      [Share, Filesystem])
+
+        self.flush_machines(session, logger, writer, failed, progress,
+                            disks_by_machine, interfaces_by_hwent,
+                            [Machine.hardware_entity_id.between(ids[0],
+                                                                ids[-1])])
+
+    def flush_host_window(self, session, logger, writer, failed, progress,
+                          ids):
+        resource_by_id = {}
+        resholder_by_id = {}
+
+        self.preload_holder_resources(session, HostResource,
+                                      HostResource.host_id, ids,
+                                      resource_by_id, resholder_by_id)
+
+        self.flush_hosts(session, logger, writer, failed, progress,
+                         [Host.hardware_entity_id.between(ids[0], ids[-1])])
+
+    def flush_cluster_window(self, session, logger, writer, failed, progress,
+                             ids):
+        resource_by_id = {}
+        resholder_by_id = {}
+
+        self.preload_holder_resources(session, ClusterResource,
+                                      ClusterResource.cluster_id, ids,
+                                      resource_by_id, resholder_by_id)
+
+        self.flush_clusters(session, logger, writer, failed, progress,
+                            [Cluster.id.between(ids[0], ids[-1])])
+
+    def flush_resource_window(self, session, logger, writer, failed,
+                              progress, ids, clusters, hosts):
+        resource_by_id = {}
+        resholder_by_id = {}
+
+        self.preload_resources(session, resource_by_id, resholder_by_id,
+                               ids=ids)
+        self.preload_resholders(session, resholder_by_id, clusters, hosts,
+                                ids=list(resholder_by_id.keys()))
+
+        self.flush_resources(session, logger, writer, failed, progress, ids)
 
     def render(self, session, logger, services, personalities, machines,
                clusters, hosts, locations, resources, networks, network_devices,
-               virtual_switches, all, **_):
+               virtual_switches, all, threads, window_size, **_):
         if all:
             services = True
             personalities = True
@@ -139,12 +344,15 @@ class CommandFlush(BrokerCommand):
             virtual_switches = True
             networks = True
 
-        with CompileKey(logger=logger):
+        if window_size is not None and window_size < 1:
+            raise ArgumentError("The window size must be a positive integer.")
+
+        with CompileKey(logger=logger), \
+                PlenaryWriter(logger=logger, threads=threads) as writer:
             logger.client_info("Loading data.")
 
             success = []
             failed = []
-            written = 0
 
             # Caches for keeping preloaded data pinned in memory, since the SQLA
             # session holds a weak reference only
@@ -156,27 +364,14 @@ class CommandFlush(BrokerCommand):
 
             # Object caches that are accessed directly
             disks_by_machine = defaultdict(list)
-            interfaces_by_hwent = defaultdict(list)
-            interfaces_by_id = {}
+            interfaces_by_hwent = {}
 
-            # When flushing clusters/hosts, loading the resource holder is done
-            # as the query that loads those objects. But when flushing resources
-            # only, we need the holder and the object it belongs to.
-            if resources and not clusters:
-                q = session.query(ClusterResource)
-                # Using joinedload('cluster') would generate an outer join
-                q = q.join(Cluster)
-                q = q.options(contains_eager('cluster'))
-                for resholder in q:
-                    resholder_by_id[resholder.id] = resholder
-            if resources and not hosts:
-                q = session.query(HostResource)
-                # Using joinedload('host') would generate an outer join
-                q = q.join(Host)
-                q = q.options(contains_eager('host'),
-                              joinedload('host.hardware_entity'))
-                for resholder in q:
-                    resholder_by_id[resholder.id] = resholder
+            # In windowed mode, objects whose number grows with the number of
+            # hosts are only loaded for the window being processed, and then
+            # released before loading the next window
+            if resources and not window_size:
+                self.preload_resholders(session, resholder_by_id, clusters,
+                                        hosts)
 
             if hosts or clusters or resources or machines:
                 # Most machines are in racks...
@@ -188,15 +383,17 @@ class CommandFlush(BrokerCommand):
                 # Loading all models is cheaper than any filtering
                 models = session.query(Model).options(joinedload('vendor')).all()
 
-            if hosts or clusters or resources:
-                self.preload_resources(session, resource_by_id, resholder_by_id)
-            elif machines:
-                self.preload_resources(session, resource_by_id, resholder_by_id,
-                                       [Share, Filesystem])
+            if not window_size:
+                if hosts or clusters or resources:
+                    self.preload_resources(session, resource_by_id,
+                                           resholder_by_id)
+                elif machines:
+                    self.preload_resources(session, resource_by_id,
+                                           resholder_by_id, [Share, Filesystem])
 
-            if hosts or machines:
-                self.preload_interfaces(session, hosts, interfaces_by_id,
-                                        interfaces_by_hwent)
+                # Hosts load their interfaces through the preloader
+                if machines:
+                    interfaces_by_hwent = load_interfaces(session)
 
             if hosts or services:
                 q = session.query(ServiceInstance)
@@ -210,7 +407,7 @@ class CommandFlush(BrokerCommand):
                 for dbloc in q:
                     try:
                         plenary = Plenary.get_plenary(dbloc, logger=logger)
-                        written += plenary._write()
+                        writer.write(plenary)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(dbloc, e))
                         continue
@@ -229,7 +426,7 @@ class CommandFlush(BrokerCommand):
                     try:
                         plenary_info = Plenary.get_plenary(dbservice,
                                                            logger=logger)
-                        written += plenary_info._write()
+                        writer.write(plenary_info)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(dbservice, e))
                         continue
@@ -238,7 +435,7 @@ class CommandFlush(BrokerCommand):
                         try:
                             plenary_info = Plenary.get_plenary(dbinst,
                                                                logger=logger)
-                            written += plenary_info._write()
+                            writer.write(plenary_info)
                         except Exception as e:
                             failed.append("{0} failed: {1}".format(dbinst, e))
                             continue
@@ -274,7 +471,7 @@ class CommandFlush(BrokerCommand):
                     try:
                         plenary_info = Plenary.get_plenary(persst,
                                                            logger=logger)
-                        written += plenary_info._write()
+                        writer.write(plenary_info)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(persst, e))
                         continue
@@ -282,13 +479,6 @@ class CommandFlush(BrokerCommand):
             if machines:
                 logger.client_info("Flushing machines.")
 
-                # Polymorphic loading cannot be applied to eager-loaded
-                # attributes, so load disks manually
-                q = session.query(Disk)
-                q = q.with_polymorphic('*')
-                for disk in q:
-                    disks_by_machine[disk.machine_id].append(disk)
-
                 # Load chassis
                 q = session.query(Chassis)
                 q = q.options(joinedload("primary_name"),
@@ -299,26 +489,28 @@ class CommandFlush(BrokerCommand):
                 q = q.options(subqueryload('legacy_vlan'))
                 port_groups = q.all()  # pylint: disable=W0612
 
-                q = session.query(Machine)
-                q = q.options(lazyload("primary_name"),
-                              subqueryload("chassis_slot"))
-
-                progress = ProgressReport(logger, q.count(), "machine")
-                for machine in q:
-                    progress.step()
-
-                    set_committed_value(machine, 'disks',
-                                        disks_by_machine.get(machine.id, None))
-                    set_committed_value(machine, 'interfaces',
-                                        interfaces_by_hwent.get(machine.id, None))
-
-                    try:
-                        plenary_info = Plenary.get_plenary(machine,
-                                                           logger=logger)
-                        written += plenary_info._write()
-                    except Exception as e:
-                        failed.append("{0} failed: {1}".format(machine, e))
-                        continue
+                progress = ProgressReport(logger, session.query(Machine).count(),
+                                          "machine")
+                if window_size:
+                    for ids in id_windows(session, Machine.hardware_entity_id,
+                                          window_size):
+                        self.flush_machine_window(session, logger, writer,
+                                                  failed, progress, ids)
+                        # The writer holds on to the plenaries, and
+                        # through them to the DB objects of the window
+                        writer.wait()
+                        gc.collect()
+                else:
+                    # Polymorphic loading cannot be applied to eager-loaded
+                    # attributes, so load disks manually
+                    q = session.query(Disk)
+                    q = q.with_polymorphic('*')
+                    for disk in q:
+                        disks_by_machine[disk.machine_id].append(disk)
+
+                    self.flush_machines(session, logger, writer, failed,
+                                        progress, disks_by_machine,
+                                        interfaces_by_hwent)
 
             if hosts:
                 logger.client_info("Flushing hosts.")
@@ -330,79 +522,54 @@ class CommandFlush(BrokerCommand):
                               lazyload("branch"))
                 cluster_cache = q.all()  # pylint: disable=W0612
 
-                q = session.query(Host)
-                q = q.options(joinedload("hardware_entity"),
-                              joinedload("hardware_entity.primary_name"),
-                              joinedload("hardware_entity.primary_name.fqdn"),
-                              subqueryload("grns"),
-                              joinedload("resholder"),
-                              subqueryload("resholder.resources"),
-                              subqueryload("services_used"),
-                              subqueryload("services_provided"),
-                              subqueryload("_cluster"),
-                              subqueryload("personality_stage"),
-                              joinedload("personality_stage.personality"),
-                              subqueryload("personality_stage.grns"),
-                              subqueryload("personality_stage.required_services"),
-                              subqueryload("virtual_switch"))
-
-                progress = ProgressReport(logger, q.count(), "host")
-                for h in q:
-                    progress.step()
-
-                    if not h.archetype.is_compileable:
-                        continue
-
-                    # TODO: this is redundant when machines are flushed as well,
-                    # but should not hurt
-                    set_committed_value(h.hardware_entity, 'interfaces',
-                                        interfaces_by_hwent.get(h.hardware_entity.id, None))
-
-                    try:
-                        plenary_host = Plenary.get_plenary(h, logger=logger)
-                        written += plenary_host._write()
-                    except IncompleteError as e:
-                        pass
-                        # logger.client_info("Not flushing host: %s" % e)
-                    except Exception as e:
-                        failed.append("{0} in {1:l} failed: {2}".format(h, h.branch, e))
+                progress = ProgressReport(logger, session.query(Host).count(),
+                                          "host")
+                if window_size:
+                    for ids in id_windows(session, Host.hardware_entity_id,
+                                          window_size):
+                        self.flush_host_window(session, logger, writer, failed,
+                                               progress, ids)
+                        # The writer holds on to the plenaries, and
+                        # through them to the DB objects of the window
+                        writer.wait()
+                        gc.collect()
+                else:
+                    self.flush_hosts(session, logger, writer, failed, progress)
 
             if clusters:
                 logger.client_info("Flushing clusters.")
-                q = session.query(Cluster)
-                q = q.with_polymorphic('*')
-                q = q.options(subqueryload('_hosts'),
-                              joinedload('_hosts.host'),
-                              joinedload('_hosts.host.hardware_entity'),
-                              subqueryload('metacluster'),
-                              joinedload('resholder'),
-                              subqueryload('resholder.resources'),
-                              subqueryload('services_used'),
-                              subqueryload('services_provided'),
-                              subqueryload('allowed_personalities'),
-                              subqueryload('virtual_switch'))
-                progress = ProgressReport(logger, q.count(), "cluster")
-                for clus in q:
-                    progress.step()
-                    try:
-                        plenary = Plenary.get_plenary(clus, logger=logger)
-                        written += plenary._write()
-                    except Exception as e:
-                        failed.append("{0} failed: {1}".format(clus, e))
+                progress = ProgressReport(logger, session.query(Cluster).count(),
+                                          "cluster")
+                if window_size:
+                    for ids in id_windows(session, Cluster.id, window_size):
+                        self.flush_cluster_window(session, logger, writer,
+                                                  failed, progress, ids)
+                        # The writer holds on to the plenaries, and
+                        # through them to the DB objects of the window
+                        writer.wait()
+                        gc.collect()
+                else:
+                    self.flush_clusters(session, logger, writer, failed,
+                                        progress)
 
             if resources:
                 logger.client_info("Flushing resources.")
 
-                q = session.query(Resource.id)
-                progress = ProgressReport(logger, q.count(), "resource")
-                for resid in q:
-                    progress.step()
-                    dbresource = session.query(Resource).get(resid)
-                    try:
-                        plenary = Plenary.get_plenary(dbresource, logger=logger)
-                        written += plenary._write()
-                    except Exception as e:
-                        failed.append("{0} failed: {1}".format(dbresource, e))
+                progress = ProgressReport(logger, session.query(Resource).count(),
+                                          "resource")
+                if window_size:
+                    for ids in id_windows(session, Resource.id, window_size):
+                        self.flush_resource_window(session, logger, writer,
+                                                   failed, progress, ids,
+                                                   clusters, hosts)
+                        # The writer holds on to the plenaries, and
+                        # through them to the DB objects of the window
+                        writer.wait()
+                        gc.collect()
+                else:
+                    ids = [row[0] for row in session.query(Resource.id)]
+                    self.flush_resources(session, logger, writer, failed,
+                                         progress, ids)
 
             if networks:
                 logger.client_info("Flushing networks.")
@@ -438,7 +605,7 @@ class CommandFlush(BrokerCommand):
                     progress.step()
                     try:
                         plenary = Plenary.get_plenary(dbnetwork, logger=logger)
-                        written += plenary._write()
+                        writer.write(plenary)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(dbnetwork, e))
 
@@ -453,12 +620,12 @@ class CommandFlush(BrokerCommand):
                     progress.step()
                     try:
                         plenary = PlenarySwitchData.get_plenary(dbnetdev, logger=logger)
-                        written += plenary._write()
+                        writer.write(plenary)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(dbnetdev, e))
                     try:
                         plenary = Plenary.get_plenary(dbnetdev, logger=logger)
-                        written += plenary._write()
+                        writer.write(plenary)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(dbnetdev, e))
 
@@ -473,10 +640,14 @@ class CommandFlush(BrokerCommand):
                     progress.step()
                     try:
                         plenary = Plenary.get_plenary(dbvswitch, logger=logger)
-                        written += plenary._write()
+                        writer.write(plenary)
                     except Exception as e:
                         failed.append("{0} failed: {1}".format(dbvswitch, e))
 
+            writer.wait()
+            failed.extend(writer.failed)
+            written = writer.written
+
             # written + len(failed) isn't actually the total that should
             # have been done, but it's the easiest to implement for this
             # count and should be reasonably close... :)
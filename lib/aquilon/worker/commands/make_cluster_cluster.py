@@ -19,7 +19,7 @@
 from aquilon.exceptions_ import ArgumentError
 from aquilon.worker.broker import BrokerCommand
 from aquilon.aqdb.model import Cluster, MetaCluster
-from aquilon.worker.templates import TemplateDomain
+from aquilon.worker.templates import TemplateDomain, preload_objects
 from aquilon.worker.services import Chooser, ChooserCache
 
 
@@ -46,9 +46,12 @@ class CommandMakeClusterCluster(BrokerCommand):
 
         # TODO: this duplicates the logic from reconfigure_list.py; it should be
         # refactored later
+        dbobjs = list(dbcluster.all_objects())
+        preload_objects(session, dbobjs)
+
         chooser_cache = ChooserCache()
         failed = []
-        for dbobj in dbcluster.all_objects():
+        for dbobj in dbobjs:
             chooser = Chooser(dbobj, plenaries, logger=logger,
                               required_only=not keepbindings,
                               cache=chooser_cache)
@@ -19,6 +19,8 @@
 from csv import DictReader, Error as CSVError
 from json import JSONDecoder
 from datetime import datetime
+from functools import partial
+from time import time
 
 from six.moves import cStringIO as StringIO  # pylint: disable=F0401
 
@@ -29,12 +31,11 @@ from aquilon.aqdb.types import MACAddress
 from aquilon.aqdb.model import (NetworkDevice, ObservedMac, PortGroup, Network,
                                 NetworkEnvironment, VlanInfo, Rack)
 from aquilon.worker.broker import BrokerCommand
-from aquilon.worker.dbwrappers.observed_mac import (
-    update_or_create_observed_mac)
+from aquilon.worker.dbwrappers.observed_mac import bulk_update_observed_macs
 from aquilon.worker.dbwrappers.network_device import (determine_helper_hostname,
                                                       determine_helper_args)
 from aquilon.worker.locks import ExternalKey
-from aquilon.worker.processes import run_command
+from aquilon.worker.processes import run_command, run_parallel
 
 
 class CommandPollNetworkDevice(BrokerCommand):
@@ -57,6 +58,15 @@ class CommandPollNetworkDevice(BrokerCommand):
         now = datetime.now()
         failed_vlan = 0
         default_ssh_args = determine_helper_args(self.config)
+        threads = self.config.getint("broker", "poll_threads")
+        if self.config.get("broker", "poll_timeout").strip():
+            timeout = self.config.getint("broker", "poll_timeout")
+        else:
+            timeout = None
+
+        # Collect everything needed to run the discovery tools up front, so
+        # the tools can run in parallel without touching the session
+        tasks = []
         for netdev in netdevs:
             if clear:
                 self.clear(session, netdev)
@@ -69,25 +79,76 @@ class CommandPollNetworkDevice(BrokerCommand):
             else:
                 ssh_args = []
 
-            with ExternalKey("poll_network_device", [netdev], logger=logger):
-                self.poll_mac(session, netdev, now, ssh_args)
-                if vlan:
-                    if netdev.switch_type != "tor":
-                        logger.client_info("Skipping VLAN probing on {0:l}, it's "
-                                           "not a ToR network device.".format(netdev))
-                        continue
+            commands = [self.camtable_args(netdev, ssh_args)]
+            if vlan and netdev.switch_type == "tor" and netdev.primary_ip:
+                commands.append(self.vlan2net_args(netdev, ssh_args))
+
+            key = ExternalKey("poll_network_device", [netdev], logger=logger)
+            tasks.append(partial(self.discover, key, commands, timeout))
+
+        results = run_parallel(tasks, threads)
+
+        # Loading the results into the DB happens serially
+        for netdev, (result, err) in zip(netdevs, results):
+            if err:
+                raise err
+
+            elapsed, outputs = result
+            if isinstance(outputs[0], ProcessException):
+                raise ArgumentError("Failed to run network device discovery: "
+                                    "%s" % outputs[0])
+            self.poll_mac(session, logger, netdev, now, outputs[0], elapsed)
+
+            if vlan:
+                if netdev.switch_type != "tor":
+                    logger.client_info("Skipping VLAN probing on {0:l}, it's "
+                                       "not a ToR network device.".format(netdev))
+                    continue
 
-                    try:
-                        self.poll_vlan(session, logger, netdev, now, ssh_args)
-                    except ProcessException as e:
-                        failed_vlan += 1
-                        logger.client_info("Failed getting VLAN info for {0:l}: "
-                                           "{1!s}".format(netdev, e))
+                try:
+                    self.poll_vlan(session, logger, netdev, now, outputs[1:])
+                except ProcessException as e:
+                    failed_vlan += 1
+                    logger.client_info("Failed getting VLAN info for {0:l}: "
+                                       "{1!s}".format(netdev, e))
         if netdevs and failed_vlan == len(netdevs):
             raise ArgumentError("Failed getting VLAN info.")
         return
 
-    def poll_mac(self, session, netdev, now, ssh_args):
+    @staticmethod
+    def discover(key, commands, timeout):
+        """
+        Run the discovery tools of a network device.
+
+        This is called from a worker thread. Returns the time it took to run
+        the commands, and the list of their outputs. If a command failed, its
+        output is replaced by the ProcessException it raised.
+
+        The timeout applies to all the commands together: a command is given
+        only the time left by the commands run before it.
+        """
+        outputs = []
+        with key:
+            start = time()
+            for args in commands:
+                if timeout:
+                    remaining = start + timeout - time()
+                    if remaining <= 0:
+                        outputs.append(ProcessException(
+                            command=" ".join(args),
+                            err="Discovery did not finish in %d seconds." %
+                            timeout))
+                        continue
+                else:
+                    remaining = None
+
+                try:
+                    outputs.append(run_command(args, timeout=remaining))
+                except ProcessException as err:
+                    outputs.append(err)
+        return time() - start, outputs
+
+    def camtable_args(self, netdev, ssh_args):
         importer = self.config.lookup_tool("get-camtable")
 
         if not netdev.primary_name:
@@ -103,41 +164,50 @@ class CommandPollNetworkDevice(BrokerCommand):
         # TODO debug options shows CheckNet fails to return data and not
         # get-camtable
         args.extend([importer, "--debug", hostname])
+        return args
 
-        try:
-            out = run_command(args)
-        except ProcessException as err:
-            raise ArgumentError("Failed to run network device discovery: %s" % err)
+    def vlan2net_args(self, netdev, ssh_args):
+        args = []
+        if ssh_args:
+            args.extend(ssh_args)
+        args.append(self.config.lookup_tool("vlan2net"))
+        args.append("-ip")
+        args.append(netdev.primary_ip)
+        return args
 
+    def poll_mac(self, session, logger, netdev, now, out, discovery_time):
+        start = time()
         macports = JSONDecoder().decode(out)
         validate_json(self.config, macports, "discovered_macs",
                       "discovered MACs")
-        for (mac, port) in macports:
-            update_or_create_observed_mac(session, netdev, port,
-                                          MACAddress(mac), now)
+        created, updated = bulk_update_observed_macs(
+            session, netdev, [(MACAddress(mac), port) for mac, port in macports],
+            now)
+
+        logger.client_info("Polled {0:l}: {1:d} MAC entries, {2:d} new, "
+                           "{3:d} updated; discovery took {4:.2f}s, updating "
+                           "the database took {5:.2f}s."
+                           .format(netdev, len(macports), created, updated,
+                                   discovery_time, time() - start))
 
     def clear(self, session, netdev):
         session.query(ObservedMac).filter_by(network_device=netdev).delete()
         session.flush()
 
-    def poll_vlan(self, session, logger, netdev, now, ssh_args):
+    def poll_vlan(self, session, logger, netdev, now, outputs):
         if not netdev.primary_ip:
             raise ArgumentError("Cannot poll VLAN info for {0:l} without "
                                 "a registered IP address.".format(netdev))
+        out = outputs[0]
+        if isinstance(out, ProcessException):
+            raise out
+
         del netdev.port_groups[:]
         session.flush()
 
         # Restrict operations to the internal network
         dbnet_env = NetworkEnvironment.get_unique_or_default(session)
 
-        args = []
-        if ssh_args:
-            args.extend(ssh_args)
-        args.append(self.config.lookup_tool("vlan2net"))
-        args.append("-ip")
-        args.append(netdev.primary_ip)
-        out = run_command(args)
-
         try:
             reader = DictReader(StringIO(out))
             for row in reader:
@@ -26,10 +26,9 @@ from aquilon.aqdb.model import (Archetype, Personality, OperatingSystem,
 from aquilon.worker.broker import BrokerCommand
 from aquilon.worker.dbwrappers.grn import lookup_grn
 from aquilon.worker.dbwrappers.host import (hostlist_to_hosts,
-                                            preload_machine_data,
                                             check_hostlist_size,
                                             validate_branch_author)
-from aquilon.worker.templates import TemplateDomain, PlenaryHost
+from aquilon.worker.templates import TemplateDomain, preload_objects
 from aquilon.worker.services import Chooser, ChooserCache
 
 
@@ -79,9 +78,8 @@ class CommandReconfigureList(BrokerCommand):
                    subqueryload('personality_stage.grns'),
                    undefer('services_used._client_count'),
                    subqueryload('_cluster.cluster')]
-        options += PlenaryHost.query_options()
         dbhosts = hostlist_to_hosts(session, list, options)
-        preload_machine_data(session, dbhosts)
+        preload_objects(session, dbhosts)
         return dbhosts
 
     def render(self, session, logger, plenaries, archetype, personality, personality_stage, keepbindings,
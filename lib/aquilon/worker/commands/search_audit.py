@@ -25,8 +25,9 @@ from aquilon.exceptions_ import ArgumentError
 from aquilon.aqdb.model import Xtn, XtnDetail, XtnEnd
 from aquilon.worker.broker import BrokerCommand
 
-_IGNORED_COMMANDS = ('show_active_locks', 'show_active_commands', 'cat',
-                     'search_audit')
+_IGNORED_COMMANDS = ('show_active_locks', 'show_active_commands',
+                     'show_lock_stats', 'show_result_cache_stats',
+                     'show_scheduler_stats', 'cat', 'search_audit')
 
 
 class CommandSearchAudit(BrokerCommand):
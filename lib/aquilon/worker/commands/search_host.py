@@ -21,7 +21,7 @@ from sqlalchemy.orm import (aliased, contains_eager, joinedload, subqueryload,
 from sqlalchemy.sql import and_, or_, null
 
 from aquilon.exceptions_ import NotFoundException
-from aquilon.aqdb.model import (Host, Cluster, Archetype, Personality,
+from aquilon.aqdb.model import (Base, Host, Cluster, Archetype, Personality,
                                 PersonalityStage, PersonalityGrnMap,
                                 HostGrnMap, HostLifecycle, OperatingSystem,
                                 ServiceInstance, ServiceInstanceServer, Share,
@@ -32,18 +32,20 @@ from aquilon.aqdb.model import (Host, Cluster, Archetype, Personality,
                                 HostEnvironment, User, Branch)
 from aquilon.aqdb.model.dns_domain import parse_fqdn
 from aquilon.worker.broker import BrokerCommand
-from aquilon.worker.formats.list import StringAttributeList
+from aquilon.worker.formats.list import StringAttributeQuery
 from aquilon.worker.dbwrappers.branch import get_branch_and_author
 from aquilon.worker.dbwrappers.grn import lookup_grn
-from aquilon.worker.dbwrappers.host import preload_machine_data
 from aquilon.worker.dbwrappers.location import get_location
 from aquilon.worker.dbwrappers.network import get_network_byip
+from aquilon.worker.templates.preload import preload_machine_data
 
 
 class CommandSearchHost(BrokerCommand):
 
     required_parameters = []
 
+    cache_dependencies = (Base,)
+
     def render(self, session, logger, hostname, machine, archetype, buildstatus,
                personality, personality_stage, host_environment, osname, osversion,
                service, instance, model, machine_type, vendor, serial, cluster,
@@ -325,7 +327,10 @@ class CommandSearchHost(BrokerCommand):
                           joinedload('hardware_entity.location'),
                           subqueryload('hardware_entity.location.parents'))
             dbhosts = q.all()
-            preload_machine_data(session, dbhosts)
+            preload_machine_data(session, [dbhost.hardware_entity
+                                           for dbhost in dbhosts])
             return dbhosts
 
-        return StringAttributeList(q.all(), "fqdn")
+        # The query is ordered by the primary name, so duplicates caused by
+        # the joins are next to each other
+        return StringAttributeQuery(q, "fqdn")
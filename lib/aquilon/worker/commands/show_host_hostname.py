@@ -18,6 +18,7 @@
 
 from sqlalchemy.orm import undefer, joinedload
 
+from aquilon.aqdb.model import Base
 from aquilon.worker.broker import BrokerCommand
 from aquilon.worker.dbwrappers.host import hostname_to_host
 
@@ -26,6 +27,8 @@ class CommandShowHostHostname(BrokerCommand):
 
     required_parameters = ["hostname"]
 
+    cache_dependencies = (Base,)
+
     def render(self, session, hostname, **_):
         # hostname_to_host() runs a query for HardwareEntity, so options should
         # be relative to that
@@ -19,8 +19,8 @@
 from sqlalchemy.orm import joinedload, subqueryload, undefer
 
 from aquilon.worker.broker import BrokerCommand
-from aquilon.worker.dbwrappers.host import (hostlist_to_hosts,
-                                            preload_machine_data)
+from aquilon.worker.dbwrappers.host import hostlist_to_hosts
+from aquilon.worker.templates.preload import preload_machine_data
 
 
 class CommandShowHostList(BrokerCommand):
@@ -46,6 +46,7 @@ class CommandShowHostList(BrokerCommand):
                    joinedload('hardware_entity.location'),
                    subqueryload('hardware_entity.location.parents')]
         dbhosts = hostlist_to_hosts(session, list, options)
-        preload_machine_data(session, dbhosts)
+        preload_machine_data(session, [dbhost.hardware_entity
+                                       for dbhost in dbhosts])
 
         return dbhosts
@@ -18,7 +18,8 @@
 
 from sqlalchemy.orm import joinedload, subqueryload, contains_eager
 
-from aquilon.aqdb.model import Archetype, Personality, PersonalityStage
+from aquilon.aqdb.model import (Base, Archetype, Personality,
+                                PersonalityStage)
 from aquilon.worker.broker import BrokerCommand
 
 
@@ -26,6 +27,8 @@ class CommandShowPersonality(BrokerCommand):
 
     required_parameters = []
 
+    cache_dependencies = (Base,)
+
     def render(self, session, personality, personality_stage, archetype, **_):
         if archetype:
             dbarchetype = Archetype.get_unique(session, archetype, compel=True)
@@ -0,0 +1,33 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Contains the logic for `aq show result cache stats`."""
+
+from aquilon.worker.broker import BrokerCommand
+from aquilon.worker.result_cache import get_result_cache, ResultCacheStats
+
+
+class CommandShowResultCacheStats(BrokerCommand):
+
+    requires_transaction = False
+    defer_to_thread = False
+    _is_lock_free = True
+
+    def render(self, **_):
+        cache = get_result_cache()
+        if not cache:
+            return ResultCacheStats(False)
+        return cache.stats()
@@ -0,0 +1,31 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Contains the logic for `aq show scheduler stats`."""
+
+from aquilon.worker.broker import BrokerCommand
+from aquilon.worker.scheduler import request_scheduler
+
+
+class CommandShowSchedulerStats(BrokerCommand):
+
+    requires_transaction = False
+    # The queues may only be looked at from the reactor thread
+    defer_to_thread = False
+    _is_lock_free = True
+
+    def render(self, **_):
+        return request_scheduler.stats()
@@ -18,13 +18,15 @@
 
 from sqlalchemy.orm import joinedload, subqueryload, undefer, contains_eager
 
-from aquilon.aqdb.model import Service, ServiceInstance
+from aquilon.aqdb.model import Base, Service, ServiceInstance
 from aquilon.worker.broker import BrokerCommand
 from aquilon.worker.dbwrappers.host import hostname_to_host
 
 
 class CommandShowService(BrokerCommand):
 
+    cache_dependencies = (Base,)
+
     def render(self, session, service, instance, server, client, **arguments):
         if service:
             if not client and not server and not instance:
@@ -18,12 +18,14 @@
 
 from sqlalchemy.orm import joinedload, subqueryload, undefer, contains_eager
 
-from aquilon.aqdb.model import Service, ServiceInstance
+from aquilon.aqdb.model import Base, Service, ServiceInstance
 from aquilon.worker.broker import BrokerCommand
 
 
 class CommandShowServiceAll(BrokerCommand):
 
+    cache_dependencies = (Base,)
+
     def render(self, session, all, **_):
         # Try to load as much as we can as bulk queries since loading the
         # objects one by one is much more expensive
@@ -26,7 +26,7 @@ from aquilon.worker.dbwrappers.location import get_location
 from aquilon.worker.dbwrappers.hardware_entity import (update_primary_ip,
                                                        rename_hardware)
 from aquilon.worker.dbwrappers.observed_mac import (
-    update_or_create_observed_mac)
+    bulk_update_observed_macs)
 from aquilon.worker.dbwrappers.network_device import discover_network_device
 from aquilon.worker.processes import DSDBRunner
 from aquilon.worker.templates import PlenarySwitchData
@@ -97,9 +97,10 @@ class CommandUpdateNetworkDevice(BrokerCommand):
                           "discovered MACs")
 
             now = datetime.now()
-            for (macaddr, port) in discovered_macs:
-                update_or_create_observed_mac(session, dbnetdev, port,
-                                              MACAddress(macaddr), now)
+            bulk_update_observed_macs(session, dbnetdev,
+                                      [(MACAddress(macaddr), port)
+                                       for macaddr, port in discovered_macs],
+                                      now)
 
         session.flush()
 
@@ -35,6 +35,7 @@ from aquilon.worker.dbwrappers.user_principal import get_user_principal
 from aquilon.worker.processes import run_git, GitRepo
 from aquilon.worker.locks import CompileKey
 from aquilon.worker.templates.domain import TemplateDomain
+from aquilon.worker.templates.manifest import drop_manifests
 
 VERSION_RE = re.compile(r'^[-_.a-zA-Z0-9]*$')
 
@@ -163,6 +164,7 @@ def remove_branch(logger, dbbranch, dbauthor=None):
     with CompileKey(domain=dbbranch.name, logger=logger):
         for dir in domain.directories():
             remove_dir(dir, logger=logger)
+            drop_manifests(dir)
 
     kingrepo = GitRepo.template_king(logger)
     hash = kingrepo.ref_commit("refs/heads/" + dbbranch.name, compel=False)
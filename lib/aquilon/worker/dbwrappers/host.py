@@ -17,7 +17,6 @@
 """Wrappers to make getting and using hosts simpler."""
 
 from collections import defaultdict, Counter
-from types import ListType
 
 from six import itervalues
 
@@ -30,8 +29,7 @@ from aquilon.aqdb.column_types import AqStr
 from aquilon.aqdb.model import (HardwareEntity, DnsEnvironment, DnsDomain, Fqdn,
                                 DnsRecord, ARecord, ReservedName, Sandbox, Host,
                                 HostGrnMap, OperatingSystem, HostLifecycle,
-                                Personality, Domain, Machine, NetworkDevice,
-                                Disk, ChassisSlot, VirtualMachine)
+                                Personality, Domain, Machine, NetworkDevice)
 from aquilon.aqdb.model.dns_domain import parse_fqdn
 from aquilon.aqdb.model.feature import hardware_features, host_features
 from aquilon.worker.dbwrappers.branch import get_branch_and_author
@@ -264,60 +262,6 @@ def hostlist_to_hosts(session, hostlist, query_options=None,
     return dbhosts
 
 
-def preload_machine_data(session, dbhosts):
-    hw_by_id = {dbhost.hardware_entity.id: dbhost.hardware_entity
-                for dbhost in dbhosts}
-
-    # Not all hosts are bound to machines, so load the machine-specific
-    # attributes separately
-    machines = [dbhost.hardware_entity.id for dbhost in dbhosts if
-                dbhost.hardware_entity.model.model_type.isMachineType()]
-    for machine_chunk in chunk(machines, 1000):
-        disks_by_hw = defaultdict(ListType)
-        q = session.query(Disk)
-        q = q.options(undefer('comments'))
-        q = q.filter(Disk.machine_id.in_(machine_chunk))
-        for dbdisk in q:
-            dbhw = hw_by_id[dbdisk.machine_id]
-            set_committed_value(dbdisk, "machine", dbhw)
-            disks_by_hw[dbdisk.machine_id].append(dbdisk)
-
-        for hw_id in machine_chunk:
-            dbhw = hw_by_id[hw_id]
-            if hw_id in disks_by_hw:
-                set_committed_value(dbhw, "disks", disks_by_hw[hw_id])
-            else:
-                set_committed_value(dbhw, "disks", [])
-
-        slots_by_hw = defaultdict(ListType)
-        q = session.query(ChassisSlot)
-        q = q.filter(ChassisSlot.machine_id.in_(machine_chunk))
-        for dbslot in q:
-            dbhw = hw_by_id[dbslot.machine_id]
-            set_committed_value(dbslot, "machine", dbhw)
-            slots_by_hw[dbslot.machine_id].append(dbslot)
-
-        for hw_id in machine_chunk:
-            dbhw = hw_by_id[hw_id]
-            if hw_id in slots_by_hw:
-                set_committed_value(dbhw, "chassis_slot", slots_by_hw[hw_id])
-            else:
-                set_committed_value(dbhw, "chassis_slot", [])
-
-        vms = set()
-        q = session.query(VirtualMachine)
-        q = q.filter(VirtualMachine.machine_id.in_(machine_chunk))
-        for vm in q:
-            dbhw = hw_by_id[vm.machine_id]
-            set_committed_value(vm, "machine", dbhw)
-            set_committed_value(dbhw, "vm_container", vm)
-            vms.add(vm.machine_id)
-
-        for hw_id in set(machine_chunk) - vms:
-            dbhw = hw_by_id[hw_id]
-            set_committed_value(dbhw, "vm_container", None)
-
-
 def check_hostlist_size(command, config, hostlist):
 
     if not hostlist:
@@ -20,24 +20,25 @@ To an extent, this has become a dumping ground for any common ip methods.
 
 """
 
+from bisect import bisect_right
 from operator import attrgetter
 import re
 
 from ipaddr import IPv4Address
 
-from sqlalchemy.orm import aliased, object_session
-from sqlalchemy.sql.expression import desc, type_coerce
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql.expression import desc
 
 from aquilon.exceptions_ import ArgumentError, InternalError, AquilonError
 from aquilon.config import Config
 from aquilon.aqdb.types import NicType, MACAddress
-from aquilon.aqdb.column_types import AqMac
 from aquilon.aqdb.model import (Interface, ManagementInterface, ObservedMac,
                                 Fqdn, ARecord, VlanInfo, AddressAssignment,
                                 SharedAddressAssignment,
                                 Model, Bunker, Location, HardwareEntity,
                                 Network, Host)
 from aquilon.aqdb.model.network import get_net_id_from_ip
+from aquilon.aqdb.utils.transaction import set_transaction_info
 from aquilon.utils import first_of
 
 
@@ -116,6 +117,132 @@ def get_vm_pg_allocator(dbmachine):
         return get_cluster_pg_allocator(holder)
 
 
+class FreeRanges(object):
+    """
+    Free addresses, stored as a sorted list of intervals.
+
+    Addresses (IP or MAC) are handled as integers. The intervals are half-open, i.e.
+    self.ends[i] is the first address after the i-th free range. Looking up
+    and allocating an address takes logarithmic time in the number of free
+    ranges, instead of being proportional to the size of the address range.
+    """
+
+    def __init__(self, start, end, used):
+        self.starts = []
+        self.ends = []
+        self.max_used = None
+
+        pos = start
+        for addr in sorted(set(used)):
+            if addr < start or addr >= end:
+                continue
+            if addr > pos:
+                self.starts.append(pos)
+                self.ends.append(addr)
+            pos = addr + 1
+            self.max_used = addr
+        if pos < end:
+            self.starts.append(pos)
+            self.ends.append(end)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, addr):
+        idx = bisect_right(self.starts, addr) - 1
+        return idx >= 0 and addr < self.ends[idx]
+
+    def lowest(self):
+        return self.starts[0]
+
+    def highest(self):
+        return self.ends[-1] - 1
+
+    def remove(self, addr):
+        idx = bisect_right(self.starts, addr) - 1
+        if idx < 0 or addr >= self.ends[idx]:  # pragma: no cover
+            raise InternalError("Address %d is not free." % addr)
+
+        start, end = self.starts[idx], self.ends[idx]
+        if end - start == 1:
+            del self.starts[idx]
+            del self.ends[idx]
+        elif addr == start:
+            self.starts[idx] = addr + 1
+        elif addr == end - 1:
+            self.ends[idx] = addr
+        else:
+            self.ends[idx] = addr
+            self.starts.insert(idx + 1, addr + 1)
+            self.ends.insert(idx + 1, end)
+
+        if self.max_used is None or addr > self.max_used:
+            self.max_used = addr
+
+
+def get_free_ip_ranges(session, dbnetwork):
+    """
+    Return the free addresses of the network.
+
+    The caller must hold the row lock of the network, otherwise concurrent
+    allocations may pick the same address.
+    """
+    startip = dbnetwork.first_usable_host
+
+    q = session.query(ARecord.ip)
+    q = q.filter_by(network=dbnetwork)
+    q = q.filter(ARecord.ip >= startip)
+
+    return FreeRanges(int(startip), int(dbnetwork.broadcast),
+                      (int(item.ip) for item in q))
+
+
+def allocate_ip(session, dbnetwork, ipalgorithm=None):
+    """
+    Pick an unused address from the network.
+
+    The address is not used by anything when this function returns, so the
+    caller has to create the DNS record before committing. The network is
+    locked until the end of the transaction.
+    """
+    # When there are e.g. multiple "add manager --autoip" operations going on in
+    # parallel, we must ensure that they won't try to use the same IP address.
+    # This query places a database lock on the network, which means IP address
+    # generation within a network will be serialized, while operations on
+    # different networks can still run in parallel. The lock will be released by
+    # COMMIT or ROLLBACK.
+    dbnetwork.lock_row()
+
+    free_ranges = get_free_ip_ranges(session, dbnetwork)
+    if not free_ranges:
+        raise ArgumentError("No available IP addresses found on "
+                            "network %s." % str(dbnetwork.network))
+
+    if ipalgorithm is None or ipalgorithm == 'lowest':
+        # Select the lowest available address
+        addr = free_ranges.lowest()
+    elif ipalgorithm == 'highest':
+        # Select the highest available address
+        addr = free_ranges.highest()
+    elif ipalgorithm == 'max':
+        # Return the max. used address + 1
+        if free_ranges.max_used is None:
+            addr = free_ranges.lowest()
+        else:
+            addr = free_ranges.max_used + 1
+            if addr not in free_ranges:
+                raise ArgumentError("Failed to find an IP that is "
+                                    "suitable for --ipalgorithm=max.  "
+                                    "Try an other algorithm as there are "
+                                    "still some free addresses.")
+    else:
+        raise ArgumentError("Unknown algorithm %s." % ipalgorithm)
+
+    return IPv4Address(addr)
+
+
 def generate_ip(session, logger, dbinterface, ip=None, ipfromip=None,
                 ipfromsystem=None, autoip=None, ipalgorithm=None, compel=False,
                 network_environment=None, audit_results=None, **_):
@@ -193,49 +320,7 @@ def generate_ip(session, logger, dbinterface, ip=None, ipfromip=None,
         raise ArgumentError("Could not determine network to use for %s." %
                             dbinterface)
 
-    # When there are e.g. multiple "add manager --autoip" operations going on in
-    # parallel, we must ensure that they won't try to use the same IP address.
-    # This query places a database lock on the network, which means IP address
-    # generation within a network will be serialized, while operations on
-    # different networks can still run in parallel. The lock will be released by
-    # COMMIT or ROLLBACK.
-    dbnetwork.lock_row()
-
-    startip = dbnetwork.first_usable_host
-
-    used_ips = session.query(ARecord.ip)
-    used_ips = used_ips.filter_by(network=dbnetwork)
-    used_ips = used_ips.filter(ARecord.ip >= startip)
-
-    full_set = set(range(int(startip), int(dbnetwork.broadcast)))
-    used_set = set(int(item.ip) for item in used_ips)
-    free_set = full_set - used_set
-
-    if not free_set:
-        raise ArgumentError("No available IP addresses found on "
-                            "network %s." % str(dbnetwork.network))
-
-    if ipalgorithm is None or ipalgorithm == 'lowest':
-        # Select the lowest available address
-        ip = IPv4Address(min(free_set))
-    elif ipalgorithm == 'highest':
-        # Select the highest available address
-        ip = IPv4Address(max(free_set))
-    elif ipalgorithm == 'max':
-        # Return the max. used address + 1
-        if not used_set:
-            # Avoids ValueError being thrown when used_set is empty
-            ip = IPv4Address(min(free_set))
-        else:
-            next = max(used_set)
-            if not next + 1 in free_set:
-                raise ArgumentError("Failed to find an IP that is suitable "
-                                    "for --ipalgorithm=max.  Try an other "
-                                    "algorithm as there are still some free "
-                                    "addresses.")
-            ip = IPv4Address(next + 1)
-    else:
-        raise ArgumentError("Unknown algorithm %s." % ipalgorithm)
+    ip = allocate_ip(session, dbnetwork, ipalgorithm=ipalgorithm)
 
     if audit_results is not None:
         if dbinterface:
@@ -685,25 +770,44 @@ def get_interfaces(dbhw_ent, interfaces, dbnetwork=None):
     return dbifaces
 
 
-def generate_mac(session, config, dbmachine):
-    """ Generate a mac address for virtual hardware.
+def _get_free_macs(session, mac_start, mac_end):
+    # The index is kept for the rest of the transaction, so allocating MACs
+    # for many interfaces does not have to scan the interface table again.
+    # The lock goes away at the end of the transaction, and so must the index.
+    cache_key = ("free_macs", mac_start.value, mac_end.value)
+    if cache_key in session.info:
+        return session.info[cache_key]
+
+    q = session.query(Interface.mac)
+    q = q.filter(Interface.mac.between(mac_start, mac_end))
+
+    # Prevent concurrent --automac invocations. We need a separate query for
+    # the FOR UPDATE, because a blocked query won't see the value inserted
+    # by the blocking query.
+    session.execute(q.with_lockmode("update"))
+
+    free_macs = FreeRanges(mac_start.value, mac_end.value + 1,
+                           (row.mac.value for row in q))
+    set_transaction_info(session, cache_key, free_macs)
+    return free_macs
+
+
+def allocate_macs(session, config, count=1):
+    """ Generate MAC addresses for virtual hardware.
 
     Algorithm:
 
-    * Query for first mac address in aqdb starting with vendor prefix,
-      order by mac descending.
-    * If no address, or address less than prefix start, use prefix start.
-    * If the found address is not suffix end, increment by one and use it.
-    * If the address is suffix end, requery for the full list and scan
-      through for holes. Use the first hole.
-    * If no holes, error. [In this case, we're still not completely dead
-      in the water - the mac address would just need to be given manually.]
+    * Load the MAC addresses in use between auto_mac_start and auto_mac_end,
+      and turn them into a list of free ranges. This is done once per
+      transaction.
+    * If the highest address in use is not the end of the range, use the
+      next one.
+    * Otherwise, use the lowest free address.
+    * If there are no free addresses left, error. [In this case, we're still
+      not completely dead in the water - the mac address would just need to
+      be given manually.]
 
     """
-    if not dbmachine.vm_container:
-        raise ArgumentError("Can only automatically generate MAC "
-                            "addresses for virtual hardware.")
-
     try:
         mac_start = MACAddress(config.get("broker", "auto_mac_start"))
     except ValueError:  # pragma: no cover
@@ -715,36 +819,37 @@ def generate_mac(session, config, dbmachine):
         raise AquilonError("The value of auto_mac_end in the [broker] "
                            "section is not a valid MAC address.")
 
-    q = session.query(Interface.mac)
-    q = q.filter(Interface.mac.between(mac_start, mac_end))
-    q = q.order_by(desc(Interface.mac))
+    free_macs = _get_free_macs(session, mac_start, mac_end)
 
-    # Prevent concurrent --automac invocations. We need a separate query for
-    # the FOR UPDATE, because a blocked query won't see the value inserted
-    # by the blocking query.
-    session.execute(q.with_lockmode("update"))
+    macs = []
+    while len(macs) < count:
+        if not free_macs:
+            raise ArgumentError("All MAC addresses between %s and %s "
+                                "inclusive are currently in use." %
+                                (mac_start, mac_end))
+
+        if free_macs.max_used is not None and \
+           free_macs.max_used < mac_end.value:
+            value = free_macs.max_used + 1
+        else:
+            value = free_macs.lowest()
+        free_macs.remove(value)
+
+        # The index does not know about MACs which were assigned explicitly
+        # since it was built
+        mac = MACAddress(value=value)
+        q = session.query(Interface.id)
+        q = q.filter_by(mac=mac)
+        if not q.first():
+            macs.append(mac)
+
+    return macs
+
+
+def generate_mac(session, config, dbmachine):
+    """ Generate a mac address for virtual hardware. """
+    if not dbmachine.vm_container:
+        raise ArgumentError("Can only automatically generate MAC "
+                            "addresses for virtual hardware.")
 
-    row = q.first()
-    if not row:
-        return mac_start
-    highest_mac = row.mac
-    if highest_mac < mac_start:
-        return mac_start
-    if highest_mac < mac_end:
-        return highest_mac + 1
-
-    Iface2 = aliased(Interface)
-    q1 = session.query(Iface2.mac)
-    q1 = q1.filter(Iface2.mac == Interface.mac + 1)
-
-    q2 = session.query(type_coerce(Interface.mac + 1, AqMac()).label("mac"))
-    q2 = q2.filter(Interface.mac.between(mac_start, mac_end - 1))
-    q2 = q2.filter(~q1.exists())
-    q2 = q2.order_by(Interface.mac)
-
-    hole = q2.first()
-    if hole:
-        return hole.mac
-
-    raise ArgumentError("All MAC addresses between %s and %s inclusive "
-                        "are currently in use." % (mac_start, mac_end))
+    return allocate_macs(session, config)[0]
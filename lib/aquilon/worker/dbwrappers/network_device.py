@@ -30,7 +30,7 @@ from aquilon.exceptions_ import (InternalError, NotFoundException,
 from aquilon.aqdb.model import (Service, ServiceMap, NetworkEnvironment,
                                 AddressAssignment, ARecord, Model,
                                 RouterAddress)
-from aquilon.aqdb.model.network import get_net_id_from_ip
+from aquilon.aqdb.model.network import get_net_id_from_ip, get_nets_from_ips
 from aquilon.worker.processes import run_command
 from aquilon.worker.dbwrappers.dns import delete_dns_record, grab_address
 from aquilon.worker.dbwrappers.interface import (get_or_create_interface,
@@ -266,17 +266,23 @@ def discover_network_device(session, logger, config, dbnetdev, dryrun):
 
     primary_ip = dbnetdev.primary_name.ip
 
+    # Resolve all the networks in one go
+    nets_by_ip = get_nets_from_ips(session,
+                                   [IPv4Address(ipstr)
+                                    for params in data["interfaces"].values()
+                                    for ipstr in params["ip"]],
+                                   dbnet_env)
+
     # Build a lookup table of discovered IP addresses
     ip_to_iface = {}
     networks = []
     for ifname, params in data["interfaces"].items():
         for ipstr, label in params["ip"].items():
             ip = IPv4Address(ipstr)
-            try:
-                dbnetwork = get_net_id_from_ip(session, ip, dbnet_env)
+            if ip in nets_by_ip:
                 ip_to_iface[ip] = {"name": ifname, "label": label}
-                networks.append(dbnetwork)
-            except NotFoundException:
+                networks.append(nets_by_ip[ip])
+            else:
                 warning("Skipping IP address %s: network not found." % ip)
 
                 # Avoid creating the interface if there are no valid IPs
@@ -16,20 +16,58 @@
 # limitations under the License.
 """Wrapper to make getting a observed_mac simpler."""
 
+from sqlalchemy.sql import and_, bindparam
 
 from aquilon.aqdb.model import ObservedMac
+from aquilon.utils import chunk
 
 
-def update_or_create_observed_mac(session, dbnetdev, port, mac, now):
-    dbobserved_mac = session.query(ObservedMac).filter_by(
-        network_device=dbnetdev, port=port, mac_address=mac).first()
-    if dbobserved_mac:
-        dbobserved_mac.last_seen = now
-        return dbobserved_mac
-    # Set creation_date explicitely instead of relying on the default to ensure
-    # creation_date == last_seen
-    dbobserved_mac = ObservedMac(network_device=dbnetdev, port=port,
-                                 mac_address=mac, creation_date=now,
-                                 last_seen=now)
-    session.add(dbobserved_mac)
-    return dbobserved_mac
+def bulk_update_observed_macs(session, dbnetdev, macports, now):
+    """
+    Record the (MAC, port) pairs discovered on a network device.
+
+    The existing rows of the device are loaded once, and the differences are
+    applied using executemany() instead of going through the ORM one row at
+    a time.
+
+    Returns the number of rows created and updated.
+    """
+    table = ObservedMac.__table__
+
+    q = session.query(ObservedMac.port, ObservedMac.mac_address)
+    q = q.filter_by(network_device_id=dbnetdev.hardware_entity_id)
+    existing = set((port, mac.value) for port, mac in q)
+
+    seen = {}
+    for mac, port in macports:
+        seen[(port, mac.value)] = mac
+
+    new_keys = [key for key in seen if key not in existing]
+    old_keys = [key for key in seen if key in existing]
+
+    dev_id = dbnetdev.hardware_entity_id
+    key_match = and_(table.c.network_device_id == dev_id,
+                     table.c.port == bindparam("b_port"),
+                     table.c.mac_address == bindparam("b_mac"))
+
+    # Set creation_date explicitely instead of relying on the default to
+    # ensure creation_date == last_seen
+    stmt = table.insert()
+    for key_chunk in chunk(new_keys, 1000):
+        session.execute(stmt, [{"network_device_id": dev_id,
+                                "port": port,
+                                "mac_address": seen[(port, value)],
+                                "creation_date": now,
+                                "last_seen": now}
+                               for port, value in key_chunk])
+
+    stmt = table.update().where(key_match).values(last_seen=now)
+    for key_chunk in chunk(old_keys, 1000):
+        session.execute(stmt, [{"b_port": port,
+                                "b_mac": seen[(port, value)]}
+                               for port, value in key_chunk])
+
+    # The ORM does not know about the changes made above
+    session.expire(dbnetdev, ["observed_macs"])
+
+    return len(new_keys), len(old_keys)
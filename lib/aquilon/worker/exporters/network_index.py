@@ -0,0 +1,51 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keep the in-memory network index in sync with the database."""
+
+from sqlalchemy.inspection import inspect
+
+from aquilon.aqdb.model.network import network_index
+from aquilon.worker.exporter import ExportHandler, register_exporter
+
+# Attributes which affect the address range covered by a network
+_INDEXED_ATTRS = ("ip", "cidr", "network_environment_id")
+
+
+@register_exporter('Network')
+class NetworkIndexExporter(ExportHandler):
+    """
+    Invalidate the cached index of a network environment if a network inside
+    it is created, deleted, or has its address range changed.
+    """
+
+    def create(self, obj, **kwargs):
+        network_index.invalidate(obj.network_environment_id)
+
+    def update(self, obj, **kwargs):
+        state = inspect(obj)
+        for attr in _INDEXED_ATTRS:
+            history = state.attrs[attr].history
+            if history.has_changes():
+                # The environment may have changed, so be thorough
+                network_index.invalidate()
+                return
+
+    def delete(self, obj, **kwargs):
+        network_index.invalidate(obj.network_environment_id)
+
+    def publish(self, notifications, **kwargs):
+        pass
@@ -0,0 +1,57 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Drop cached command results when the data behind them changes."""
+
+from aquilon.worker.exporter import (ExportHandler, ExporterNotification,
+                                     register_exporter)
+from aquilon.worker.result_cache import get_result_cache
+
+
+class ResultCacheNotification(ExporterNotification):
+    def __init__(self, cls):
+        self.cls = cls
+
+
+@register_exporter('Base')
+class ResultCacheExporter(ExportHandler):
+    """
+    Invalidate cached results when objects are flushed, and once more after
+    the transaction has been committed.
+    """
+
+    def _invalidate(self, obj):
+        cache = get_result_cache()
+        if not cache:
+            return None
+        cache.invalidate(obj.__class__)
+        return ResultCacheNotification(obj.__class__)
+
+    def create(self, obj, **kwargs):
+        return self._invalidate(obj)
+
+    def update(self, obj, **kwargs):
+        return self._invalidate(obj)
+
+    def delete(self, obj, **kwargs):
+        return self._invalidate(obj)
+
+    def publish(self, notifications, **kwargs):
+        cache = get_result_cache()
+        if not cache:
+            return
+        for cls in set(notification.cls for notification in notifications):
+            cache.invalidate(cls)
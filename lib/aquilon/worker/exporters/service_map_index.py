@@ -0,0 +1,37 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keep the in-memory service map index in sync with the database."""
+
+from aquilon.aqdb.model.service_map import service_map_index
+from aquilon.worker.exporter import ExportHandler, register_exporter
+
+
+@register_exporter('ServiceMap')
+class ServiceMapIndexExporter(ExportHandler):
+    """Invalidate the cached service map index if a map changes."""
+
+    def create(self, obj, **kwargs):
+        service_map_index.invalidate()
+
+    def update(self, obj, **kwargs):
+        service_map_index.invalidate()
+
+    def delete(self, obj, **kwargs):
+        service_map_index.invalidate()
+
+    def publish(self, notifications, **kwargs):
+        pass
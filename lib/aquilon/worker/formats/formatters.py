@@ -34,6 +34,24 @@ csv.register_dialect('aquilon', delimiter=',', quoting=csv.QUOTE_MINIMAL,
                      doublequote=True, lineterminator='\n')
 
 
+class ChunkBuffer(object):
+    """File-like object collecting output until it is large enough to send."""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def drain(self):
+        data = "".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
 class ResponseFormatter(object):
     """This handles the top level of formatting results... results
         pass through here and are delegated out to ObjectFormatter
@@ -42,6 +60,9 @@ class ResponseFormatter(object):
     """
     formats = ["raw", "csv", "html", "proto", "djb"]
 
+    # Formats which can be generated piece by piece, see format_stream()
+    stream_formats = ["raw", "csv"]
+
     loaded_protocols = {}
 
     def __init__(self):
@@ -104,6 +125,42 @@ class ResponseFormatter(object):
         m = getattr(self, "format_" + str(style).lower(), self.format_raw)
         return str(m(result, request))
 
+    def format_stream(self, style, result, request, chunk_size=65536):
+        """Generate the formatted result in chunks.
+
+        The output is the same as returned by format(), but lists are
+        formatted one item at a time, and the output is returned once it
+        reaches chunk_size bytes. That allows sending the beginning of the
+        response while the rest of a query is still being processed.
+        """
+        m = getattr(self, "stream_" + str(style).lower(), None)
+        if not m:
+            yield self.format(style, result, request)
+            return
+
+        for chunk in m(result, request, chunk_size):
+            yield chunk
+
+    def stream_raw(self, result, request, chunk_size):
+        buf = ChunkBuffer()
+        first = True
+        for piece in ObjectFormatter.redirect_raw_iter(result, embedded=False):
+            if not first:
+                buf.write("\n")
+            first = False
+            buf.write(str(piece))
+            if buf.size >= chunk_size:
+                yield buf.drain()
+        yield buf.drain()
+
+    def stream_csv(self, result, request, chunk_size):
+        buf = ChunkBuffer()
+        writer = csv.writer(buf, dialect='aquilon')
+        for _ in ObjectFormatter.redirect_csv_iter(result, writer):
+            if buf.size >= chunk_size:
+                yield buf.drain()
+        yield buf.drain()
+
     def format_raw(self, result, request):
         return ObjectFormatter.redirect_raw(result, embedded=False)
 
@@ -192,6 +249,15 @@ class ObjectFormatter(object):
                          indent=indent).rstrip()
         return indent + str(result)
 
+    def iter_raw(self, result, indent="", embedded=True, indirect_attrs=True):
+        """Generate the raw output in pieces, to be joined by newlines.
+
+        Formatters of collections should override this if the items can be
+        formatted independently.
+        """
+        yield self.format_raw(result, indent, embedded=embedded,
+                              indirect_attrs=indirect_attrs)
+
     def csv_fields(self, result):  # pragma: no cover
         raise ProtocolError("{0!r} does not have a CSV formatter."
                             .format(type(result)))
@@ -201,6 +267,11 @@ class ObjectFormatter(object):
             if fields:
                 writer.writerow(fields)
 
+    def iter_csv(self, result, writer):
+        """Format the result as CSV, yielding after each piece written."""
+        self.format_csv(result, writer)
+        yield
+
     def format_djb(self, result):
         # We get here if the command throws an exception
         return self.format_raw(result)
@@ -252,12 +323,26 @@ class ObjectFormatter(object):
         return handler.format_raw(result, indent, embedded=embedded,
                                   indirect_attrs=indirect_attrs)
 
+    @staticmethod
+    def redirect_raw_iter(result, indent="", embedded=True,
+                          indirect_attrs=True):
+        handler = ObjectFormatter.handlers.get(result.__class__,
+                                               ObjectFormatter.default_handler)
+        return handler.iter_raw(result, indent, embedded=embedded,
+                                indirect_attrs=indirect_attrs)
+
     @staticmethod
     def redirect_csv(result, writer):
         handler = ObjectFormatter.handlers.get(result.__class__,
                                                ObjectFormatter.default_handler)
         return handler.format_csv(result, writer)
 
+    @staticmethod
+    def redirect_csv_iter(result, writer):
+        handler = ObjectFormatter.handlers.get(result.__class__,
+                                               ObjectFormatter.default_handler)
+        return handler.iter_csv(result, writer)
+
     @staticmethod
     def redirect_djb(result):
         handler = ObjectFormatter.handlers.get(result.__class__,
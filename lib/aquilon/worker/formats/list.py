@@ -33,13 +33,34 @@ class ListFormatter(ObjectFormatter):
             return ObjectFormatter.format_raw(self, result, indent,
                                               embedded=embedded,
                                               indirect_attrs=indirect_attrs)
-        return "\n".join(self.redirect_raw(item, indent, embedded=embedded,
-                                           indirect_attrs=indirect_attrs)
-                         for item in result)
+        return "\n".join(self.iter_raw(result, indent, embedded=embedded,
+                                       indirect_attrs=indirect_attrs))
+
+    def iter_raw(self, result, indent="", embedded=True, indirect_attrs=True):
+        # Subclasses formatting the list as a whole cannot be split up
+        if hasattr(self, "template_raw") or \
+           type(self).format_raw != ListFormatter.format_raw:
+            yield self.format_raw(result, indent, embedded=embedded,
+                                  indirect_attrs=indirect_attrs)
+            return
+
+        for item in result:
+            yield self.redirect_raw(item, indent, embedded=embedded,
+                                    indirect_attrs=indirect_attrs)
 
     def format_csv(self, result, writer):
+        for _ in self.iter_csv(result, writer):
+            pass
+
+    def iter_csv(self, result, writer):
+        if type(self).format_csv != ListFormatter.format_csv:
+            self.format_csv(result, writer)
+            yield
+            return
+
         for item in result:
             self.redirect_csv(item, writer)
+            yield
 
     def format_html(self, result):
         if hasattr(self, "template_html"):
@@ -69,12 +90,14 @@ class StringList(list):
 class StringListFormatter(ListFormatter):
     """ Format a list of object as strings, regardless of type """
 
-    def format_raw(self, objects, indent="", embedded=True, indirect_attrs=True):
-        return "\n".join(indent + str(obj) for obj in objects)
+    def iter_raw(self, objects, indent="", embedded=True, indirect_attrs=True):
+        for obj in objects:
+            yield indent + str(obj)
 
-    def format_csv(self, objects, writer):
+    def iter_csv(self, objects, writer):
         for obj in objects:
             writer.writerow((str(obj),))
+            yield
 
 ObjectFormatter.handlers[StringList] = StringListFormatter()
 
@@ -91,12 +114,14 @@ class StringAttributeList(list):
 class StringAttributeListFormatter(ListFormatter):
     """ Format a single attribute of every object as a string """
 
-    def format_raw(self, objects, indent="", embedded=True, indirect_attrs=True):
-        return "\n".join(indent + str(objects.getter(obj)) for obj in objects)
+    def iter_raw(self, objects, indent="", embedded=True, indirect_attrs=True):
+        for obj in objects:
+            yield indent + str(objects.getter(obj))
 
-    def format_csv(self, objects, writer):
+    def iter_csv(self, objects, writer):
         for obj in objects:
             writer.writerow((str(objects.getter(obj)),))
+            yield
 
     def format_proto(self, objects, container, embedded=True, indirect_attrs=True):
         # This method always populates the first field of the protobuf message,
@@ -114,3 +139,32 @@ class StringAttributeListFormatter(ListFormatter):
             # if a usecase comes up.
 
 ObjectFormatter.handlers[StringAttributeList] = StringAttributeListFormatter()
+
+
+class StringAttributeQuery(object):
+    """
+    Like StringAttributeList, but the objects are loaded while the output is
+    being formatted.
+
+    The query is run using yield_per(), so if the output is streamed, then
+    only batch_size objects are kept in memory at a time. The query must not
+    eager load collections. Query.all() filters out duplicate objects, but
+    yield_per() can only do that within a batch, so the query has to be
+    ordered in a way that keeps duplicates next to each other.
+    """
+
+    def __init__(self, query, attr, batch_size=1000):
+        self.query = query.yield_per(batch_size)
+        if isinstance(attr, string_types):
+            self.getter = attrgetter(attr)
+        else:
+            self.getter = attr
+
+    def __iter__(self):
+        last = None
+        for obj in self.query:
+            if obj is not last:
+                yield obj
+            last = obj
+
+ObjectFormatter.handlers[StringAttributeQuery] = StringAttributeListFormatter()
@@ -0,0 +1,51 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Lock statistics formatter."""
+
+from aquilon.locks import LockHistogram, LockNamespaceStats
+from aquilon.worker.formats.formatters import ObjectFormatter
+
+
+def _bucket_labels():
+    labels = ["<= %gs" % bound for bound in LockHistogram.bounds]
+    labels.append("> %gs" % LockHistogram.bounds[-1])
+    return labels
+
+
+class LockNamespaceStatsFormatter(ObjectFormatter):
+    def format_raw(self, stats, indent="", embedded=True,
+                   indirect_attrs=True):
+        details = [indent + "Lock Namespace: %s" % stats.namespace]
+        for title, histogram in (("Wait Time", stats.wait),
+                                 ("Hold Time", stats.hold)):
+            details.append(indent + "  %s: count %d, total %.3fs, max %.3fs" %
+                           (title, histogram.count, histogram.total,
+                            histogram.max))
+            for label, count in zip(_bucket_labels(), histogram.buckets):
+                details.append(indent + "    %s: %d" % (label, count))
+        return "\n".join(details)
+
+    def csv_fields(self, stats):
+        # The bucket counts are not cumulative; the upper bounds are listed in
+        # LockHistogram.bounds
+        for kind, histogram in (("wait", stats.wait), ("hold", stats.hold)):
+            fields = [stats.namespace, kind, histogram.count,
+                      "%.6f" % histogram.total, "%.6f" % histogram.max]
+            fields.extend(histogram.buckets)
+            yield fields
+
+ObjectFormatter.handlers[LockNamespaceStats] = LockNamespaceStatsFormatter()
@@ -0,0 +1,43 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Result cache statistics formatter."""
+
+from aquilon.worker.formats.formatters import ObjectFormatter
+from aquilon.worker.result_cache import ResultCacheStats
+
+
+class ResultCacheStatsFormatter(ObjectFormatter):
+    def format_raw(self, stats, indent="", embedded=True,
+                   indirect_attrs=True):
+        if not stats.enabled:
+            return indent + "Result Cache: disabled"
+        details = [indent + "Result Cache: enabled",
+                   indent + "  Entries: %d" % stats.entries,
+                   indent + "  Size: %d bytes" % stats.size,
+                   indent + "  Hits: %d" % stats.hits,
+                   indent + "  Misses: %d" % stats.misses,
+                   indent + "  Stores: %d" % stats.stores,
+                   indent + "  Evictions: %d" % stats.evictions,
+                   indent + "  Invalidations: %d" % stats.invalidations]
+        return "\n".join(details)
+
+    def csv_fields(self, stats):
+        yield (stats.enabled, stats.entries, stats.size, stats.hits,
+               stats.misses, stats.stores, stats.evictions,
+               stats.invalidations)
+
+ObjectFormatter.handlers[ResultCacheStats] = ResultCacheStatsFormatter()
@@ -0,0 +1,46 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Request scheduler statistics formatter."""
+
+from aquilon.worker.formats.formatters import ObjectFormatter
+from aquilon.worker.scheduler import RequestQueueStats
+
+
+class RequestQueueStatsFormatter(ObjectFormatter):
+    def format_raw(self, stats, indent="", embedded=True,
+                   indirect_attrs=True):
+        if stats.started:
+            avg_wait = stats.total_wait / stats.started
+        else:
+            avg_wait = 0.0
+        details = [indent + "Request Class: %s" % stats.name,
+                   indent + "  Threads: %d" % stats.concurrency,
+                   indent + "  Running: %d" % stats.running,
+                   indent + "  Queued: %d (%d users)" % (stats.queued,
+                                                         stats.users),
+                   indent + "  Started: %d" % stats.started,
+                   indent + "  Rejected: %d" % stats.rejected,
+                   indent + "  Wait Time: avg %.3fs, max %.3fs" %
+                   (avg_wait, stats.max_wait)]
+        return "\n".join(details)
+
+    def csv_fields(self, stats):
+        yield (stats.name, stats.concurrency, stats.running, stats.queued,
+               stats.users, stats.started, stats.rejected,
+               "%.6f" % stats.total_wait, "%.6f" % stats.max_wait)
+
+ObjectFormatter.handlers[RequestQueueStats] = RequestQueueStatsFormatter()
@@ -28,9 +28,11 @@ import logging
 from contextlib import contextmanager
 from subprocess import Popen, PIPE
 from tempfile import mkdtemp
-from threading import Thread
+from threading import Thread, Timer
 
 from six import iteritems
+from six.moves import shlex_quote  # pylint: disable=F0401
+from six.moves.queue import Queue, Empty  # pylint: disable=F0401
 
 from mako.lookup import TemplateLookup
 from twisted.python import context
@@ -76,19 +78,8 @@ class StreamLoggerThread(Thread):
                     self.logger.log(self.loglevel, data.rstrip())
 
 
-def run_command(args, env=None, path="/", logger=LOGGER, loglevel=logging.INFO,
-                stream_level=None, filterre=None, input=None):
-    '''Run the specified command (args should be a list corresponding to ARGV).
-
-    Returns any output (stdout only).  If the command fails, then
-    ProcessException will be raised.  To pass the output back to the client
-    pass in a logger and specify loglevel as CLIENT_INFO.
-
-    To reduce the captured output, pass in a compiled regular expression
-    with the filterre keyword argument.  Any output lines on stdout will
-    only be kept if filterre.search() finds a match.
-
-    '''
+def command_env(env=None):
+    """Build the environment of an external command."""
     if env:
         shell_env = env.copy()
     else:
@@ -105,6 +96,11 @@ def run_command(args, env=None, path="/", logger=LOGGER, loglevel=logging.INFO,
         if envname not in shell_env and envname in os.environ:
             shell_env[envname] = os.environ[envname]
 
+    return shell_env
+
+
+def command_argv(args):
+    """Normalize the argument list of an external command."""
     # Force any arguments to be strings... takes care of unicode from
     # the database.
     command_args = [str(arg) for arg in args]
@@ -115,6 +111,28 @@ def run_command(args, env=None, path="/", logger=LOGGER, loglevel=logging.INFO,
         config = Config()
         command_args[0] = config.lookup_tool(command_args[0])
 
+    return command_args
+
+
+def run_command(args, env=None, path="/", logger=LOGGER, loglevel=logging.INFO,
+                stream_level=None, filterre=None, input=None, timeout=None):
+    '''Run the specified command (args should be a list corresponding to ARGV).
+
+    Returns any output (stdout only).  If the command fails, then
+    ProcessException will be raised.  To pass the output back to the client
+    pass in a logger and specify loglevel as CLIENT_INFO.
+
+    To reduce the captured output, pass in a compiled regular expression
+    with the filterre keyword argument.  Any output lines on stdout will
+    only be kept if filterre.search() finds a match.
+
+    If timeout is given, the command is killed if it does not finish in
+    that many seconds.
+
+    '''
+    shell_env = command_env(env)
+    command_args = command_argv(args)
+
     simple_command = " ".join(command_args)
     logger.log(loglevel, "run_command: %s (CWD: %s)", simple_command,
                os.path.abspath(path))
@@ -131,36 +149,48 @@ def run_command(args, env=None, path="/", logger=LOGGER, loglevel=logging.INFO,
     p = Popen(args=command_args, stdin=proc_stdin, stdout=PIPE, stderr=PIPE,
               cwd=path, env=shell_env)
 
-    # If we want to stream the command's output back to the client while the
-    # command is still executing, then we have to doit ourselves. Otherwise,
-    # p.communicate() does everything.
-    if stream_level is None:
-        out, err = p.communicate(input=input)
-        if filterre:
-            out = "\n".join(line for line in out.splitlines()
-                            if filterre.search(line))
+    if timeout:
+        timer = Timer(timeout, _kill_process, [p, simple_command, timeout,
+                                               logger])
+        timer.start()
     else:
-        out_thread = StreamLoggerThread(logger, stream_level, p, p.stdout,
-                                        filterre=filterre, context=ctx)
-        err_thread = StreamLoggerThread(logger, stream_level, p, p.stderr, context=ctx)
-        out_thread.start()
-        err_thread.start()
-        if proc_stdin:
-            p.stdin.write(input)
-            p.stdin.close()
-        p.wait()
-        out_thread.join()
-        err_thread.join()
-
-        out = "".join(out_thread.buffer)
-        err = "".join(err_thread.buffer)
+        timer = None
+
+    try:
+        # If we want to stream the command's output back to the client while
+        # the command is still executing, then we have to doit ourselves.
+        # Otherwise, p.communicate() does everything.
+        if stream_level is None:
+            out, err = p.communicate(input=input)
+            if filterre:
+                out = "\n".join(line for line in out.splitlines()
+                                if filterre.search(line))
+        else:
+            out_thread = StreamLoggerThread(logger, stream_level, p, p.stdout,
+                                            filterre=filterre, context=ctx)
+            err_thread = StreamLoggerThread(logger, stream_level, p, p.stderr,
+                                            context=ctx)
+            out_thread.start()
+            err_thread.start()
+            if proc_stdin:
+                p.stdin.write(input)
+                p.stdin.close()
+            p.wait()
+            out_thread.join()
+            err_thread.join()
+
+            out = "".join(out_thread.buffer)
+            err = "".join(err_thread.buffer)
+    finally:
+        if timer:
+            timer.cancel()
 
     if p.returncode >= 0:
         logger.log(loglevel, "command `%s` exited with return code %d",
                    simple_command, p.returncode)
         retcode = p.returncode
         signal_num = None
-    else:  # pragma: no cover
+    else:
         logger.log(loglevel, "command `%s` exited with signal %d",
                    simple_command, -p.returncode)
         retcode = None
@@ -175,6 +205,58 @@ def run_command(args, env=None, path="/", logger=LOGGER, loglevel=logging.INFO,
     return out
 
 
+def _kill_process(process, simple_command, timeout, logger):
+    if process.poll() is not None:  # pragma: no cover
+        return
+    logger.warning("Command `%s` did not finish in %s seconds, killing it.",
+                   simple_command, timeout)
+    try:
+        process.kill()
+    except OSError:  # pragma: no cover
+        pass
+
+
+def run_parallel(tasks, threads):
+    """
+    Call the given functions using a bounded pool of threads.
+
+    This is meant for waiting on external commands in parallel. The functions
+    are called without arguments, and they must not touch the DB session.
+
+    Returns a list of (result, exception) pairs, in the same order as tasks.
+    """
+    results = [(None, None)] * len(tasks)
+    work = Queue()
+    for idx, task in enumerate(tasks):
+        work.put((idx, task))
+
+    # The context contains the log prefix
+    ctx = (context.get(ILogContext) or {}).copy()
+
+    def call(idx, task):
+        try:
+            results[idx] = (task(), None)
+        except Exception as err:  # pylint: disable=W0703
+            results[idx] = (None, err)
+
+    def worker():
+        while True:
+            try:
+                idx, task = work.get_nowait()
+            except Empty:
+                return
+            callWithContext(ctx, call, idx, task)
+
+    workers = [Thread(target=worker)
+               for _ in range(max(1, min(threads, len(tasks))))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return results
+
+
 def run_git(args, env=None, path=".", logger=LOGGER, loglevel=logging.INFO,
             filterre=None, stream_level=None):
     config = Config()
@@ -363,6 +445,101 @@ DNS_DOMAIN_EXISTS = re.compile(r"DNS domain [-\w\.\d]+ already defined")
 INVALID_NAME_RE = re.compile(r"[^A-Za-z0-9_.-]")
 
 
+class DSDBBatch(object):
+    """
+    Run several DSDB actions using a single dsdb process.
+
+    The process is started with the --batch flag. It reads one action per
+    line from its standard input, with the arguments quoted the same way as
+    for the shell. After executing an action, it writes the standard output
+    of the action, a line containing BATCH_ERR_MARKER, the standard error of
+    the action, and finally a line containing BATCH_RC_MARKER and the exit
+    code of the action.
+
+    The process is started when the first action is run, and it is stopped
+    by close().
+    """
+
+    BATCH_ERR_MARKER = "@@DSDB_STDERR@@"
+    BATCH_RC_MARKER = "@@DSDB_RC@@"
+
+    def __init__(self, env=None, logger=LOGGER, loglevel=logging.INFO):
+        self.env = env
+        self.logger = logger
+        self.loglevel = loglevel
+        self.process = None
+        self.tool = command_argv(["dsdb"])[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self):
+        self.logger.log(self.loglevel, "Starting %s --batch", self.tool)
+        self.process = Popen(args=[self.tool, "--batch"], stdin=PIPE,
+                             stdout=PIPE, cwd="/",
+                             env=command_env(self.env))
+
+    def _read_until(self, marker):
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise ProcessException(command="%s --batch" % self.tool,
+                                       err="Unexpected end of output.")
+            if line.startswith(marker):
+                return lines, line[len(marker):].strip()
+            lines.append(line)
+
+    def run(self, args):
+        """Execute a single action, with the same semantics as run_command()."""
+        command_args = [str(arg) for arg in args]
+        simple_command = " ".join([self.tool] + command_args)
+        self.logger.log(self.loglevel, "run_command: %s (batch)",
+                        simple_command)
+
+        if not self.process:
+            self._start()
+        try:
+            self.process.stdin.write(" ".join(shlex_quote(arg)
+                                              for arg in command_args) + "\n")
+            self.process.stdin.flush()
+        except IOError as err:
+            raise ProcessException(command=simple_command, err=str(err))
+
+        out, _ = self._read_until(self.BATCH_ERR_MARKER)
+        err, rc = self._read_until(self.BATCH_RC_MARKER)
+        out = "".join(out)
+        err = "".join(err)
+        try:
+            retcode = int(rc)
+        except ValueError:
+            raise ProcessException(command=simple_command, out=out, err=err +
+                                   "Invalid return code: %r" % rc)
+
+        self.logger.log(self.loglevel, "command `%s` exited with return code %d",
+                        simple_command, retcode)
+        if err:
+            self.logger.log(self.loglevel, "command `%s` stderr: %s",
+                            simple_command, err)
+        if retcode != 0:
+            raise ProcessException(command=simple_command, out=out, err=err,
+                                   code=retcode)
+        return out
+
+    def close(self):
+        if not self.process:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:  # pragma: no cover
+            pass
+        self.process.wait()
+        self.process = None
+
+
 class DSDBRunner(object):
 
     def __init__(self, logger=LOGGER):
@@ -370,43 +547,59 @@ class DSDBRunner(object):
         self.logger = logger
         self.dsdb_use_testdb = config.getboolean("broker", "dsdb_use_testdb")
         self.location_sync = config.getboolean("broker", "dsdb_location_sync")
+        self.use_batch = config.getboolean("broker", "dsdb_batch")
         self.actions = []
         self.rollback_list = []
 
     def normalize_iface(self, iface):
         return INVALID_NAME_RE.sub("_", iface)
 
-    def commit(self, verbose=False):
-        for args, rollback, error_filter, ignore_msg in self.actions:
-            cmd = ["dsdb"]
-            cmd.extend(args)
+    @contextmanager
+    def executor(self):
+        """Return a function executing a single DSDB action."""
+        if self.use_batch:
+            with DSDBBatch(env=self.getenv(), logger=self.logger) as batch:
+                yield batch.run
+        else:
+            def run(args):
+                cmd = ["dsdb"]
+                cmd.extend(args)
+                return run_command(cmd, env=self.getenv(), logger=self.logger)
+            yield run
 
-            try:
-                if verbose:
-                    self.logger.client_info("DSDB: %s" %
-                                            " ".join(str(a) for a in args))
-                run_command(cmd, env=self.getenv(), logger=self.logger)
-            except ProcessException as err:
-                if error_filter and err.out and error_filter.search(err.out):
-                    self.logger.warning(ignore_msg)
-                else:
-                    raise
+    def commit(self, verbose=False):
+        if not self.actions:
+            return
 
-            if rollback:
-                self.rollback_list.append(rollback)
+        with self.executor() as run:
+            for args, rollback, error_filter, ignore_msg in self.actions:
+                try:
+                    if verbose:
+                        self.logger.client_info("DSDB: %s" %
+                                                " ".join(str(a) for a in args))
+                    run(args)
+                except ProcessException as err:
+                    if error_filter and err.out and \
+                       error_filter.search(err.out):
+                        self.logger.warning(ignore_msg)
+                    else:
+                        raise
+
+                if rollback:
+                    self.rollback_list.append(rollback)
 
     def rollback(self, verbose=False):
         self.rollback_list.reverse()
         rollback_failures = []
-        for args in self.rollback_list:
-            cmd = ["dsdb"]
-            cmd.extend(args)
-            try:
-                self.logger.client_info("DSDB: %s" %
-                                        " ".join(str(a) for a in args))
-                run_command(cmd, env=self.getenv(), logger=self.logger)
-            except ProcessException as err:
-                rollback_failures.append(str(err))
+        if self.rollback_list:
+            with self.executor() as run:
+                for args in self.rollback_list:
+                    try:
+                        self.logger.client_info("DSDB: %s" %
+                                                " ".join(str(a) for a in args))
+                        run(args)
+                    except ProcessException as err:
+                        rollback_failures.append(str(err))
 
         did_something = bool(self.rollback_list)
         del self.rollback_list[:]
@@ -45,31 +45,99 @@ ToDo:
 
 """
 
+import hashlib
+import json
 import re
+import time
+from threading import Event
 from xml.etree import ElementTree
 
 from six import iteritems
+from zope.interface import implementer
 
 from twisted.web import server, resource, http
-from twisted.internet import defer, threads
+from twisted.internet import defer, threads, reactor
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
 
-from aquilon.config import lookup_file_path
+from aquilon.config import Config, lookup_file_path
 from aquilon.aqdb.types import StringEnum
-from aquilon.exceptions_ import ArgumentError, ProtocolError
+from aquilon.exceptions_ import ArgumentError, ProtocolError, TransientError
 from aquilon.worker.formats.formatters import ResponseFormatter
 from aquilon.worker.broker import BrokerCommand, ERROR_TO_CODE
 from aquilon.worker import commands
 from aquilon.worker.processes import cache_version
+from aquilon.worker.scheduler import request_scheduler
 from aquilon.utils import (force_int, force_float, force_boolean, force_ipv4,
                            force_mac, force_ascii, force_list, force_json,
-                           force_uuid, force_justification)
+                           force_uuid, force_justification, write_file)
 
 # Regular Expression for matching variables in a path definition.
 # Currently only supports stuffing a single variable in a path
 # component.
 varmatch = re.compile(r'^%\((.*)\)s$')
 
+# Bump when the layout of the cached command table changes
+_COMMAND_TABLE_VERSION = 1
+
+
+@implementer(IPushProducer)
+class ResponseStream(object):
+    """Send the output of a command to the client while it is being formatted.
+
+    The formatting happens in a worker thread, but the request may only be
+    written from the reactor thread. The stream registers itself as a
+    producer of the request, so if the client does not read the data fast
+    enough, the worker thread is paused instead of buffering the whole output
+    in the broker.
+
+    Since no content-length is known in advance, Twisted uses chunked
+    transfer encoding for the response.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.started = False
+        self.stopped = False
+        self.writable = Event()
+        self.writable.set()
+
+    def write(self, data):
+        """Send a chunk of data. Must be called from a worker thread."""
+        if not self.started:
+            self.started = True
+            threads.blockingCallFromThread(reactor,
+                                           self.request.registerProducer,
+                                           self, True)
+        self.writable.wait()
+        if self.stopped:
+            raise ProtocolError("Lost connection to the client.")
+        if data:
+            threads.blockingCallFromThread(reactor, self.request.write, data)
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        self.stopped = True
+        self.writable.set()
+
+    def finish(self):
+        self.request.unregisterProducer()
+
+    def abort(self):
+        """Drop the connection if the response could not be completed.
+
+        Once the headers are sent, the status cannot be changed anymore.
+        Closing the connection without terminating the chunked encoding
+        lets the client know that the output is incomplete.
+        """
+        self.request.unregisterProducer()
+        self.request.channel.transport.loseConnection()
+
 
 class ResponsePage(resource.Resource):
 
@@ -189,9 +257,19 @@ class ResponsePage(resource.Resource):
                           broker_command.add_logger(style=style,
                                                     request=request,
                                                     **arguments))
+        # Large outputs are sent while they are being formatted, which needs
+        # the formatting to run outside the reactor thread. Output already sent
+        # cannot be taken back if the commit fails later, so only read-only
+        # commands are streamed, and only if they do not hold locks while
+        # waiting for a slow client.
+        if broker_command.defer_to_thread and broker_command.requires_format \
+           and broker_command.requires_readonly \
+           and broker_command.is_lock_free \
+           and style in self.formatter.stream_formats:
+            request.response_stream = ResponseStream(request)
+
         if broker_command.defer_to_thread:
-            d = d.addCallback(lambda arguments: threads.deferToThread(
-                broker_command.invoke_render, **arguments))
+            d = d.addCallback(self.scheduleRender, broker_command)
         else:
             d = d.addCallback(lambda arguments: broker_command.invoke_render(**arguments))
         d = d.addCallback(self.finishRender, request)
@@ -200,6 +278,20 @@ class ResponsePage(resource.Resource):
         d.callback(arguments)
         return server.NOT_DONE_YET
 
+    def scheduleRender(self, arguments, broker_command):
+        """Queue the command for running in the thread pool of its class."""
+        try:
+            return request_scheduler.submit(broker_command.request_class,
+                                            arguments["user"],
+                                            broker_command.invoke_render,
+                                            **arguments)
+        except TransientError as err:
+            # invoke_render() will not be called to clean up the logger
+            logger = arguments["logger"]
+            logger.info("%s: %s", type(err).__name__, err)
+            logger.close_handlers()
+            raise
+
     def format(self, result, request):
         # This method is called to format error messages, and the only format
         # we currently support for those is "raw"
@@ -209,7 +301,9 @@ class ResponsePage(resource.Resource):
         return self.formatter.format("raw", result, request)
 
     def finishRender(self, result, request):
-        if result:
+        if isinstance(result, ResponseStream):
+            result.finish()
+        elif result:
             request.setHeader('content-length', str(len(result)))
             # TODO: When disconnected, why doesn't write() fail?
             request.write(result)
@@ -228,6 +322,8 @@ class ResponsePage(resource.Resource):
     def wrapNonInternalError(self, failure, request):
         """This takes care of 'expected' problems, like NotFoundException."""
         r = failure.trap(*ERROR_TO_CODE.keys())
+        if self.abortStream(failure, request):
+            return
         request.setResponseCode(ERROR_TO_CODE[r])
         formatted = self.format(failure.value, request)
         return self.finishRender(formatted, request)
@@ -240,10 +336,23 @@ class ResponsePage(resource.Resource):
         log.msg("Internal Error: %s\nTraceback:\n%s" %
                 (msg, failure.getBriefTraceback()))
         # failure.printDetailedTraceback()
+        if self.abortStream(failure, request):
+            return
         request.setResponseCode(http.INTERNAL_SERVER_ERROR)
         return self.finishRender(msg, request)
 
 
+    def abortStream(self, failure, request):
+        """Drop the connection if part of the response was already sent."""
+        stream = getattr(request, "response_stream", None)
+        if not stream or not stream.started:
+            return False
+        log.msg("Command #%d failed after sending partial output: %s" %
+                (request.sequence_no, failure.getErrorMessage()))
+        stream.abort()
+        return True
+
+
 class RestServer(ResponsePage):
     """The root resource is used to define the site as a whole."""
 
@@ -351,6 +460,101 @@ class CommandEntry(object):
         pass
 
 
+def parse_input_xml(content):
+    """
+    Parse the definition of the commands.
+
+    Returns a list of (name, transports, options, formats) tuples, one for
+    every command. Transports are (method, path, trigger) tuples, options
+    are (name, type, enum) tuples, and formats are (style, XML) tuples. The
+    result only contains basic types, so it can be serialized easily.
+    """
+    table = []
+    tree = ElementTree.fromstring(content)
+    for command in tree.getiterator("command"):
+        if 'name' not in command.attrib:
+            continue
+        name = command.attrib['name']
+
+        transports = []
+        for transport in command.getiterator("transport"):
+            if "method" not in transport.attrib or \
+               "path" not in transport.attrib:
+                log.msg("Warning: incorrect transport specification "
+                        "for %s." % name)
+                continue
+            transports.append((transport.attrib["method"],
+                               transport.attrib["path"],
+                               transport.attrib.get("trigger")))
+
+        options = []
+        for option in command.getiterator("option"):
+            if 'name' not in option.attrib or \
+               'type' not in option.attrib:
+                log.msg("Warning: incorrect options specification "
+                        "for %s." % name)
+                continue
+            options.append((option.attrib["name"], option.attrib["type"],
+                            option.attrib.get("enum")))
+
+        formats = []
+        for format in command.getiterator("format"):
+            if "name" not in format.attrib:
+                log.msg("Warning: incorrect format specification "
+                        "for %s." % name)
+                continue
+            formats.append((format.attrib["name"],
+                            ElementTree.tostring(format)))
+
+        table.append((name, transports, options, formats))
+
+    return table
+
+
+def load_command_table(config):
+    """
+    Return the parsed definition of the commands.
+
+    Parsing input.xml takes a while, so the result is cached in the file
+    named by the command_table_cache option of the [broker] section. The
+    cache is used if the digest of input.xml matches the one recorded in it.
+
+    Returns the table, and a flag telling if the cache was used.
+    """
+    with open(lookup_file_path("input.xml"), "rb") as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+
+    cache_file = None
+    if config.has_option("broker", "command_table_cache"):
+        cache_file = config.get("broker", "command_table_cache").strip()
+
+    if cache_file:
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache["version"] == _COMMAND_TABLE_VERSION and \
+               cache["digest"] == digest:
+                return cache["commands"], True
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    table = parse_input_xml(content)
+
+    if cache_file:
+        cache = {"version": _COMMAND_TABLE_VERSION,
+                 "digest": digest,
+                 "commands": table}
+        try:
+            write_file(cache_file, json.dumps(cache, separators=(",", ":")),
+                       create_directory=True)
+        except (IOError, OSError) as err:
+            # The cache is only an optimization
+            log.msg("Failed to write %s: %s" % (cache_file, err))
+
+    return table, False
+
+
 class CommandRegistry(object):
 
     def new_entry(self, fullname, method, path, name, trigger):
@@ -361,25 +565,17 @@ class CommandRegistry(object):
         """Save the completed CommandEntry"""
         pass
 
-    def __init__(self):
-        tree = ElementTree.parse(lookup_file_path("input.xml"))
+    def __init__(self, config=None):
+        if config is None:
+            config = Config()
 
-        for command in tree.getiterator("command"):
-            if 'name' not in command.attrib:
-                continue
-            name = command.attrib['name']
-
-            for transport in command.getiterator("transport"):
-                if "method" not in transport.attrib or \
-                   "path" not in transport.attrib:
-                    log.msg("Warning: incorrect transport specification "
-                            "for %s." % name)
-                    continue
-
-                method = transport.attrib["method"]
-                path = transport.attrib["path"]
-                trigger = transport.attrib.get("trigger")
+        start = time.time()
+        table, self.table_cached = load_command_table(config)
+        self.table_time = time.time() - start
 
+        start = time.time()
+        for name, transports, options, formats in table:
+            for method, path, trigger in transports:
                 fullname = name
                 if trigger:
                     fullname = fullname + "_" + trigger
@@ -388,26 +584,14 @@ class CommandRegistry(object):
                 if not entry:
                     continue
 
-                for option in command.getiterator("option"):
-                    if 'name' not in option.attrib or \
-                       'type' not in option.attrib:
-                        log.msg("Warning: incorrect options specification "
-                                "for %s." % fullname)
-                        continue
-                    option_name = option.attrib["name"]
-                    paramtype = option.attrib["type"]
-                    enumtype = option.attrib.get("enum")
+                for option_name, paramtype, enumtype in options:
                     entry.add_option(option_name, paramtype, enumtype)
 
-                for format in command.getiterator("format"):
-                    if "name" not in format.attrib:
-                        log.msg("Warning: incorrect format specification "
-                                "for %s." % fullname)
-                        continue
-                    style = format.attrib["name"]
-                    entry.add_format(format, style)
+                for style, format in formats:
+                    entry.add_format(ElementTree.fromstring(format), style)
 
                 self.add_entry(entry)
+        self.entries_time = time.time() - start
 
 
 class ResourcesCommandEntry(CommandEntry):
@@ -430,29 +614,50 @@ class ResourcesCommandEntry(CommandEntry):
     def __init__(self, fullname, method, path, name, trigger):
         super(ResourcesCommandEntry, self).__init__(fullname, method, path, name, trigger)
 
+        # The instance of BrokerCommand is looked up on first use, together
+        # with the other entries sharing it (i.e. the other transports of the
+        # same command). Until then, just record the options and the
+        # formats.
+        self.siblings = [self]
+        self.options = []
+        self.formats = []
+        self._broker_command = None
+
+        # Filled in by setup()
+        self.argument_requirments = None
+        self.parameter_checks = None
+
+    @property
+    def broker_command(self):
+        if self._broker_command is None:
+            self.load()
+        return self._broker_command
+
+    def load(self):
+        """Load the command, and set up all entries using it."""
         # Locate the instance of the BrokerCommand
         # See commands/__init__.py for more info here...
-        broker_module = getattr(commands, fullname, None)
-        if not broker_module:
-            log.msg("No module available in aquilon.worker.commands " +
-                    "for %s" % fullname)
-        broker_command = getattr(broker_module, "broker_command", None)
+        broker_command = commands.get_broker_command(self.fullname)
         if not broker_command:
-            log.msg("No class instance available for %s" % fullname)
+            log.msg("No class instance available for %s" % self.fullname)
             broker_command = BrokerCommand()
 
+        for entry in self.siblings:
+            entry.setup(broker_command)
+
+    def setup(self, broker_command):
         # Save the broker command for later usage
-        self.broker_command = broker_command
+        self._broker_command = broker_command
 
         # Update the shortname of the command
-        broker_command.command = name
+        broker_command.command = self.name
 
         # HTTP GET should only be used for queries, so force such commands to be
         # read-only and require using the formatters.
-        if method.lower() == "get":
+        if self.method.lower() == "get":
             if not broker_command.requires_readonly:
                 log.msg("Command %s uses GET, setting it to read-only" %
-                        fullname)
+                        self.fullname)
             broker_command.requires_readonly = True
 
             # show_request must be able to override requires_format to False
@@ -460,17 +665,25 @@ class ResourcesCommandEntry(CommandEntry):
                 broker_command.requires_format = True
 
         # Fill in the required arguments from the instance of BrokerComamnd
-        # this will be extended when more options are found in add_option.
+        # this will be extended when more options are found in setup_option.
         self.argument_requirments = {"debug": False, "requestid": False}
         for arg in broker_command.optional_parameters or []:
             self.argument_requirments[arg] = False
         for arg in broker_command.required_parameters or []:
             self.argument_requirments[arg] = True
 
-        # Checks for specific parameters, filled in by add_option
+        # Checks for specific parameters, filled in by setup_option
         self.parameter_checks = {}
 
+        for option_name, paramtype, enumtype in self.options:
+            self.setup_option(option_name, paramtype, enumtype)
+        for format, style in self.formats:
+            self.setup_format(format, style)
+
     def add_option(self, option_name, paramtype, enumtype=None):
+        self.options.append((option_name, paramtype, enumtype))
+
+    def setup_option(self, option_name, paramtype, enumtype=None):
         # If this argument was not specified directly by the instance of
         # BrokerCommand then record it as optional (FIXME)
         if option_name not in self.argument_requirments:
@@ -505,6 +718,9 @@ class ResourcesCommandEntry(CommandEntry):
         exception will be raised.
 
         """
+        if self._broker_command is None:
+            self.load()
+
         result = {}
         for (arg, req) in self.argument_requirments.items():
             # log.msg("Checking for arg %s with required=%s" % (arg, req))
@@ -521,6 +737,9 @@ class ResourcesCommandEntry(CommandEntry):
         return result
 
     def add_format(self, format, style):
+        self.formats.append((format, style))
+
+    def setup_format(self, format, style):
         # If input.xml specifies a format description, then we need to go
         # through the formatter
         self.broker_command.requires_format = True
@@ -535,7 +754,21 @@ class ResourcesCommandRegistry(CommandRegistry):
         # Save the additional instance of ResourceServer and call
         # the base class to finish setting up.
         self.server = server
-        super(ResourcesCommandRegistry, self).__init__()
+        self.entries = {}
+        super(ResourcesCommandRegistry, self).__init__(server.config)
+
+        # Commands are normally loaded when they are first used
+        self.load_time = None
+        if not server.config.getboolean("broker", "lazy_command_loading"):
+            self.load_all()
+
+    def load_all(self):
+        """Load all commands now."""
+        start = time.time()
+        for siblings in self.entries.values():
+            if siblings[0]._broker_command is None:
+                siblings[0].load()
+        self.load_time = time.time() - start
 
     def new_entry(self, fullname, method, path, name, trigger):
         # Create a new instance of ResourcesCommandEntry.  It's add_option
@@ -546,4 +779,7 @@ class ResourcesCommandRegistry(CommandRegistry):
         # Once the ResourcesCommandEntry has been populated this method
         # is called.  We insert the entry into the ResourceServer to
         # expose them.
+        siblings = self.entries.setdefault(entry.fullname, [])
+        siblings.append(entry)
+        entry.siblings = siblings
         self.server.insert_handler(entry, entry.method.upper(), entry.path)
@@ -0,0 +1,174 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache the formatted results of read-only commands."""
+
+from collections import OrderedDict, defaultdict
+from threading import Lock
+import time
+
+from aquilon.config import Config
+
+
+class ResultCacheStats(object):
+    """Snapshot of the result cache counters."""
+
+    def __init__(self, enabled, entries=0, size=0, hits=0, misses=0,
+                 stores=0, evictions=0, invalidations=0):
+        self.enabled = enabled
+        self.entries = entries
+        self.size = size
+        self.hits = hits
+        self.misses = misses
+        self.stores = stores
+        self.evictions = evictions
+        self.invalidations = invalidations
+
+
+class ResultCache(object):
+    """
+    Keep the formatted output of read-only commands.
+
+    Commands opt in by listing the DB classes their output depends on in
+    BrokerCommand.cache_dependencies. Entries are keyed by the command, the
+    normalized arguments and the output style, and are evicted in LRU order
+    if there are more than max_entries of them, or their total size exceeds
+    max_bytes.
+
+    If an object of a class a command depends on is flushed, then all
+    entries of that command are dropped. This happens both at flush time,
+    and again after the commit - a read-only command which started before
+    the commit could otherwise store a result computed from the old state.
+    The generation counter of the command catches results which were being
+    computed while an invalidation happened.
+
+    Changes made by other processes, or using bulk statements bypassing the
+    ORM, are not seen. Entries older than ttl seconds are never used, which
+    limits the staleness in such cases.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = Lock()
+        # key -> (value, size, expiry)
+        self.entries = OrderedDict()
+        self.keys_by_command = defaultdict(set)
+        self.dependencies = {}
+        self.generations = defaultdict(int)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        value, size, _ = self.entries.pop(key)
+        self.size -= size
+        self.keys_by_command[key[0]].discard(key)
+
+    def lookup(self, key, dependencies):
+        """
+        Return the cached value of key, and the current generation.
+
+        The value is None if there is nothing cached. The generation has to
+        be passed to store() later. The dependencies of the command are
+        registered here, so changes made while the first result of a command
+        is being computed are not missed.
+        """
+        with self.lock:
+            self.dependencies[key[0]] = tuple(dependencies)
+            generation = self.generations[key[0]]
+            entry = self.entries.get(key)
+            if entry and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+            if entry:
+                self.hits += 1
+                # Move the key to the end, to implement LRU eviction
+                del self.entries[key]
+                self.entries[key] = entry
+                return entry[0], generation
+            self.misses += 1
+            return None, generation
+
+    def store(self, key, value, generation):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            command = key[0]
+            # Something the result depends on changed while the command was
+            # running
+            if self.generations[command] != generation:
+                return
+
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.time() + self.ttl)
+            self.keys_by_command[command].add(key)
+            self.size += size
+            self.stores += 1
+
+            while len(self.entries) > self.max_entries or \
+                    self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, cls):
+        """Drop the results of commands depending on the given DB class."""
+        with self.lock:
+            for command, dependencies in self.dependencies.items():
+                if not issubclass(cls, dependencies):
+                    continue
+                self.generations[command] += 1
+                keys = self.keys_by_command[command]
+                if keys:
+                    self.invalidations += len(keys)
+                    for key in list(keys):
+                        self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return ResultCacheStats(True, len(self.entries), self.size,
+                                    self.hits, self.misses, self.stores,
+                                    self.evictions, self.invalidations)
+
+
+_result_cache = None
+_result_cache_lock = Lock()
+
+
+def get_result_cache():
+    """Return the result cache, or None if caching is disabled."""
+    global _result_cache
+
+    with _result_cache_lock:
+        if _result_cache is None:
+            config = Config()
+            max_entries = config.getint("broker", "result_cache_entries")
+            if max_entries <= 0:
+                return None
+            _result_cache = ResultCache(max_entries,
+                                        config.getint("broker",
+                                                      "result_cache_bytes"),
+                                        config.getint("broker",
+                                                      "result_cache_ttl"))
+        return _result_cache
@@ -0,0 +1,177 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schedule the execution of broker commands on worker threads."""
+
+from collections import OrderedDict, deque
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+from aquilon.config import Config
+from aquilon.exceptions_ import TransientError
+
+# Classes of requests, each having its own thread pool
+REQUEST_CLASSES = ("readonly", "lockfree", "plenary", "compile")
+
+
+class RequestQueueStats(object):
+    """Snapshot of the counters of a request queue."""
+
+    def __init__(self, queue):
+        self.name = queue.name
+        self.concurrency = queue.concurrency
+        self.max_queued = queue.max_queued
+        self.running = queue.running
+        self.queued = queue.queued
+        self.users = len(queue.waiting)
+        self.started = queue.started
+        self.rejected = queue.rejected
+        self.total_wait = queue.total_wait
+        self.max_wait = queue.max_wait
+
+
+class RequestQueue(object):
+    """
+    Run requests of one class using a bounded number of threads.
+
+    Requests which cannot be started immediately are queued per user, and
+    the users take turns when a thread becomes free, so a single user
+    submitting many requests does not delay the requests of others for long.
+
+    All methods must be called from the reactor thread. The thread pool and
+    the reactor can be replaced for testing.
+    """
+
+    def __init__(self, name, concurrency, max_queued, pool=None,
+                 reactor=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        if pool is None:
+            pool = ThreadPool(minthreads=0, maxthreads=concurrency,
+                              name="aqd-%s" % name)
+        self.pool = pool
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        # user -> deque of (deferred, function, args, kwargs, submit time)
+        self.waiting = OrderedDict()
+        self.running = 0
+        self.queued = 0
+        self.started = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        self.pool.start()
+        self.reactor.addSystemEventTrigger('during', 'shutdown',
+                                           self.pool.stop)
+
+    def submit(self, queue_user, func, *args, **kwargs):
+        """
+        Run func in a worker thread, and return a Deferred of the result.
+
+        The requests of queue_user are run in the order they were submitted.
+        The parameter is not called "user", so it cannot clash with the
+        keyword arguments passed to func.
+
+        Raises TransientError if the queue is full.
+        """
+        if self.max_queued and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise TransientError("Too many %s requests are waiting to be "
+                                 "processed, please try again later." %
+                                 self.name)
+
+        d = defer.Deferred()
+        requests = self.waiting.setdefault(queue_user, deque())
+        requests.append((d, func, args, kwargs, time.time()))
+        self.queued += 1
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self.waiting:
+            # Take the first request of the user waiting the longest, and
+            # move the user to the end of the line
+            user = next(iter(self.waiting))
+            requests = self.waiting.pop(user)
+            d, func, args, kwargs, submitted = requests.popleft()
+            if requests:
+                self.waiting[user] = requests
+            self.queued -= 1
+
+            wait = time.time() - submitted
+            self.started += 1
+            self.total_wait += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+
+            self.running += 1
+            result = threads.deferToThreadPool(self.reactor, self.pool,
+                                               func, *args, **kwargs)
+            result.addBoth(self._finished)
+            result.chainDeferred(d)
+
+    def _finished(self, result):
+        self.running -= 1
+        self._dispatch()
+        return result
+
+
+class RequestScheduler(object):
+    """
+    Distribute requests between the queues of the request classes.
+
+    The concurrency of the classes is taken from the scheduler_*_threads
+    options in the [broker] section; the queues are created when they are
+    first used.
+    """
+
+    def __init__(self):
+        self.queues = {}
+
+    def get_queue(self, name):
+        try:
+            return self.queues[name]
+        except KeyError:
+            pass
+
+        config = Config()
+        concurrency = config.getint("broker", "scheduler_%s_threads" % name)
+        max_queued = config.getint("broker", "scheduler_max_queued")
+        queue = RequestQueue(name, concurrency, max_queued)
+        queue.start()
+        log.msg("Started the %s request queue with %d threads" %
+                (name, concurrency))
+        self.queues[name] = queue
+        return queue
+
+    def submit(self, request_class, queue_user, func, *args, **kwargs):
+        return self.get_queue(request_class).submit(queue_user, func, *args,
+                                                    **kwargs)
+
+    def stats(self):
+        return [RequestQueueStats(self.get_queue(name))
+                for name in REQUEST_CLASSES]
+
+
+# Single instance of the scheduler used by the broker
+request_scheduler = RequestScheduler()
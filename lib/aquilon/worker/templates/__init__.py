@@ -17,7 +17,8 @@
 
 from aquilon.worker.templates.base import (Plenary, StructurePlenary,
                                            ObjectPlenary, PlenaryCollection,
-                                           add_location_info)
+                                           PlenaryWriter, add_location_info)
+from aquilon.worker.templates.preload import Preloader, preload_objects
 from aquilon.worker.templates.city import PlenaryCity
 from aquilon.worker.templates.personality import (PlenaryPersonality,
                                                   PlenaryPersonalityBase)
@@ -22,6 +22,9 @@ import logging
 import threading
 import weakref
 from contextlib import contextmanager
+from functools import partial
+
+from six.moves.queue import Queue  # pylint: disable=F0401
 
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import object_session
@@ -29,8 +32,11 @@ from sqlalchemy.orm import object_session
 from aquilon.exceptions_ import (InternalError, IncompleteError,
                                  NotFoundException, ArgumentError)
 from aquilon.config import Config
-from aquilon.aqdb.model import Base, Sandbox, CompileableMixin
+from aquilon.aqdb.model import Base, Sandbox, CompileableMixin, Location
+from aquilon.aqdb.model.location import LocationLink
 from aquilon.worker.locks import lock_queue, CompileKey, NoLockKey
+from aquilon.worker.templates.fragments import FragmentCache, add_fragment
+from aquilon.worker.templates.manifest import get_manifest, content_digest
 from aquilon.worker.templates.panutils import pan_assign, pan_variable
 from aquilon.utils import write_file, remove_file
 
@@ -81,12 +87,19 @@ class Plenary(object):
 
         # The following attributes are for stash/restore_stash
         self.old_path = self.full_path(dbobj)
+        self.old_base = self.base_dir(dbobj)
         self.new_path = None
+        self.new_base = None
         self.old_content = None
+        self.old_digest = None
+        self.old_content_read = False
         self.stashed = False
         self.removed = False
         self.changed = False
         self.allow_incomplete = allow_incomplete
+        # If set, empty directories are recorded here instead of being
+        # removed immediately; see PlenaryWriter
+        self.pending_cleanup = None
 
     def __hash__(self):
         """Since equality is based on dbobj, just hash on it."""
@@ -162,6 +175,10 @@ class Plenary(object):
 
         return "\n".join(lines) + "\n"
 
+    @classmethod
+    def use_manifest(cls):
+        return cls.config.getboolean("broker", "plenary_manifest")
+
     def is_deleted(self):
         session = object_session(self.dbobj)
         return self.dbobj in session.deleted or inspect(self.dbobj).deleted
@@ -179,15 +196,29 @@ class Plenary(object):
         Returns the number of files that were written.
         """
 
+        written, content = self.prepare_write(remove_profile=remove_profile)
+        if content is None:
+            return written
+        return self.commit_write(content)
+
+    def prepare_write(self, remove_profile=False):
+        """First half of _write(): everything that needs the DB session.
+
+        Returns a tuple of (written, content). If content is None, then there
+        is nothing left to do, and written is the number of files already
+        touched. Otherwise, commit_write() must be called with the content.
+        """
+
         if isinstance(self.dbobj, CompileableMixin) and \
            not self.ignore_compileable and \
            not self.dbobj.archetype.is_compileable:
-            return self._remove(remove_profile=True)
+            return (self._remove(remove_profile=True), None)
 
-        self.stash()
+        self.stash_path()
 
         if self.is_deleted():
-            return self._remove(remove_profile=remove_profile)
+            self.stash_content()
+            return (self._remove(remove_profile=remove_profile), None)
         elif not self.new_path:
             raise InternalError("{0!r}: object is not deleted, but "
                                 "new_path is not set.".format(self))
@@ -195,18 +226,38 @@ class Plenary(object):
         try:
             content = self._generate_content()
         except IncompleteError as err:
+            self.stash_content()
             self._remove()
             if self.allow_incomplete:
                 self.logger.client_info("Warning: %s", err)
-                return 0
+                return (0, None)
             else:
                 raise
 
-        if self.old_content == content and not self.removed:
+        return (0, content)
+
+    def commit_write(self, content):
+        """Second half of _write(): compare and write out the content.
+
+        This part does not touch the DB session, so it may be called from a
+        different thread than the one that called prepare_write().
+        """
+
+        self.stash_content()
+
+        if self.old_content_read:
+            unchanged = self.old_content == content
+        else:
+            unchanged = self.old_digest == content_digest(content)
+        if unchanged and not self.removed:
             # optimise out the write (leaving the mtime good for ant)
             # if nothing is actually changed
             return 0
 
+        # We're about to overwrite the file, so we need the old content in
+        # case restore_stash() gets called
+        self.load_old_content()
+
         # If the plenary has moved, then clean up any potential leftover
         # files from the old location
         if self.new_path != self.old_path:
@@ -216,6 +267,8 @@ class Plenary(object):
 
         write_file(self.new_path, content, create_directory=True,
                    logger=self.logger)
+        if self.use_manifest():
+            get_manifest(self.new_base).update(self.new_path, content)
         self.changed = True
         if self.new_path == self.old_path:
             self.removed = False
@@ -244,13 +297,32 @@ class Plenary(object):
         remove this plenary template
         """
 
+        if self.stashed:
+            self.load_old_content()
+
         if os.path.exists(self.old_path):
             self.logger.debug("Removing %r [%s]", self, self.old_path)
-        if remove_file(self.old_path, cleanup_directory=True,
-                       logger=self.logger):
+        if remove_file(self.old_path, logger=self.logger):
             self.removed = True
+            self.cleanup_directory(os.path.dirname(self.old_path))
+        if self.use_manifest():
+            get_manifest(self.old_base).discard(self.old_path)
         return 1
 
+    def pop_removed_profiles(self):
+        """Return the names of the profiles removed since the last call."""
+        return []
+
+    def cleanup_directory(self, path):
+        """Remove the directory, and its parents, if they are empty."""
+        if self.pending_cleanup is not None:
+            self.pending_cleanup.add(path)
+            return
+        try:
+            os.removedirs(path)
+        except OSError:
+            pass
+
     def stash(self):
         """Record the state of the plenary to make restoration possible.
 
@@ -260,6 +332,14 @@ class Plenary(object):
         if self.stashed:
             return
 
+        self.stash_path()
+        self.stash_content()
+
+    def stash_path(self):
+        """The part of stash() which needs to look at the DB object."""
+        if self.stashed:
+            return
+
         if self.is_dirty():
             raise InternalError("{0!r}: stash() is called on dirty object"
                                 .format(self))
@@ -268,12 +348,34 @@ class Plenary(object):
         # for generating the path.
         if not self.is_deleted():
             self.new_path = self.full_path(self.dbobj)
+            self.new_base = self.base_dir(self.dbobj)
+
+    def stash_content(self):
+        """The part of stash() which reads the old content from the disk.
+
+        If the manifest has a valid entry for the old file, then only the
+        digest is recorded, and reading the content is deferred until
+        load_old_content() is called.
+        """
+        if self.stashed:
+            return
+
+        if self.use_manifest():
+            self.old_digest = get_manifest(self.old_base).lookup(self.old_path)
+        if self.old_digest is None:
+            self.load_old_content()
+        self.stashed = True
+
+    def load_old_content(self):
+        """Make sure old_content is valid, before modifying the file."""
+        if self.old_content_read:
+            return
 
         try:
             self.old_content = self.read()
         except NotFoundException:
             self.old_content = None
-        self.stashed = True
+        self.old_content_read = True
 
     def restore_stash(self):
         """Restore previous state of plenary.
@@ -289,16 +391,29 @@ class Plenary(object):
         # If the plenary has moved, then we need to clean up the new location
         if self.new_path and self.new_path != self.old_path:
             self.logger.debug("Removing %r [%s]", self, self.new_path)
-            remove_file(self.new_path, cleanup_directory=True,
-                        logger=self.logger)
+            if remove_file(self.new_path, logger=self.logger):
+                self.cleanup_directory(os.path.dirname(self.new_path))
+            if self.use_manifest():
+                get_manifest(self.new_base).discard(self.new_path)
+
+        if not self.old_content_read:
+            # The old file was never touched, so there's nothing to restore
+            self.removed = False
+            self.changed = False
+            return
 
         self.logger.debug("Restoring %r [%s]", self, self.old_path)
         if self.old_content is None:
-            remove_file(self.old_path, cleanup_directory=True,
-                        logger=self.logger)
+            if remove_file(self.old_path, logger=self.logger):
+                self.cleanup_directory(os.path.dirname(self.old_path))
+            if self.use_manifest():
+                get_manifest(self.old_base).discard(self.old_path)
         else:
             write_file(self.old_path, self.old_content, create_directory=True,
                        logger=self.logger)
+            if self.use_manifest():
+                get_manifest(self.old_base).update(self.old_path,
+                                                   self.old_content)
             # Do not try to restore the timestamp of the plenary. If the
             # rollback is due to just a couple of profiles failing from a large
             # batch, we want the next domain compile to recompile the hosts that
@@ -356,6 +471,7 @@ class ObjectPlenary(Plenary):
 
         self.old_name = self.template_name(dbobj)
         self.old_branch = dbobj.branch.name
+        self.profile_removed = False
 
     @classmethod
     def loadpath(cls, dbobj):
@@ -417,10 +533,7 @@ class ObjectPlenary(Plenary):
                                 "build", self.old_branch, self.old_name)
         for ext in self.cleanup_extensions:
             remove_file(basename + ext, logger=self.logger)
-        try:
-            os.removedirs(os.path.dirname(basename))
-        except OSError:
-            pass
+        self.cleanup_directory(os.path.dirname(basename))
 
         super(ObjectPlenary, self)._remove()
 
@@ -428,7 +541,8 @@ class ObjectPlenary(Plenary):
             basename = os.path.join(self.config.get("broker", "profilesdir"),
                                     self.old_name)
             for ext in self.cleanup_extensions:
-                remove_file(basename + ext, logger=self.logger)
+                if remove_file(basename + ext, logger=self.logger):
+                    self.profile_removed = True
 
             # Remove the cached template created by ant
             remove_file(os.path.join(self.config.get("broker", "quattordir"),
@@ -437,6 +551,12 @@ class ObjectPlenary(Plenary):
                         logger=self.logger)
         return 1
 
+    def pop_removed_profiles(self):
+        if not self.profile_removed:
+            return []
+        self.profile_removed = False
+        return [self.old_name]
+
 
 class PlenaryCollection(object):
     """
@@ -518,6 +638,12 @@ class PlenaryCollection(object):
             elif plen.template_type == 'object' and plen.dbobj.archetype.is_compileable:
                 yield plen.template_name(plen.dbobj)
 
+    def pop_removed_profiles(self):
+        names = []
+        for plen in self.plenaries:
+            names.extend(plen.pop_removed_profiles())
+        return names
+
     def _write(self, remove_profile=False):
         total = 0
         errors = []
@@ -554,6 +680,8 @@ class PlenaryCollection(object):
         finally:
             if not locked:
                 lock_queue.release(key)
+            # Removed profiles are not restored by restore_stash()
+            _record_removed_profiles(self.pop_removed_profiles())
 
         if verbose and self.plenaries:
             self.logger.client_info("Flushed %d/%d templates." %
@@ -628,7 +756,194 @@ class PlenaryCollection(object):
                 raise
 
 
+class PlenaryWriter(object):
+    """
+    Write out a large number of plenaries, optionally using worker threads.
+
+    Generating the content of a plenary needs the DB session, which is not
+    thread-safe, so write() always does that on the calling thread. If threads
+    is larger than 1, then reading the old content, comparing it, and writing
+    out the file is handed over to a bounded pool of worker threads.
+
+    Worker threads never create or remove directories, since checking and
+    modifying the same directory from several threads is racy. Directories
+    are created on the calling thread before the work is handed over, and
+    directories which may have become empty are only cleaned up by wait(),
+    once all the workers are idle.
+
+    In serial mode, errors raised while writing are passed to the caller, same
+    as when calling _write() directly. In threaded mode, errors raised by the
+    worker threads are collected, and the "failed" attribute contains the
+    formatted error messages after wait() or close() returns.
+
+    The instance should be used as a context manager, to make sure the worker
+    threads are stopped even if the caller runs into an exception.
+    """
+
+    def __init__(self, logger=LOGGER, threads=None, queue_size=None):
+        self.logger = logger
+        self.threads = threads or 1
+        self.written = 0
+        self.failed = []
+
+        self._lock = threading.Lock()
+        self._errors = []
+        self._workers = []
+        self._plenaries = []
+        self._directories = set()
+        self._cleanup = set()
+
+        if self.threads > 1:
+            if not queue_size:
+                queue_size = self.threads * 16
+            self._queue = Queue(maxsize=queue_size)
+            for _ in range(self.threads):
+                worker = threading.Thread(target=self._worker)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                plenary, content, describe = item
+                try:
+                    count = plenary.commit_write(content)
+                except Exception as err:  # pylint: disable=W0703
+                    with self._lock:
+                        self._errors.append((describe, err))
+                else:
+                    with self._lock:
+                        self.written += count
+            finally:
+                self._queue.task_done()
+
+    def _prepare(self, plenary, describe):
+        if isinstance(plenary, PlenaryCollection):
+            # Same error handling as PlenaryCollection._write()
+            errors = []
+            for plen in plenary.plenaries:
+                try:
+                    self._prepare(plen, describe)
+                except IncompleteError as err:
+                    errors.append(str(err))
+            if errors:
+                raise ArgumentError("\n".join(errors))
+            return
+
+        plenary.pending_cleanup = self._cleanup
+        self._plenaries.append(plenary)
+
+        written, content = plenary.prepare_write()
+        if describe is None:
+            describe = partial(format, plenary.dbobj)
+        if written:
+            with self._lock:
+                self.written += written
+        if content is not None:
+            self._make_directory(os.path.dirname(plenary.new_path))
+            self._queue.put((plenary, content, describe))
+
+    def _make_directory(self, path):
+        if path in self._directories:
+            return
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self._directories.add(path)
+
+    def write(self, plenary, describe=None):
+        """
+        Write the plenary, which may also be a PlenaryCollection.
+
+        The optional describe argument should be a callable returning a
+        description of the object, to be used in error messages; by default,
+        the DB object of the failing plenary is used. The callable will be
+        called from the thread calling wait() or close().
+        """
+        try:
+            if not self._workers:
+                self.written += plenary._write()
+            else:
+                self._prepare(plenary, describe)
+        finally:
+            _record_removed_profiles(plenary.pop_removed_profiles())
+
+    def wait(self):
+        """Wait until all the queued plenaries are written."""
+        if not self._workers:
+            return
+
+        self._queue.join()
+
+        # The workers are idle now, so it is safe to touch the directories
+        for plenary in self._plenaries:
+            plenary.pending_cleanup = None
+        self._plenaries = []
+        self._directories.clear()
+        for path in sorted(self._cleanup, reverse=True):
+            try:
+                os.removedirs(path)
+            except OSError:
+                pass
+        self._cleanup.clear()
+
+        with self._lock:
+            errors = self._errors
+            self._errors = []
+        for describe, err in errors:
+            self.failed.append("{0} failed: {1}".format(describe(), err))
+
+    def close(self):
+        """Wait for the pending writes and stop the worker threads."""
+        if not self._workers:
+            return
+
+        self.wait()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+def _record_removed_profiles(names):
+    if not hasattr(_mylocal, "removed_profiles"):
+        _mylocal.removed_profiles = set()
+    _mylocal.removed_profiles.update(names)
+
+
+def pop_removed_profiles():
+    """
+    Return the names of the profiles removed by the current thread.
+
+    aq_notifyd does not rescan the profiles directory after every change, so
+    profiles removed outside of a compilation have to be reported explicitly
+    to get them dropped from the index. Writing plenaries only collects the
+    names; telling aq_notifyd is up to the caller.
+    """
+    removed = getattr(_mylocal, "removed_profiles", None)
+    _mylocal.removed_profiles = set()
+    return sorted(removed) if removed else []
+
+
 def add_location_info(lines, dblocation, prefix=""):
+    add_fragment(lines, dblocation, "location", prefix,
+                 partial(_location_info, dblocation=dblocation, prefix=prefix))
+
+
+def _location_info(lines, dblocation, prefix):
     # FIXME: sort out hub/region
     for parent_type in ["continent", "country", "city", "campus", "building",
                         "bunker"]:
@@ -644,3 +959,6 @@ def add_location_info(lines, dblocation, prefix=""):
             pan_assign(lines, prefix + "rack/column", dblocation.rack_column)
     if dblocation.room:
         pan_assign(lines, prefix + "sysloc/room", dblocation.room.name)
+
+
+FragmentCache.dependencies["location"] = (Location, LocationLink)
@@ -19,6 +19,7 @@ import logging
 from operator import attrgetter
 
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import joinedload, subqueryload
 
 from aquilon.aqdb.model import (Cluster, EsxCluster, ComputeCluster,
                                 StorageCluster)
@@ -27,6 +28,7 @@ from aquilon.worker.templates import (Plenary, ObjectPlenary, StructurePlenary,
                                       PlenaryServiceInstanceClientDefault,
                                       PlenaryServiceInstanceServerDefault,
                                       PlenaryPersonalityBase, add_location_info)
+from aquilon.worker.templates.preload import Preloader
 from aquilon.worker.templates.panutils import (StructureTemplate, PanValue,
                                                pan_assign, pan_include,
                                                pan_append)
@@ -58,6 +60,22 @@ Plenary.handlers[ComputeCluster] = PlenaryCluster
 Plenary.handlers[EsxCluster] = PlenaryCluster
 Plenary.handlers[StorageCluster] = PlenaryCluster
 
+Preloader.handlers[PlenaryCluster] = Preloader(
+    query_options=[joinedload('status'),
+                   joinedload('location_constraint'),
+                   subqueryload('_hosts'),
+                   joinedload('_hosts.host'),
+                   joinedload('_hosts.host.hardware_entity'),
+                   subqueryload('metacluster'),
+                   joinedload('resholder'),
+                   subqueryload('resholder.resources'),
+                   subqueryload('services_used'),
+                   subqueryload('services_provided'),
+                   subqueryload('allowed_personalities'),
+                   subqueryload('virtual_switch'),
+                   subqueryload('personality_stage'),
+                   joinedload('personality_stage.personality')])
+
 
 class PlenaryClusterData(StructurePlenary):
     prefix = "clusterdata"
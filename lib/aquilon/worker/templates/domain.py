@@ -251,4 +251,6 @@ class TemplateDomain(object):
         # anything this compilation used.
         time.sleep(1)
 
-        trigger_notifications(config, self.logger, CLIENT_INFO)
+        # If we know what was compiled, then aq_notifyd does not need to
+        # rescan the whole profilesdir
+        trigger_notifications(config, self.logger, CLIENT_INFO, objects=only)
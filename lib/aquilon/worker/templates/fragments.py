@@ -0,0 +1,103 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache pieces of plenary templates shared between many objects."""
+
+from collections import defaultdict
+from itertools import chain
+
+from six import iteritems
+
+from sqlalchemy import event
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import object_session
+
+from aquilon.aqdb.utils.transaction import set_transaction_info
+
+
+class FragmentCache(object):
+    """
+    Store rendered fragments of plenary templates.
+
+    Templates of different objects often contain the same piece of
+    information, e.g. every host in a rack gets the same location data, and
+    every host of a personality gets the same feature parameters. When
+    generating plenaries in bulk, rendering such fragments once and re-using
+    the result saves a lot of time.
+
+    Fragments are identified by their kind, the identity of the DB object
+    they describe, and any extra arguments affecting the output. The cache
+    lives in session.info, and is dropped at the end of the transaction. If
+    an object of a class listed in dependencies is flushed, then all
+    fragments of the affected kind are thrown away.
+    """
+
+    dependencies = {}
+    """ DB classes affecting the contents, indexed by the kind of fragment """
+
+    def __init__(self):
+        self.fragments = defaultdict(dict)
+
+    def get(self, kind, key, render):
+        fragments = self.fragments[kind]
+        try:
+            return fragments[key]
+        except KeyError:
+            lines = []
+            render(lines)
+            fragments[key] = lines
+            return lines
+
+    def invalidate(self, classes):
+        for kind, dep_classes in iteritems(self.dependencies):
+            if kind not in self.fragments:
+                continue
+            if any(issubclass(cls, dep_classes) for cls in classes):
+                del self.fragments[kind]
+
+
+def _invalidate_fragments(session, flush_context):
+    cache = session.info.get("fragment_cache")
+    if not cache:
+        return
+    classes = set(type(obj) for obj in chain(session.new, session.dirty,
+                                             session.deleted))
+    cache.invalidate(classes)
+
+
+def add_fragment(lines, dbobj, kind, key, render):
+    """
+    Add a fragment describing dbobj to lines.
+
+    render is called with an empty list to generate the fragment, if it is
+    not cached yet. key should contain everything besides dbobj the output
+    depends on.
+    """
+    session = object_session(dbobj)
+    identity = inspect(dbobj).identity
+    if not session or identity is None:
+        render(lines)
+        return
+
+    cache = session.info.get("fragment_cache")
+    if cache is None:
+        cache = FragmentCache()
+        set_transaction_info(session, "fragment_cache", cache)
+
+        if not event.contains(session, "after_flush", _invalidate_fragments):
+            event.listen(session, "after_flush", _invalidate_fragments)
+
+    lines.extend(cache.get(kind, (identity, key), render))
@@ -26,8 +26,8 @@ from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import joinedload, lazyload, subqueryload
 
 from aquilon.exceptions_ import InternalError, IncompleteError
-from aquilon.aqdb.model import (Host, VlanInterface, BondingInterface,
-                                BridgeInterface)
+from aquilon.aqdb.model import (Host, VlanInterface,
+                                BondingInterface, BridgeInterface)
 from aquilon.aqdb.model.feature import nonhost_features
 from aquilon.worker.locks import CompileKey, PlenaryKey
 from aquilon.worker.templates import (Plenary, ObjectPlenary, StructurePlenary,
@@ -35,7 +35,10 @@ from aquilon.worker.templates import (Plenary, ObjectPlenary, StructurePlenary,
                                       PlenaryResource, PlenaryPersonalityBase,
                                       PlenaryServiceInstanceClientDefault,
                                       PlenaryServiceInstanceServerDefault)
-from aquilon.worker.templates.personality import get_parameters_by_feature
+from aquilon.worker.templates.personality import add_feature_parameters
+from aquilon.worker.templates.preload import (Preloader,
+                                              preload_hwent_interfaces,
+                                              preload_machine_data)
 from aquilon.worker.templates.panutils import (StructureTemplate, PanValue,
                                                pan_assign, pan_append,
                                                pan_include,
@@ -100,25 +103,47 @@ class PlenaryHost(PlenaryCollection):
                                                 allow_incomplete=allow_incomplete))
 
     @classmethod
-    def query_options(cls, prefix=""):
-        return [subqueryload(prefix + "hardware_entity.interfaces"),
-                subqueryload(prefix + "hardware_entity.interfaces.assignments"),
-                joinedload(prefix + 'hardware_entity.interfaces.assignments.network'),
-                subqueryload(prefix + 'hardware_entity.interfaces.assignments.dns_records'),
-                joinedload(prefix + 'hardware_entity.model'),
-                joinedload(prefix + 'hardware_entity.location'),
-                subqueryload(prefix + 'hardware_entity.location.parents'),
-                subqueryload(prefix + "grns"),
-                joinedload(prefix + "resholder"),
-                subqueryload(prefix + "resholder.resources"),
-                subqueryload(prefix + "services_used"),
-                subqueryload(prefix + "services_provided"),
-                subqueryload(prefix + "_cluster"),
-                lazyload(prefix + "_cluster.host")]
+    def query_options(cls, prefix="", load_interfaces=True):
+        options = [joinedload(prefix + 'hardware_entity'),
+                   joinedload(prefix + 'hardware_entity.model'),
+                   joinedload(prefix + 'hardware_entity.location'),
+                   subqueryload(prefix + 'hardware_entity.location.parents'),
+                   joinedload(prefix + 'operating_system'),
+                   joinedload(prefix + 'status'),
+                   subqueryload(prefix + 'grns'),
+                   joinedload(prefix + 'resholder'),
+                   subqueryload(prefix + 'resholder.resources'),
+                   subqueryload(prefix + 'services_used'),
+                   subqueryload(prefix + 'services_provided'),
+                   subqueryload(prefix + '_cluster'),
+                   lazyload(prefix + '_cluster.host'),
+                   subqueryload(prefix + 'virtual_switch'),
+                   subqueryload(prefix + 'personality_stage'),
+                   joinedload(prefix + 'personality_stage.personality'),
+                   subqueryload(prefix + 'personality_stage.grns'),
+                   subqueryload(prefix + 'personality_stage.required_services')]
+        # The preloader loads the interfaces by hand, together with the
+        # routing information
+        if load_interfaces:
+            options.extend([subqueryload(prefix + "hardware_entity.interfaces"),
+                            subqueryload(prefix + "hardware_entity.interfaces.assignments"),
+                            joinedload(prefix + 'hardware_entity.interfaces.assignments.network'),
+                            subqueryload(prefix + 'hardware_entity.interfaces.assignments.dns_records')])
+        return options
 
 Plenary.handlers[Host] = PlenaryHost
 
 
+def preload_host_hardware(session, dbhosts):
+    hwents = [dbhost.hardware_entity for dbhost in dbhosts]
+    preload_hwent_interfaces(session, hwents, routes=True)
+    preload_machine_data(session, hwents)
+
+Preloader.handlers[PlenaryHost] = Preloader(
+    query_options=PlenaryHost.query_options(load_interfaces=False),
+    loaders=[preload_host_hardware])
+
+
 class PlenaryHostData(StructurePlenary):
     prefix = "hostdata"
 
@@ -304,9 +329,7 @@ class PlenaryHostData(StructurePlenary):
                                 .intersection(dbstage.param_features),
                                 key=attrgetter('feature_type', 'name')):
             base_path = "system/" + dbfeature.cfg_path
-            params = get_parameters_by_feature(dbstage, dbfeature)
-            for path in sorted(params):
-                pan_assign(lines, base_path + "/" + path, params[path])
+            add_feature_parameters(lines, dbstage, dbfeature, base_path)
 
 
 class PlenaryHostObject(ObjectPlenary):
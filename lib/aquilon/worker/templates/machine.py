@@ -20,6 +20,7 @@
 import logging
 
 from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import joinedload, subqueryload
 
 from aquilon.exceptions_ import InternalError
 from aquilon.aqdb.model import (Machine, LocalDisk, VirtualDisk, Share,
@@ -27,6 +28,9 @@ from aquilon.aqdb.model import (Machine, LocalDisk, VirtualDisk, Share,
 from aquilon.worker.locks import CompileKey, NoLockKey
 from aquilon.worker.templates import (Plenary, StructurePlenary,
                                       add_location_info)
+from aquilon.worker.templates.preload import (Preloader,
+                                              preload_hwent_interfaces,
+                                              preload_machine_data)
 from aquilon.worker.templates.panutils import (StructureTemplate, pan_assign,
                                                pan_include, PanMetric)
 from aquilon.utils import nlist_key_re
@@ -201,3 +205,17 @@ class PlenaryMachineInfo(StructurePlenary):
             pan_assign(lines, "uuid", self.dbobj.uuid)
 
 Plenary.handlers[Machine] = PlenaryMachineInfo
+
+
+def preload_machine_hardware(session, dbmachines):
+    preload_hwent_interfaces(session, dbmachines)
+    preload_machine_data(session, dbmachines)
+
+Preloader.handlers[PlenaryMachineInfo] = Preloader(
+    query_options=[joinedload('model'),
+                   joinedload('model.vendor'),
+                   joinedload('cpu_model'),
+                   joinedload('cpu_model.vendor'),
+                   joinedload('location'),
+                   subqueryload('location.parents')],
+    loaders=[preload_machine_hardware])
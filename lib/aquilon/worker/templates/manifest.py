@@ -0,0 +1,235 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keep track of the content of the plenary templates written out."""
+
+import errno
+import hashlib
+import logging
+import os
+import threading
+
+from six import iteritems, text_type
+
+from aquilon.utils import write_file
+
+LOGGER = logging.getLogger(__name__)
+
+# Rewrite the journal if it contains more superseded lines than live ones,
+# but not before it contains at least this many superseded lines
+_COMPACT_THRESHOLD = 1000
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def content_digest(content):
+    if isinstance(content, text_type):
+        content = content.encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+class PlenaryManifest(object):
+    """
+    Record the size, modification time and digest of templates.
+
+    There is one manifest for every directory tree holding plenaries - i.e.
+    one for the shared plenary directory, and one for the object templates of
+    every branch. Deciding if a template needs to be rewritten can then be
+    done by comparing the digest of the new content with the manifest, instead
+    of reading the old file.
+
+    An entry is only trusted if the size and the modification time of the
+    file still match the recorded values, so files modified behind the
+    broker's back are detected, and the caller will fall back to reading the
+    file.
+
+    The manifest is persisted as an append-only journal next to the directory
+    it describes. Lines are either "<digest> <size> <mtime> <path>", or
+    "- <path>" for removed files; later lines override earlier ones. Once
+    most of the lines are superseded, the journal is rewritten, leaving out
+    the entries which no longer match the files on the disk.
+    """
+
+    def __init__(self, basedir, logger=LOGGER):
+        self.basedir = basedir.rstrip("/")
+        self.filename = self.basedir + ".manifest"
+        self.logger = logger
+        self.entries = None
+        self.superseded = 0
+        self.lock = threading.Lock()
+
+    def _relpath(self, path):
+        if not path.startswith(self.basedir + "/"):
+            return None
+        return path[len(self.basedir) + 1:]
+
+    def _load(self):
+        self.entries = {}
+        self.superseded = 0
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split(" ", 3)
+                    if fields[0] == "-" and len(fields) == 2:
+                        if self.entries.pop(fields[1], None):
+                            self.superseded += 1
+                        self.superseded += 1
+                    elif len(fields) == 4:
+                        digest, size, mtime, relpath = fields
+                        if relpath in self.entries:
+                            self.superseded += 1
+                        self.entries[relpath] = (int(size), float(mtime),
+                                                 digest)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                self.logger.info("Failed to read %s: %s", self.filename, err)
+        except ValueError as err:
+            # A truncated line may happen if the broker was killed; drop the
+            # manifest rather than trusting it
+            self.logger.info("Ignoring damaged %s: %s", self.filename, err)
+            self.entries = {}
+            self._compact()
+            return
+
+        if self._needs_compaction():
+            self._compact()
+
+    def _needs_compaction(self):
+        return self.superseded >= max(_COMPACT_THRESHOLD, len(self.entries))
+
+    def _stat_matches(self, relpath, size, mtime):
+        try:
+            st = os.stat(os.path.join(self.basedir, relpath))
+        except OSError:
+            return False
+        return st.st_size == size and st.st_mtime == mtime
+
+    def _compact(self):
+        # Entries which do not match the disk anymore would be ignored by
+        # lookup() anyway, so do not keep them around
+        self.entries = dict((relpath, entry)
+                            for relpath, entry in iteritems(self.entries)
+                            if self._stat_matches(relpath, *entry[:2]))
+        lines = ["%s %d %r %s\n" % (digest, size, mtime, relpath)
+                 for relpath, (size, mtime, digest) in iteritems(self.entries)]
+        try:
+            write_file(self.filename, "".join(lines), logger=self.logger)
+            self.superseded = 0
+        except (IOError, OSError) as err:
+            self.logger.info("Failed to write %s: %s", self.filename, err)
+
+    def _append(self, line):
+        try:
+            with open(self.filename, "a") as f:
+                f.write(line)
+        except (IOError, OSError) as err:
+            # The directory may be gone if the branch was just deleted. The
+            # manifest is only an optimization, so carry on.
+            self.logger.debug("Failed to update %s: %s", self.filename, err)
+
+        if self._needs_compaction():
+            self._compact()
+
+    def lookup(self, path):
+        """
+        Return the digest of the file, or None if it is not known.
+
+        None is returned if the file is not in the manifest, or if it has been
+        changed since the manifest was updated.
+        """
+        relpath = self._relpath(path)
+        if relpath is None:
+            return None
+
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(relpath)
+
+        if not entry:
+            return None
+
+        size, mtime, digest = entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if not st or st.st_size != size or st.st_mtime != mtime:
+            # The file was changed or removed behind the broker's back. The
+            # entry will not be valid again, and the line in the journal
+            # goes away at the next compaction.
+            with self.lock:
+                if self.entries.get(relpath) == entry:
+                    del self.entries[relpath]
+                    self.superseded += 1
+            return None
+        return digest
+
+    def update(self, path, content):
+        """Record the content just written to the file."""
+        relpath = self._relpath(path)
+        if relpath is None:
+            return
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(path)
+            return
+        digest = content_digest(content)
+
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if relpath in self.entries:
+                self.superseded += 1
+            self.entries[relpath] = (st.st_size, st.st_mtime, digest)
+            self._append("%s %d %r %s\n" % (digest, st.st_size, st.st_mtime,
+                                            relpath))
+
+    def discard(self, path):
+        """Forget about a file that was removed."""
+        relpath = self._relpath(path)
+        if relpath is None:
+            return
+
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if self.entries.pop(relpath, None):
+                self.superseded += 2
+                self._append("- %s\n" % relpath)
+
+
+def drop_manifests(topdir):
+    """Forget the manifests of the directories below topdir."""
+    prefix = topdir.rstrip("/") + "/"
+    with _manifests_lock:
+        for basedir in list(_manifests.keys()):
+            if (basedir + "/").startswith(prefix):
+                del _manifests[basedir]
+
+
+def get_manifest(basedir):
+    """Return the manifest of the given plenary directory."""
+    with _manifests_lock:
+        try:
+            return _manifests[basedir]
+        except KeyError:
+            manifest = PlenaryManifest(basedir)
+            _manifests[basedir] = manifest
+            return manifest
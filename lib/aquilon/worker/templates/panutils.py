@@ -24,99 +24,161 @@ from six import string_types
 # language documentation
 _valid_id = re.compile(r"^[a-zA-Z_][\w.+\-]*$")
 
+# Formatted nlist keys. The same few keys are used over and over again, so
+# validate each of them only once.
+_formatted_keys = {}
+_MAX_FORMATTED_KEYS = 65536
 
-def pan(obj, indent=0):
-    """pan(OBJ) -- return a string representing OBJ in the PAN language"""
+# Formatting functions, indexed by the type of the value
+_formatters = {}
+
+
+def _format_key(key):
+    try:
+        return _formatted_keys[key]
+    except (KeyError, TypeError):
+        pass
+
+    if isinstance(key, string_types):
+        if not _valid_id.match(str(key)):  # pragma: no cover
+            raise ValueError("Invalid nlist key '%s'." % key)
+    else:  # pragma: no cover
+        raise TypeError("The value of an nlist key must be a string, "
+                        "optionally escaped (it was: %r)" % key)
+
+    # Valid keys never contain quotes
+    formatted = '"%s"' % key
+    if len(_formatted_keys) >= _MAX_FORMATTED_KEYS:  # pragma: no cover
+        _formatted_keys.clear()
+    _formatted_keys[key] = formatted
+    return formatted
 
-    spaces = "  " * (indent + 1)
-    accumulator = list()
-
-    if isinstance(obj, string_types):
-        quote = '"'
-        if '"' in obj:
-            quote = "'"
-        accumulator.append("%s%s%s" % (quote, obj, quote))
-
-    elif isinstance(obj, bool):
-        accumulator.append(str(obj).lower())
-
-    elif isinstance(obj, int):
-        accumulator.append("%d" % obj)
-
-    elif isinstance(obj, float):
-        # Pan requires a dot to be present in a double literal, so we need to
-        # use the alternate format specifier
-        accumulator.append("%#g" % obj)
-
-    elif isinstance(obj, PanObject):
-        accumulator.append(obj.format(indent))
-
-    elif isinstance(obj, Mapping):
-        accumulator.append("nlist(")
-        # Enforce a deterministic order to avoid recompilations due to change in
-        # ordering. This also helps with the testsuite.
-        for key in sorted(obj):
-            val = pan(obj[key], indent + 1)
-            if isinstance(key, string_types):
-                if not _valid_id.match(str(key)):  # pragma: no cover
-                    raise ValueError("Invalid nlist key '%s'." % key)
-            else:  # pragma: no cover
-                raise TypeError("The value of an nlist key must be a string, "
-                                "optionally escaped (it was: %r)" % key)
-            accumulator.append("%s%s, %s," % (spaces, pan(key), val))
-        # remove the last comma
-        accumulator[-1] = accumulator[-1].rstrip(",")
-        accumulator.append("%s)" % ("  " * indent))
-
-    elif isinstance(obj, Iterable):
-        accumulator.append("list(")
-        for item in obj:
-            val = pan(item, indent + 1)
-            accumulator.append("%s%s," % (spaces, val))
-        # remove the last comma
-        accumulator[-1] = accumulator[-1].rstrip(",")
-        accumulator.append("%s)" % ("  " * indent))
-
-    elif obj is None:
-        accumulator.append("null")
 
+def _write_string(out, obj, indent):
+    if '"' in obj:
+        out.append("'%s'" % obj)
     else:
-        accumulator.append(pan(str(obj)))
+        out.append('"%s"' % obj)
 
-    if len(accumulator) == 1:
-        return accumulator[0]
 
-    return "\n".join(("%s" % x) for x in accumulator)
+def _write_bool(out, obj, indent):
+    out.append("true" if obj else "false")
 
 
-def pan_create(path, params=None, indent=0):
-    """ Return a PAN create() statement """
+def _write_int(out, obj, indent):
+    out.append("%d" % obj)
+
+
+def _write_float(out, obj, indent):
+    # Pan requires a dot to be present in a double literal, so we need to
+    # use the alternate format specifier
+    out.append("%#g" % obj)
 
-    spaces = "  " * (indent + 1)
-    accumulator = list()
-    accumulator.append("create(%s," % pan(path))
 
+def _write_pan_object(out, obj, indent):
+    out.append(obj.format(indent))
+
+
+def _write_entries(out, obj, indent, value_indent):
     # Enforce a deterministic order to avoid recompilations due to change in
     # ordering. This also helps with the testsuite.
+    spaces = "\n" + "  " * (indent + 1)
+    separator = spaces
+    for key in sorted(obj):
+        value = obj[key]
+        formatted_key = _format_key(key)
+        out.append(separator)
+        out.append(formatted_key)
+        out.append(", ")
+        _write(out, value, value_indent)
+        separator = "," + spaces
+    out.append("\n")
+    out.append("  " * indent)
+    out.append(")")
+
+
+def _write_mapping(out, obj, indent):
+    out.append("nlist(")
+    _write_entries(out, obj, indent, indent + 1)
+
+
+def _write_iterable(out, obj, indent):
+    spaces = "\n" + "  " * (indent + 1)
+    separator = spaces
+    out.append("list(")
+    for item in obj:
+        out.append(separator)
+        _write(out, item, indent + 1)
+        separator = "," + spaces
+    out.append("\n")
+    out.append("  " * indent)
+    out.append(")")
+
+
+def _write_none(out, obj, indent):
+    out.append("null")
+
+
+def _write_other(out, obj, indent):
+    _write_string(out, str(obj), indent)
+
+
+def _get_formatter(cls):
+    # The order of the checks matters: e.g. bool is a subclass of int, and
+    # strings are iterable
+    if issubclass(cls, string_types):
+        formatter = _write_string
+    elif issubclass(cls, bool):
+        formatter = _write_bool
+    elif issubclass(cls, int):
+        formatter = _write_int
+    elif issubclass(cls, float):
+        formatter = _write_float
+    elif issubclass(cls, PanObject):
+        formatter = _write_pan_object
+    elif issubclass(cls, Mapping):
+        formatter = _write_mapping
+    elif issubclass(cls, Iterable):
+        formatter = _write_iterable
+    elif cls is type(None):
+        formatter = _write_none
+    else:
+        formatter = _write_other
+
+    _formatters[cls] = formatter
+    return formatter
+
+
+def _write(out, obj, indent):
+    try:
+        formatter = _formatters[type(obj)]
+    except KeyError:
+        formatter = _get_formatter(type(obj))
+    formatter(out, obj, indent)
+
+
+def pan(obj, indent=0):
+    """pan(OBJ) -- return a string representing OBJ in the PAN language"""
+
+    out = []
+    _write(out, obj, indent)
+    return "".join(out)
+
+
+def pan_create(path, params=None, indent=0):
+    """ Return a PAN create() statement """
+
+    out = ["create("]
+    _write(out, path, indent)
     if params:
-        for key in sorted(params):
-            val = pan(params[key], indent + 2)
-            if isinstance(key, string_types):
-                if not _valid_id.match(str(key)):  # pragma: no cover
-                    raise ValueError("Invalid nlist key '%s'." % key)
-            else:  # pragma: no cover
-                raise TypeError("The value of an nlist key must be a string, "
-                                "optionally escaped (it was: %r)" % key)
-            accumulator.append("%s%s, %s," % (spaces, pan(key), val))
-        # remove the last comma
-        accumulator[-1] = accumulator[-1].rstrip(",")
-        accumulator.append("%s)" % ("  " * indent))
+        out.append(",")
+        _write_entries(out, params, indent, indent + 2)
     else:
         # If there are no parameters, keep the entire create() statement in a
         # single line
-        accumulator[-1] = accumulator[-1].rstrip(",") + ")"
+        out.append(")")
 
-    return "\n".join(("%s" % x) for x in accumulator)
+    return "".join(out)
 
 
 def pan_assign(lines, path, value, final=False):
@@ -22,11 +22,13 @@ from operator import attrgetter
 from sqlalchemy.orm import joinedload, subqueryload
 
 from aquilon.aqdb.model import (PersonalityStage, PersonalityParameter,
-                                ArchetypeParamDef)
+                                ArchetypeParamDef, Parameter, ParamDefHolder,
+                                ParamDefinition, Feature, FeatureLink)
 from aquilon.aqdb.model.feature import host_features
 from aquilon.worker.locks import NoLockKey, PlenaryKey
 from aquilon.worker.templates.base import (Plenary, StructurePlenary,
                                            PlenaryCollection)
+from aquilon.worker.templates.fragments import FragmentCache, add_fragment
 from aquilon.worker.templates.panutils import (pan_include, pan_variable,
                                                pan_assign, pan_append,
                                                pan_include_if_exists)
@@ -55,6 +57,22 @@ def get_parameters_by_feature(dbstage, dbfeature):
     return ret
 
 
+def add_feature_parameters(lines, dbstage, dbfeature, base_path):
+    def render(lines):
+        params = get_parameters_by_feature(dbstage, dbfeature)
+        for key in sorted(params):
+            pan_assign(lines, base_path + "/" + key, params[key])
+
+    add_fragment(lines, dbstage, "feature_parameters",
+                 (dbfeature.id, base_path), render)
+
+
+FragmentCache.dependencies["feature_parameters"] = (PersonalityStage,
+                                                    Parameter, ParamDefHolder,
+                                                    ParamDefinition, Feature,
+                                                    FeatureLink)
+
+
 def staged_path(prefix, dbstage, suffix):
     if dbstage.name == "current":
         return "%s/%s/%s" % (prefix, dbstage.personality.name, suffix)
@@ -144,10 +162,7 @@ class PlenaryPersonalityBase(Plenary):
                                 .intersection(self.dbobj.param_features),
                                 key=attrgetter('name')):
             base_path = "/system/" + dbfeature.cfg_path
-            params = get_parameters_by_feature(self.dbobj, dbfeature)
-
-            for key in sorted(params.keys()):
-                pan_assign(lines, base_path + "/" + key, params[key])
+            add_feature_parameters(lines, self.dbobj, dbfeature, base_path)
 
         for dbfeature in sorted(pre, key=attrgetter('name')):
             pan_include(lines, dbfeature.cfg_path + "/config")
@@ -0,0 +1,237 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Bulk-load the data needed for generating plenary templates."""
+
+from collections import defaultdict
+
+from six import iteritems
+
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import joinedload, subqueryload, undefer
+from sqlalchemy.orm.attributes import set_committed_value
+
+from aquilon.aqdb.model import (Interface, AddressAssignment, Disk,
+                                ChassisSlot, VirtualMachine, Machine)
+from aquilon.worker.templates.base import Plenary
+from aquilon.utils import chunk
+
+
+class Preloader(object):
+    """
+    Describe the data the plenaries of a given class need.
+
+    Generating plenaries one by one makes SQLAlchemy lazy-load the related
+    objects of every DB object separately. If many plenaries have to be
+    generated, then preload_objects() can be used to load the same data for
+    all objects using a few bulk queries instead.
+
+    query_options is a list of loader options (joinedload() and friends). The
+    objects are re-queried using these options, which fills in the
+    relationships that have not been loaded yet.
+
+    loaders is a list of functions, which are called with the session and the
+    list of objects. Loaders handle data which cannot be described by query
+    options, most importantly polymorphic collections, which have to be
+    loaded manually and set using set_committed_value().
+    """
+
+    handlers = {}
+    """ Preloaders indexed by plenary class """
+
+    def __init__(self, query_options=None, loaders=None):
+        self.query_options = query_options or []
+        self.loaders = loaders or []
+
+    @staticmethod
+    def get_preloader(plenary_cls):
+        """Look up the preloader of a plenary class, or of its parents."""
+        for cls in plenary_cls.__mro__:
+            if cls in Preloader.handlers:
+                return Preloader.handlers[cls]
+        return None
+
+    def preload(self, session, dbobjs):
+        if self.query_options:
+            objs_by_class = defaultdict(list)
+            for dbobj in dbobjs:
+                objs_by_class[dbobj.__class__].append(dbobj)
+
+            for cls, objs in iteritems(objs_by_class):
+                mapper = inspect(cls)
+                pk = mapper.primary_key[0]
+                ids = [mapper.primary_key_from_instance(obj)[0]
+                       for obj in objs]
+                for id_chunk in chunk(ids, 1000):
+                    q = session.query(cls)
+                    q = q.filter(pk.in_(id_chunk))
+                    q = q.options(*self.query_options)
+                    q.all()
+
+        for loader in self.loaders:
+            loader(session, dbobjs)
+
+
+def preload_objects(session, dbobjs, cls=None):
+    """
+    Bulk-load everything needed to generate the plenaries of the objects.
+
+    The objects are grouped by the plenary class which handles them, and the
+    preloader registered for that class is called once for every group. If
+    cls is given, it is used as the plenary class of all objects, similar to
+    PlenaryCollection.add(). Objects with no registered preloader are
+    skipped.
+    """
+    objs_by_preloader = defaultdict(list)
+    for dbobj in dbobjs:
+        if cls:
+            handler = cls
+        else:
+            handler = Plenary.handlers.get(dbobj.__class__)
+            if not handler:
+                continue
+
+        preloader = Preloader.get_preloader(handler)
+        if preloader:
+            objs_by_preloader[preloader].append(dbobj)
+
+    for preloader, objs in iteritems(objs_by_preloader):
+        preloader.preload(session, objs)
+
+
+def load_interfaces(session, hwent_ids=None, routes=False):
+    """
+    Load interfaces, together with the addresses assigned to them.
+
+    Polymorphic loading cannot be applied to eager-loaded attributes, so
+    interfaces are loaded manually. If hwent_ids is None, then all interfaces
+    are loaded. If routes is True, then the routers and static routes of the
+    networks are loaded as well.
+
+    Returns the lists of interfaces, indexed by the ID of the hardware entity.
+    """
+    interfaces_by_hwent = defaultdict(list)
+    interfaces_by_id = {}
+    addrs_by_iface = defaultdict(list)
+    slaves_by_id = defaultdict(list)
+
+    if hwent_ids is not None:
+        criteria = [Interface.hardware_entity_id.in_(id_chunk)
+                    for id_chunk in chunk(sorted(hwent_ids), 1000)]
+    else:
+        criteria = [None]
+
+    for criterion in criteria:
+        q = session.query(Interface)
+        q = q.with_polymorphic('*')
+        if criterion is not None:
+            q = q.filter(criterion)
+        q = q.options(joinedload('model'),
+                      joinedload('model.vendor'))
+        for iface in q:
+            interfaces_by_hwent[iface.hardware_entity_id].append(iface)
+            interfaces_by_id[iface.id] = iface
+            if iface.master_id:
+                slaves_by_id[iface.master_id].append(iface)
+
+    if hwent_ids is not None:
+        criteria = [AddressAssignment.interface_id.in_(id_chunk)
+                    for id_chunk in chunk(sorted(interfaces_by_id), 1000)]
+
+    # subqueryload() and with_polymorphic() do not play nice together, so
+    # addresses are also loaded by hand
+    for criterion in criteria:
+        q = session.query(AddressAssignment)
+        if criterion is not None:
+            q = q.filter(criterion)
+        q = q.options(joinedload("network"),
+                      joinedload("network.network_environment"),
+                      joinedload("dns_records"))
+        if routes:
+            q = q.options(subqueryload("network.static_routes"),
+                          subqueryload("network.routers"))
+        q = q.order_by(AddressAssignment.label)
+
+        for addr in q:
+            addrs_by_iface[addr.interface_id].append(addr)
+
+    for iface_id, iface in iteritems(interfaces_by_id):
+        set_committed_value(iface, "assignments",
+                            addrs_by_iface.get(iface_id, None))
+        set_committed_value(iface, "slaves",
+                            slaves_by_id.get(iface_id, None))
+        set_committed_value(iface, "master",
+                            interfaces_by_id.get(iface.master_id, None))
+        if hasattr(iface, "parent"):
+            set_committed_value(iface, "parent",
+                                interfaces_by_id.get(iface.parent_id, None))
+
+    return interfaces_by_hwent
+
+
+def preload_hwent_interfaces(session, hwents, routes=False):
+    """Load the interfaces of the given hardware entities."""
+    hw_by_id = {dbhw.id: dbhw for dbhw in hwents}
+    interfaces_by_hwent = load_interfaces(session, hw_by_id.keys(),
+                                          routes=routes)
+    for hw_id, dbhw in iteritems(hw_by_id):
+        set_committed_value(dbhw, "interfaces",
+                            interfaces_by_hwent.get(hw_id, None))
+
+
+def preload_machine_data(session, hwents):
+    """
+    Load the disks, the chassis slots and the VM container of machines.
+
+    Not all hosts are bound to machines, so hardware entities which are not
+    machines are skipped.
+    """
+    hw_by_id = {dbhw.id: dbhw for dbhw in hwents if isinstance(dbhw, Machine)}
+
+    for machine_chunk in chunk(hw_by_id.keys(), 1000):
+        disks_by_hw = defaultdict(list)
+        q = session.query(Disk)
+        q = q.with_polymorphic('*')
+        q = q.options(undefer('comments'))
+        q = q.filter(Disk.machine_id.in_(machine_chunk))
+        for dbdisk in q:
+            dbhw = hw_by_id[dbdisk.machine_id]
+            set_committed_value(dbdisk, "machine", dbhw)
+            disks_by_hw[dbdisk.machine_id].append(dbdisk)
+
+        slots_by_hw = defaultdict(list)
+        q = session.query(ChassisSlot)
+        q = q.options(joinedload('chassis'))
+        q = q.filter(ChassisSlot.machine_id.in_(machine_chunk))
+        for dbslot in q:
+            dbhw = hw_by_id[dbslot.machine_id]
+            set_committed_value(dbslot, "machine", dbhw)
+            slots_by_hw[dbslot.machine_id].append(dbslot)
+
+        vms = {}
+        q = session.query(VirtualMachine)
+        q = q.filter(VirtualMachine.machine_id.in_(machine_chunk))
+        for vm in q:
+            dbhw = hw_by_id[vm.machine_id]
+            set_committed_value(vm, "machine", dbhw)
+            vms[vm.machine_id] = vm
+
+        for hw_id in machine_chunk:
+            dbhw = hw_by_id[hw_id]
+            set_committed_value(dbhw, "disks", disks_by_hw.get(hw_id, []))
+            set_committed_value(dbhw, "chassis_slot",
+                                slots_by_hw.get(hw_id, []))
+            set_committed_value(dbhw, "vm_container", vms.get(hw_id, None))
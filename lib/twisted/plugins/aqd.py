@@ -18,6 +18,7 @@
 
 import os
 import sys
+import time
 
 # This is done by the wrapper script.
 # import aquilon.worker.depends
@@ -38,6 +39,10 @@ from aquilon.worker.base_protocol import AQDSite
 # config file has been parsed.
 # from aquilon.worker.resources import RestServer
 
+# When the plugin was loaded, which is a good approximation of when twistd
+# started
+_plugin_loaded = time.time()
+
 
 class Options(usage.Options):
     optFlags = [["noauth", None, "Do not start the knc listener."],
@@ -58,16 +63,42 @@ def set_thread_pool_size(config):
     # This is a somewhat made up number.  The default is ten.
     # We are resource-limited in 32-bit, can't just make this
     # a huge number.
-    # We need at least 10 threads for the normal sqlalchemy
-    # thread pool and 10 for the special "no locks allowed"
-    # pool.  Anything beyond that are just being allowed to
-    # queue and get themselves a logger.
-    # We are also constrained by the number of knc sockets
-    # that can be open at once (max file descriptors).
+    # Commands do not use this pool, they are run by the thread
+    # pools of aquilon.worker.scheduler, sized by the
+    # scheduler_*_threads options.  This pool is left for
+    # Twisted's own use, e.g. name resolution.
+    # The total number of threads is also constrained by the
+    # number of knc sockets that can be open at once (max file
+    # descriptors).
     pool_size = config.get("broker", "twisted_thread_pool_size")
     reactor.suggestThreadPoolSize(int(pool_size))
 
 
+class StartupTimer(object):
+    """Keep track of how long the phases of the broker startup take."""
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, phase):
+        """Record the end of a phase, which started where the last one ended."""
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def add(self, phase, elapsed):
+        """Record a part of the last phase, which was measured separately."""
+        self.phases.append(("  " + phase, elapsed))
+
+    def report(self):
+        self.mark("Remaining setup and reactor startup")
+        log.msg("Broker startup took %.3fs:" % (self.last - self.start))
+        for phase, elapsed in self.phases:
+            log.msg("  %-44s %8.3fs" % (phase, elapsed))
+
+
 def make_required_dirs(config):
     for d in ["basedir", "profilesdir", "plenarydir", "rundir", "logdir"]:
         dir = config.get("broker", d)
@@ -86,6 +117,10 @@ class AQDMaker(object):
     options = Options
 
     def makeService(self, options):
+        timer = StartupTimer(_plugin_loaded)
+        timer.mark("Twisted startup")
+        reactor.addSystemEventTrigger('after', 'startup', timer.report)
+
         # Start up coverage ASAP.
         coverage_dir = options["coveragedir"]
         if coverage_dir:
@@ -150,6 +185,7 @@ class AQDMaker(object):
             config.set('broker', 'mode', 'readwrite')
 
         log.msg("Loading broker in mode %s" % config.get('broker', 'mode'))
+        timer.mark("Configuration and logging")
 
         # Dynamic import means that we can parse config options before
         # importing aqdb.  This is a hack until aqdb can be imported without
@@ -157,10 +193,28 @@ class AQDMaker(object):
         resources = __import__("aquilon.worker.resources", globals(), locals(),
                                ["RestServer"], 0)
         RestServer = getattr(resources, "RestServer")
+        timer.mark("Importing the broker modules")
         restServer = RestServer(config)
+        timer.mark("Setting up the REST server")
 
         ResourcesCommandRegistry = getattr(resources, "ResourcesCommandRegistry")
         registry = ResourcesCommandRegistry(restServer)
+        timer.mark("Setting up the commands")
+        if registry.table_cached:
+            timer.add("Loading the cached command table",
+                      registry.table_time)
+        else:
+            timer.add("Parsing input.xml", registry.table_time)
+        timer.add("Registering the commands", registry.entries_time)
+        if registry.load_time is not None:
+            timer.add("Loading all commands", registry.load_time)
+
+        # Commands are loaded lazily, so connect to the database explicitly
+        # to find problems early
+        db_factory = __import__("aquilon.aqdb.db_factory", globals(),
+                                locals(), ["DbFactory"], 0)
+        db_factory.DbFactory()
+        timer.mark("Connecting to the database")
 
         openSite = AQDSite(restServer)
 
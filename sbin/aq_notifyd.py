@@ -57,9 +57,15 @@ class NotifyProtocol(LineReceiver):
     def lineReceived(self, line):
         logger = logging.getLogger("aq_notifyd")
 
-        if line == "update":
+        words = line.split()
+        if words and words[0] in ("update", "rescan"):
             # Wake up the worker thread
             worker_notify.acquire()
+            if words[0] == "rescan" or len(words) == 1:
+                # A plain "update" does not tell what has changed
+                worker_thread.rescan_queued = True
+            else:
+                worker_thread.queued_objects.update(words[1:])
             worker_thread.update_queued = True
             worker_notify.notify()
             worker_notify.release()
@@ -73,13 +79,13 @@ class NotifyFactory(Factory):
     protocol = NotifyProtocol
 
 
-def update_index_and_notify(config, logger, db):
+def update_index_and_notify(config, logger, db, index=None, objects=None):
     from aquilon.notify.index import build_index
 
     session = db.Session()
 
     try:
-        build_index(config, session, logger)
+        build_index(config, session, logger, index=index, objects=objects)
     except Exception as err:
         logger.error(err)
     finally:
@@ -93,11 +99,20 @@ class UpdaterThread(Thread):
         self.logger = logger
         self.db = db
         self.update_queued = False
+        # The index is kept in memory, and the profilesdir is only rescanned
+        # at startup, or if explicitly requested
+        self.index = None
+        self.rescan_queued = True
+        self.queued_objects = set()
         self.do_exit = False
         super(UpdaterThread, self).__init__()
 
     def run(self):
+        from aquilon.notify.index import ProfileIndex
+
         self.logger.info("Worker thread starting")
+        self.index = ProfileIndex(self.config, logger=self.logger)
+        self.update_queued = True
 
         while True:
             worker_notify.acquire()
@@ -110,10 +125,17 @@ class UpdaterThread(Thread):
                 continue
 
             self.update_queued = False
+            if self.rescan_queued:
+                objects = None
+            else:
+                objects = self.queued_objects
+            self.rescan_queued = False
+            self.queued_objects = set()
             worker_notify.release()
 
             self.logger.debug("Worker woken up")
-            update_index_and_notify(self.config, self.logger, self.db)
+            update_index_and_notify(self.config, self.logger, self.db,
+                                    index=self.index, objects=objects)
 
         worker_notify.release()
         self.logger.info("Worker thread finished")
@@ -18,8 +18,10 @@
 
 import os
 import re
+import gzip
 from time import sleep
 from datetime import datetime, timedelta
+import xml.etree.ElementTree as ET
 
 from dateutil.parser import parse
 
@@ -78,3 +80,34 @@ class VerifyNotificationsMixin(object):
                 return
             sleep(0.5)
         self.fail("Notifications were not sent within %d seconds" % NOTIFY_WAIT)
+
+    def get_indexed_profiles(self):
+        """Return the names of the objects listed in profiles-info.xml."""
+        transparent_gzip = self.config.getboolean('panc', 'transparent_gzip')
+        profilesdir = self.config.get('broker', 'profilesdir')
+        index = os.path.join(profilesdir, 'profiles-info.xml')
+        if self.gzip_profiles and transparent_gzip:
+            source = gzip.open(index + '.gz')
+        else:
+            source = open(index)
+        tree = ET.parse(source)
+        source.close()
+
+        names = set()
+        for profile in tree.iter('profile'):
+            obj = profile.text.strip() if profile.text else ""
+            for suffix in [self.xml_suffix, self.json_suffix]:
+                if obj.endswith(suffix):
+                    names.add(obj[:-len(suffix)])
+        return names
+
+    def wait_index(self, name, present=True):
+        start = datetime.now()
+        delta = timedelta(seconds=NOTIFY_WAIT)
+        while datetime.now() <= start + delta:
+            if (name in self.get_indexed_profiles()) == present:
+                return
+            sleep(0.5)
+        self.fail("Profile %s was %s the index after %d seconds" %
+                  (name, "still not in" if present else "still in",
+                   NOTIFY_WAIT))
@@ -32,6 +32,9 @@ from .test_start import TestBrokerStart
 from .test_ping import TestPing
 from .test_status import TestStatus
 from .test_show_active_commands import TestShowActiveCommands
+from .test_show_lock_stats import TestShowLockStats
+from .test_show_result_cache_stats import TestShowResultCacheStats
+from .test_show_scheduler_stats import TestShowSchedulerStats
 from .test_add_role import TestAddRole
 from .test_del_role import TestDelRole
 from .test_permission import TestPermission
@@ -188,6 +191,7 @@ from .test_search_dns import TestSearchDns
 from .test_dump_dns import TestDumpDns
 from .test_search_system import TestSearchSystem
 from .test_search_host import TestSearchHost
+from .test_show_host import TestShowHost
 from .test_search_esx_cluster import TestSearchESXCluster
 from .test_search_cluster_esx import TestSearchClusterESX
 from .test_search_cluster import TestSearchCluster
@@ -418,7 +422,8 @@ class BrokerTestSuite(unittest.TestSuite):
                      TestSearchHardware, TestSearchMachine, TestShowMachine,
                      TestSearchDns, TestDumpDns,
                      TestSearchPersonality,
-                     TestSearchSystem, TestSearchHost, TestSearchESXCluster,
+                     TestSearchSystem, TestSearchHost, TestShowHost,
+                     TestSearchESXCluster,
                      TestSearchClusterESX, TestSearchCluster,
                      TestSearchMetaCluster,
                      TestSearchObservedMac, TestSearchNext, TestSearchNetwork,
@@ -492,6 +497,8 @@ class BrokerTestSuite(unittest.TestSuite):
                      TestDelUser,
                      TestDelDnsEnvironment, TestDelDnsDomain, TestDelRole,
                      TestClientFailure, TestAudit, TestShowActiveCommands,
+                     TestShowLockStats, TestShowResultCacheStats,
+                     TestShowSchedulerStats,
                      TestDocumentation,
                      TestBrokerStop]:
             self.addTest(unittest.TestLoader().loadTestsFromTestCase(test))
@@ -17,6 +17,8 @@
 # limitations under the License.
 """Module for testing the flush command."""
 
+import os
+from shutil import rmtree
 import unittest
 
 if __name__ == "__main__":
@@ -31,6 +33,64 @@ class TestFlush(TestBrokerCommand):
     def testflushunittest(self):
         self.statustest(["flush", "--all"])
 
+    def testflushthreads(self):
+        self.statustest(["flush", "--hosts", "--clusters", "--threads", "4"])
+
+    def snapshot_plenaries(self, plenarydir):
+        contents = {}
+        for dirpath, _, filenames in os.walk(plenarydir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path) as f:
+                    contents[os.path.relpath(path, plenarydir)] = f.read()
+        return contents
+
+    def flush_to_copy(self, plenarydir, copydir, command):
+        # Start from an empty plenary directory, so all the templates are
+        # actually written, and move the result out of the way
+        self.statustest(command)
+        os.rename(plenarydir, copydir)
+        return self.snapshot_plenaries(copydir)
+
+    def testflushthreadsmatchserial(self):
+        plenarydir = self.config.get("broker", "plenarydir").rstrip("/")
+        saved = plenarydir + ".saved"
+        serialdir = plenarydir + ".serial"
+        threadeddir = plenarydir + ".threaded"
+
+        # Other tests depend on the contents of the plenary directory, so
+        # keep the original tree, and put it back when done
+        os.rename(plenarydir, saved)
+        try:
+            serial = self.flush_to_copy(plenarydir, serialdir,
+                                        ["flush", "--all"])
+            threaded = self.flush_to_copy(plenarydir, threadeddir,
+                                          ["flush", "--all", "--threads", "4"])
+        finally:
+            if os.path.exists(plenarydir):
+                os.rename(plenarydir, threadeddir + ".partial")
+            os.rename(saved, plenarydir)
+            for path in (serialdir, threadeddir, threadeddir + ".partial"):
+                rmtree(path, ignore_errors=True)
+
+        self.assertEqual(sorted(serial.keys()), sorted(threaded.keys()))
+        for path, content in serial.items():
+            self.assertEqual(content, threaded[path],
+                             "%s differs after a threaded flush" % path)
+
+    def testflushwindowed(self):
+        self.statustest(["flush", "--all", "--window_size", "7"])
+
+    def testflushwindowedthreads(self):
+        self.statustest(["flush", "--all", "--window_size", "7",
+                         "--threads", "4"])
+
+    def testflushbadwindow(self):
+        command = ["flush", "--hosts", "--window_size", "0"]
+        out = self.badrequesttest(command)
+        self.matchoutput(out, "The window size must be a positive integer.",
+                         command)
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestFlush)
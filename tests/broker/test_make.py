@@ -273,6 +273,46 @@ class TestMake(TestBrokerCommand):
                          "Uses Service: scope_test Instance: scope-network",
                          command)
 
+    def test_127_unmap_network_rebind(self):
+        # The broker caches the service maps, removing a map must be noticed
+        # by the next command
+        ip = self.net["netperssvcmap"].subnet()[0].ip
+        self.noouttest(["unmap", "service", "--networkip", ip,
+                        "--service", "scope_test", "--instance", "scope-network",
+                        "--personality", "utpers-dev",
+                        "--archetype", "aquilon"])
+
+        command = ["make", "--hostname", "netmap-pers.aqd-unittest.ms.com"]
+        out = self.statustest(command)
+        self.matchoutput(out,
+                         "removing binding for service instance scope_test/scope-network",
+                         command)
+        self.matchoutput(out,
+                         "adding binding for service instance scope_test/target-personality",
+                         command)
+
+    def test_128_remap_network_rebind(self):
+        ip = self.net["netperssvcmap"].subnet()[0].ip
+        self.noouttest(["map", "service", "--networkip", ip,
+                        "--service", "scope_test", "--instance", "scope-network",
+                        "--personality", "utpers-dev",
+                        "--archetype", "aquilon"])
+
+        command = ["make", "--hostname", "netmap-pers.aqd-unittest.ms.com"]
+        out = self.statustest(command)
+        self.matchoutput(out,
+                         "removing binding for service instance scope_test/target-personality",
+                         command)
+        self.matchoutput(out,
+                         "adding binding for service instance scope_test/scope-network",
+                         command)
+
+        command = "show host --hostname netmap-pers.aqd-unittest.ms.com"
+        out = self.commandtest(command.split(" "))
+        self.matchoutput(out,
+                         "Uses Service: scope_test Instance: scope-network",
+                         command)
+
     def test_130_make_vm_hosts(self):
         for i in range(1, 6):
             command = ["make", "--hostname", "evh%s.aqd-unittest.ms.com" % i,
@@ -60,6 +60,11 @@ class TestPollNetworkDevice(TestBrokerCommand):
         err = self.statustest(command)
         self.matchoutput(err, "No jump host for np06bals03.ms.com, running "
                          "discovery from %s." % socket.gethostname(), command)
+        self.searchoutput(err,
+                          r"Polled .* np06bals03\.ms\.com: \d+ MAC entries, "
+                          r"\d+ new, \d+ updated; discovery took [0-9.]+s, "
+                          r"updating the database took [0-9.]+s\.",
+                          command)
 
     # Tests re-polling np06bals03 and polls np06fals01
     def testpollnp7(self):
@@ -405,6 +405,7 @@ class TestReconfigure(VerifyGrnsMixin, VerifyNotificationsMixin,
         self.assertTrue(os.path.exists(
             self.build_profile_name("unittest01.one-nyp.ms.com",
                                     domain="unittest")))
+        self.wait_index("unittest01.one-nyp.ms.com")
 
     def test_1074_make_noncompileable(self):
         self.statustest(["reconfigure", "--hostname", "unittest01.one-nyp.ms.com",
@@ -413,6 +414,9 @@ class TestReconfigure(VerifyGrnsMixin, VerifyNotificationsMixin,
         self.assertFalse(os.path.exists(
             self.build_profile_name("unittest01.one-nyp.ms.com",
                                     domain="unittest")))
+        # The profile was removed without compiling anything, but it must
+        # still disappear from the index
+        self.wait_index("unittest01.one-nyp.ms.com", present=False)
         self.statustest(["manage", "--hostname", "unittest01.one-nyp.ms.com",
                          "--domain", "ut-prod", "--force"])
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the show host command."""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from brokertest import TestBrokerCommand
+
+
+class TestShowHost(TestBrokerCommand):
+
+    def test_100_all_streamed(self):
+        # The raw and CSV outputs are larger than stream_chunk_size, so they
+        # are sent in multiple chunks. The protobuf output is never streamed,
+        # so it can serve as the reference.
+        chunk_size = self.config.getint("broker", "stream_chunk_size")
+        command = ["show_host", "--all"]
+        hostlist = self.protobuftest(command + ["--format", "proto"])
+        expected = [host_msg.hostname for host_msg in hostlist]
+
+        raw = self.commandtest(command)
+        self.assertTrue(len(raw) > chunk_size,
+                        "The output of %s is too small to be streamed." %
+                        command)
+        self.assertEqual(raw.splitlines(), expected)
+
+        out = self.commandtest(command + ["--format", "csv"])
+        self.assertEqual(out.splitlines(), expected)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestShowHost)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the show result cache stats command."""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from brokertest import TestBrokerCommand
+
+
+class TestShowResultCacheStats(TestBrokerCommand):
+
+    def test_100_show_result_cache_stats(self):
+        command = ["show_result_cache_stats"]
+        out = self.commandtest(command)
+        self.matchoutput(out, "Result Cache: disabled", command)
+
+    def test_110_show_result_cache_stats_csv(self):
+        command = ["show_result_cache_stats", "--format", "csv"]
+        out = self.commandtest(command)
+        self.matchoutput(out, "False,0,0,0,0,0,0,0", command)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestShowResultCacheStats)
+    unittest.TextTestRunner(verbosity=2).run(suite)
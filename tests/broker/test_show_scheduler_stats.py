@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the show scheduler stats command."""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from brokertest import TestBrokerCommand
+
+
+class TestShowSchedulerStats(TestBrokerCommand):
+
+    def test_100_show_scheduler_stats(self):
+        command = ["show_scheduler_stats"]
+        out = self.commandtest(command)
+        for name in ("readonly", "lockfree", "plenary", "compile"):
+            self.matchoutput(out, "Request Class: %s" % name, command)
+        self.searchoutput(out,
+                          r'Request Class: readonly\s*'
+                          r'Threads: \d+\s*'
+                          r'Running: 0\s*'
+                          r'Queued: 0 \(0 users\)\s*'
+                          r'Started: [1-9]\d*\s*'
+                          r'Rejected: 0\s*'
+                          r'Wait Time: avg [0-9.]+s, max [0-9.]+s\s*',
+                          command)
+
+    def test_110_show_scheduler_stats_csv(self):
+        command = ["show_scheduler_stats", "--format", "csv"]
+        out = self.commandtest(command)
+        self.searchoutput(out, r'^readonly,\d+,0,0,0,[1-9]\d*,0,[0-9.]+,[0-9.]+$',
+                          command)
+        self.searchoutput(out, r'^compile,\d+,0,0,0,[1-9]\d*,0,[0-9.]+,[0-9.]+$',
+                          command)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestShowSchedulerStats)
+    unittest.TextTestRunner(verbosity=2).run(suite)
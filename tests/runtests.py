@@ -40,6 +40,7 @@ from verbose_text_test import VerboseTextTestRunner
 
 from broker.orderedsuite import BrokerTestSuite
 from aqdb.orderedsuite import DatabaseTestSuite
+from unit.orderedsuite import UnitTestSuite
 
 default_configfile = os.path.join(BINDIR, "unittest.conf")
 
@@ -206,6 +207,7 @@ os.environ["AQTEST_DSDB_COVERAGE_DIR"] = dsdb_coverage_dir
 suite = unittest.TestSuite()
 # Relies on the oracle rebuild doing a nuke first.
 suite.addTest(DatabaseTestSuite())
+suite.addTest(UnitTestSuite())
 suite.addTest(BrokerTestSuite())
 result = VerboseTextTestRunner(verbosity=opts.verbose).run(suite)
 sys.exit(not result.wasSuccessful())
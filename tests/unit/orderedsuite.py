@@ -0,0 +1,70 @@
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Module for running the unit tests of the broker internals.
+
+Unlike the broker tests, these tests do not need a running broker, and they
+can be run in any order.
+"""
+
+from __future__ import absolute_import
+
+import unittest
+
+from .test_locks import TestLockQueue
+from .test_interface import TestAllocateMacs
+from .test_processes import TestRunCommand, TestRunParallel, TestPollDiscover
+from .test_dsdb import TestDSDBBatch
+from .test_notify import TestHostResolver, TestSendNotification
+from .test_service_map import TestServiceMapIndex
+from .test_manifest import TestPlenaryManifest
+from .test_preload import TestPreloadHosts
+from .test_formats import TestStringAttributeQuery
+from .test_xtn import TestAuditWriter
+from .test_result_cache import TestResultCache, TestResultCacheExporter
+from .test_db_factory import TestReplica, TestStatementStats
+from .test_scheduler import (TestRequestQueue, TestScheduleRender,
+                             TestRequestClass)
+
+
+class UnitTestSuite(unittest.TestSuite):
+    """Collect the unit tests of the broker internals."""
+
+    def __init__(self, *args, **kwargs):
+        unittest.TestSuite.__init__(self, *args, **kwargs)
+        for test in [TestLockQueue,
+                     TestAllocateMacs,
+                     TestRunCommand,
+                     TestRunParallel,
+                     TestPollDiscover,
+                     TestDSDBBatch,
+                     TestHostResolver,
+                     TestSendNotification,
+                     TestServiceMapIndex,
+                     TestPlenaryManifest,
+                     TestPreloadHosts,
+                     TestStringAttributeQuery,
+                     TestAuditWriter,
+                     TestResultCache,
+                     TestResultCacheExporter,
+                     TestReplica,
+                     TestStatementStats,
+                     TestRequestQueue,
+                     TestScheduleRender,
+                     TestRequestClass,
+                     ]:
+            self.addTest(unittest.TestLoader().loadTestsFromTestCase(test))
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the database factory and the SQL statistics."""
+
+from datetime import timedelta
+import logging
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import time
+import unittest
+from uuid import uuid4
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from six.moves.configparser import RawConfigParser  # pylint: disable=F0401
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, scoped_session, object_session
+
+from aquilon.config import Config
+from aquilon.exceptions_ import ArgumentError
+from aquilon.aqdb.db_factory import (DbFactory, StatementStats, call_site,
+                                     stats_start, stats_stop)
+from aquilon.aqdb.model import (Xtn, XtnEnd, XtnDetail, Realm, Role,
+                                UserPrincipal)
+from aquilon.aqdb.model.xtn import utcnow
+from aquilon.worker import result_cache
+from aquilon.worker.broker import BrokerCommand
+from aquilon.worker.logger import RequestLogger
+from aquilon.worker.result_cache import ResultCache
+
+
+class FakeAuthorization(object):
+
+    def check(self, **_):
+        pass
+
+
+class FakeFormatter(object):
+
+    def format(self, style, result, request):
+        return ",".join(result) + "\n"
+
+
+class FakeStatus(object):
+
+    def __init__(self):
+        self.requestid = uuid4()
+        self.user = "user@example.realm"
+        self.command = "show_role"
+
+
+class FakeRequest(object):
+
+    path = "/role"
+
+    def __init__(self):
+        self.status = FakeStatus()
+
+
+class RoleList(BrokerCommand):
+    """Run the real invoke_render(), with the given DbFactory."""
+
+    requires_readonly = True
+    requires_format = True
+    cache_dependencies = (Role,)
+    _is_lock_free = False
+
+    def __init__(self, dbf):  # pylint: disable=W0231
+        self.dbf = dbf
+        self.config = Config()
+        self.az = FakeAuthorization()
+        self.formatter = FakeFormatter()
+        self.audit_writer = None
+        self.audit_statement_stats = False
+        self.statement_budget = None
+        self.command = self.action = "show_role"
+
+    def render(self, session, **_):
+        return [dbrole.name for dbrole in
+                session.query(Role).order_by(Role.name)]
+
+
+class RoleLookup(RoleList):
+    """Look up the roles one by one, and optionally fail afterwards."""
+
+    cache_dependencies = ()
+    names = ()
+    error = None
+
+    def render(self, session, **_):
+        result = [Role.get_unique(session, name, compel=True).name
+                  for name in self.names]
+        if self.error:
+            raise self.error
+        return result
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Primary and replica databases, with the schema used by the tests."""
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="replica_")
+        self.primary_dsn = "sqlite:///" + os.path.join(self.tmpdir,
+                                                       "primary.db")
+        self.replica_dsn = "sqlite:///" + os.path.join(self.tmpdir,
+                                                       "replica.db")
+        self.engines = []
+        self.primary = self.make_db(self.primary_dsn)
+        self.replica = self.make_db(self.replica_dsn)
+
+        self.config = RawConfigParser()
+        self.config.add_section("database")
+        self.config.set("database", "replica_max_lag", "10")
+        # Checks are forced by the tests by resetting replica_checked
+        self.config.set("database", "replica_check_interval", "3600")
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+        rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_db(self, dsn):
+        engine = create_engine(dsn)
+        for table in [Xtn.__table__, XtnEnd.__table__, XtnDetail.__table__,
+                      Realm.__table__, Role.__table__,
+                      UserPrincipal.__table__]:
+            table.create(engine)
+        self.engines.append(engine)
+        return engine
+
+    def make_factory(self, replica_dsn=None):
+        # DbFactory shares its state between all instances, and the shared
+        # instance belongs to the test configuration. Build a private one
+        # without going through __init__().
+        dbf = object.__new__(DbFactory)
+        dbf.verbose = False
+        dbf.engine = self.primary
+        dbf.setup_replica(self.config, replica_dsn or self.replica_dsn, {})
+        self.engines.append(dbf.replica_engine)
+        return dbf
+
+    def add_xtn(self, engine, age=0):
+        engine.execute(Xtn.__table__.insert(),
+                       {"id": uuid4(), "command": "show_host",
+                        "username": "user", "is_readonly": True,
+                        "start_time": utcnow(None) - timedelta(seconds=age)})
+
+    def add_user(self):
+        # The same user exists in both databases
+        for engine in [self.primary, self.replica]:
+            engine.execute(Realm.__table__.insert(),
+                           {"id": 1, "name": "example.realm", "trusted": True})
+            engine.execute(Role.__table__.insert(),
+                           {"id": 2, "name": "operations"})
+            engine.execute(UserPrincipal.__table__.insert(),
+                           {"id": 3, "name": "user", "realm_id": 1,
+                            "role_id": 2})
+
+    def run_command(self, command, request=None, logger=None):
+        request = request or FakeRequest()
+        return command.invoke_render(user=request.status.user,
+                                     request=request,
+                                     requestid=request.status.requestid,
+                                     logger=logger or RequestLogger(),
+                                     style="raw")
+
+
+class TestReplica(ReplicaTestCase):
+
+    def recheck(self, dbf):
+        dbf.replica_checked = 0
+        return dbf.replica_session()
+
+    def test_100_in_sync(self):
+        self.add_xtn(self.primary)
+        self.add_xtn(self.replica)
+        dbf = self.make_factory()
+
+        session = dbf.replica_session()
+        self.assertTrue(session is not None)
+        self.assertTrue(session.bind is dbf.replica_engine)
+        self.assertTrue(dbf.replica_usable)
+        dbf.ReplicaSession.remove()
+
+    def test_110_empty(self):
+        # Nothing to compare, the replica is as good as the primary
+        dbf = self.make_factory()
+        self.assertTrue(dbf.replica_session() is not None)
+        dbf.ReplicaSession.remove()
+
+    def test_200_lag_fallback(self):
+        self.add_xtn(self.primary)
+        self.add_xtn(self.replica, age=60)
+        dbf = self.make_factory()
+        self.assertTrue(dbf.replica_session() is None)
+        self.assertFalse(dbf.replica_usable)
+
+        # The result of the check is kept until the interval expires
+        self.add_xtn(self.replica)
+        self.assertTrue(dbf.replica_session() is None)
+
+        # Once the replica catches up, it is used again
+        self.assertTrue(self.recheck(dbf) is not None)
+        dbf.ReplicaSession.remove()
+
+        # Within the allowed lag
+        self.add_xtn(self.primary, age=-5)
+        self.assertTrue(self.recheck(dbf) is not None)
+        dbf.ReplicaSession.remove()
+
+    def test_210_replica_has_no_xtn(self):
+        self.add_xtn(self.primary)
+        dbf = self.make_factory()
+        self.assertTrue(dbf.replica_session() is None)
+
+    def test_300_unreachable(self):
+        self.add_xtn(self.primary)
+        missing = "sqlite:///" + os.path.join(self.tmpdir, "missing",
+                                              "replica.db")
+        dbf = self.make_factory(replica_dsn=missing)
+        self.assertTrue(dbf.replica_session() is None)
+        self.assertFalse(dbf.replica_usable)
+
+    def test_400_merge_user(self):
+        self.add_user()
+        dbf = self.make_factory()
+
+        session = sessionmaker(bind=self.primary)()
+        dbuser = session.query(UserPrincipal).filter_by(name="user").one()
+        self.assertEqual(dbuser.role.name, "operations")
+
+        # Same sequence as in BrokerCommand.invoke_render(): copy the user,
+        # then commit the primary session, which expires the original
+        replica_session = dbf.replica_session()
+        self.assertTrue(replica_session is not None)
+        replica_user = replica_session.merge(dbuser, load=False)
+        session.commit()
+        session.close()
+
+        self.assertTrue(object_session(replica_user) is replica_session)
+        self.assertEqual(replica_user.id, 3)
+        self.assertEqual(replica_user.name, "user")
+        self.assertEqual(replica_user.role.name, "operations")
+        self.assertEqual(replica_user.realm.name, "example.realm")
+        dbf.ReplicaSession.remove()
+
+    def test_500_result_cache_lag(self):
+        self.add_user()
+        self.add_xtn(self.primary)
+        self.add_xtn(self.replica)
+        dbf = self.make_factory()
+        dbf.Session = scoped_session(sessionmaker(bind=self.primary))
+        command = RoleList(dbf)
+
+        cache = ResultCache(10, 1 << 20, 3600)
+        saved_cache = result_cache._result_cache
+        result_cache._result_cache = cache
+        try:
+            self.assertEqual(self.run_command(command), "operations\n")
+            self.assertTrue(dbf.replica_usable)
+
+            # Another command commits a change to the primary database, which
+            # did not reach the replica yet
+            self.primary.execute(Role.__table__.insert(),
+                                 {"id": 4, "name": "engineering"})
+            cache.invalidate(Role)
+            self.add_xtn(self.primary)
+
+            # The replica is still within the allowed lag, and the stale
+            # result must not be kept
+            self.assertEqual(self.run_command(command), "operations\n")
+            self.assertEqual(cache.stores, 0)
+
+            # Once the replica catches up, the change shows up
+            self.replica.execute(Role.__table__.insert(),
+                                 {"id": 4, "name": "engineering"})
+            self.assertEqual(self.run_command(command),
+                             "engineering,operations\n")
+            self.assertEqual(cache.hits, 0)
+
+            # Results computed on the primary database are kept
+            dbf.replica_usable = False
+            self.assertEqual(self.run_command(command),
+                             "engineering,operations\n")
+            self.assertEqual(cache.stores, 1)
+            self.assertEqual(self.run_command(command),
+                             "engineering,operations\n")
+            self.assertEqual(cache.hits, 1)
+        finally:
+            result_cache._result_cache = saved_cache
+            dbf.Session.remove()
+
+
+class TestStatementStats(ReplicaTestCase):
+
+    def setUp(self):
+        super(TestStatementStats, self).setUp()
+        self.add_user()
+        for engine in [self.primary, self.replica]:
+            engine.execute(Role.__table__.insert(),
+                           [{"id": 4, "name": "engineering"},
+                            {"id": 5, "name": "nobody"}])
+            event.listen(engine, "before_cursor_execute", stats_start)
+            event.listen(engine, "after_cursor_execute", stats_stop)
+        self.session = sessionmaker(bind=self.primary)()
+
+    def tearDown(self):
+        self.session.close()
+        super(TestStatementStats, self).tearDown()
+
+    def lookup_roles(self, *names):
+        return [Role.get_unique(self.session, name, compel=True)
+                for name in names]
+
+    def role_lookups(self, stats):
+        return sum(stmt_stats[0]
+                   for statement, stmt_stats in stats.statements.items()
+                   if "WHERE role.name = ?" in statement)
+
+    def messages(self, handler, prefix):
+        return len([msg for msg in handler.messages
+                    if msg.startswith(prefix)])
+
+    def make_command(self, names, statement_budget=None):
+        self.add_xtn(self.primary)
+        self.add_xtn(self.replica)
+        dbf = self.make_factory()
+        dbf.Session = scoped_session(sessionmaker(bind=self.primary))
+        self.addCleanup(dbf.Session.remove)
+        command = RoleLookup(dbf)
+        command.names = names
+        command.statement_budget = statement_budget
+        return command
+
+    def test_100_repeated(self):
+        with StatementStats() as stats:
+            self.lookup_roles("operations", "engineering", "nobody")
+            self.session.query(Realm).all()
+
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.repeated, 2)
+        self.assertEqual(len(stats.statements), 2)
+        self.assertEqual(stats.audit_results()[:2],
+                         [("sql_statements", 4), ("sql_repeated", 2)])
+
+        # Statements executed only once are not offenders
+        offenders = stats.worst_offenders(5)
+        self.assertEqual(len(offenders), 1)
+        count, _, caller, statement = offenders[0]
+        self.assertEqual(count, 3)
+        self.assertIn("FROM role", statement)
+        # The call site is in our code, not in SQLAlchemy
+        self.assertIn("/aquilon/aqdb/model/base.py:", caller)
+        self.assertTrue(caller.endswith(" (get_unique)"), caller)
+
+    def test_110_call_site_outside_aquilon(self):
+        # The test itself is not part of the aquilon package
+        if "/aquilon/" not in __file__:
+            self.assertEqual(call_site(), "unknown")
+
+    def test_120_nested(self):
+        outer = StatementStats()
+        outer.start()
+        try:
+            self.lookup_roles("operations")
+            with StatementStats() as inner:
+                self.lookup_roles("engineering", "nobody")
+            self.lookup_roles("nobody")
+        finally:
+            outer.stop()
+        self.lookup_roles("operations")
+
+        self.assertEqual(inner.count, 2)
+        self.assertEqual(outer.count, 2)
+
+    def test_130_failed_statement(self):
+        with StatementStats() as stats:
+            self.assertRaises(OperationalError, self.session.execute,
+                              "SELECT * FROM no_such_table")
+            self.session.rollback()
+            time.sleep(0.2)
+            self.lookup_roles("operations")
+
+        # The failed statement is not counted, and does not leave a start
+        # time behind for the next statement
+        self.assertEqual(stats.count, 1)
+        self.assertNotIn("SELECT * FROM no_such_table", stats.statements)
+        self.assertTrue(stats.total_time < 0.2, stats.total_time)
+
+    def test_200_budget_exceeded(self):
+        command = self.make_command(["operations", "engineering", "nobody"],
+                                    statement_budget=2)
+        logger = RequestLogger()
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        self.assertEqual(self.run_command(command, logger=logger),
+                         "operations,engineering,nobody\n")
+
+        # The summary is logged at debug level, and once more with the
+        # budget, followed by the statements executed more than once
+        exceeded = [msg for msg in handler.messages
+                    if msg.endswith(", exceeding the budget of 2.")]
+        self.assertEqual(len(exceeded), 1)
+        self.assertTrue(exceeded[0].startswith("Command show_role executed 3 "
+                                               "SQL statements (2 repeated) "),
+                        exceeded[0])
+        offenders = [msg for msg in handler.messages if msg.startswith("  ")]
+        self.assertEqual(len(offenders), 1)
+        self.assertTrue(offenders[0].startswith("  3 executions, "),
+                        offenders[0])
+        self.assertIn("(get_unique): SELECT ", offenders[0])
+
+    def test_210_within_budget(self):
+        command = self.make_command(["operations", "engineering", "nobody"],
+                                    statement_budget=3)
+        logger = RequestLogger()
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        self.run_command(command, logger=logger)
+
+        self.assertEqual(self.messages(handler, "Command show_role executed 3 "
+                                                "SQL statements (2 repeated)"),
+                         1)
+        self.assertEqual(self.messages(handler, "  "), 0)
+        for msg in handler.messages:
+            self.assertNotIn("exceeding the budget", msg)
+
+    def test_220_command_fails(self):
+        command = self.make_command(["operations", "engineering"])
+        command.audit_statement_stats = True
+        command.error = ArgumentError("Bad role.")
+        request = FakeRequest()
+
+        logger = RequestLogger()
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+
+        with StatementStats() as outer:
+            self.assertRaises(ArgumentError, self.run_command, command,
+                              request=request, logger=logger)
+            # The statistics of the command are stopped even though it
+            # failed: the outer object saw the audit records written by the
+            # broker, but not the statements of render(), and it is active
+            # again
+            self.assertEqual(self.role_lookups(outer), 0)
+            self.lookup_roles("operations")
+            self.assertEqual(self.role_lookups(outer), 1)
+
+        self.assertIn(("sql_statements", 2), request._audit_result)
+        self.assertIn(("sql_repeated", 1), request._audit_result)
+        self.assertIn("ArgumentError: Bad role.", handler.messages)
+        self.assertEqual(self.messages(handler, "Command show_role executed 2 "
+                                                "SQL statements (1 repeated)"),
+                         1)
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    for test in [TestReplica, TestStatementStats]:
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(test))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing running DSDB actions in batch mode."""
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from aquilon.exceptions_ import AquilonError, ArgumentError, ProcessException
+from aquilon.worker.processes import DSDBBatch, DSDBRunner, CAMPUS_NOT_FOUND
+
+
+class RecordingLogger(object):
+    """Minimal stand-in for the request logger."""
+
+    def __init__(self):
+        self.messages = []
+        self.warnings = []
+
+    def log(self, level, msg, *args):
+        self.messages.append(msg % args if args else msg)
+
+    def info(self, msg, *args):
+        self.messages.append(msg % args if args else msg)
+
+    def client_info(self, msg, *args):
+        self.messages.append(msg % args if args else msg)
+
+    def warning(self, msg, *args):
+        self.warnings.append(msg % args if args else msg)
+
+
+class TestDSDBBatch(unittest.TestCase):
+    """
+    Run DSDB actions through fake_dsdb --batch.
+
+    The test configuration runs DSDB actions one process at a time, so the
+    batch mode is enabled explicitely on the runners created here.
+    """
+
+    def setUp(self):
+        self.coverage_dir = mkdtemp(prefix="dsdb_batch_")
+        self.old_coverage_dir = os.environ.get("AQTEST_DSDB_COVERAGE_DIR")
+        os.environ["AQTEST_DSDB_COVERAGE_DIR"] = self.coverage_dir
+        self.logger = RecordingLogger()
+
+    def tearDown(self):
+        if self.old_coverage_dir is None:
+            del os.environ["AQTEST_DSDB_COVERAGE_DIR"]
+        else:
+            os.environ["AQTEST_DSDB_COVERAGE_DIR"] = self.old_coverage_dir
+        rmtree(self.coverage_dir, ignore_errors=True)
+
+    def expect(self, command, fail=False, errstr=""):
+        if fail:
+            filename = "fail_expected_dsdb_cmds"
+        else:
+            filename = "expected_dsdb_cmds"
+        with open(os.path.join(self.coverage_dir, filename), "a") as fp:
+            fp.write(command + "\n")
+        if errstr:
+            with open(os.path.join(self.coverage_dir,
+                                   "fail_expected_dsdb_error"), "w") as fp:
+                fp.write(errstr)
+
+    def read_lines(self, filename):
+        try:
+            with open(os.path.join(self.coverage_dir, filename)) as fp:
+                return [line.rstrip("\n") for line in fp]
+        except IOError:
+            return []
+
+    def make_runner(self):
+        runner = DSDBRunner(logger=self.logger)
+        runner.use_batch = True
+        return runner
+
+    def make_tool(self, script):
+        path = os.path.join(self.coverage_dir, "fake_batch_tool")
+        with open(path, "w") as fp:
+            fp.write("#!/bin/sh\n" + script)
+        os.chmod(path, 0o755)
+        return path
+
+    def test_100_commit(self):
+        self.expect("add_city_aq -city_symbol ab -country_symbol us "
+                    "-city_name Some City")
+        self.expect("add_campus_aq -campus_name cd")
+        runner = self.make_runner()
+        runner.add_action(["add_city_aq", "-city_symbol", "ab",
+                           "-country_symbol", "us", "-city_name", "Some City"],
+                          ["delete_city_aq", "-city", "ab"])
+        runner.add_action(["add_campus_aq", "-campus_name", "cd"],
+                          ["delete_campus_aq", "-campus", "cd"])
+        runner.commit()
+
+        self.assertEqual(self.read_lines("issued_dsdb_cmds"),
+                         ["add_city_aq -city_symbol ab -country_symbol us "
+                          "-city_name Some City",
+                          "add_campus_aq -campus_name cd"])
+        self.assertEqual(len(self.read_lines("issued_dsdb_batches")), 1)
+        self.assertEqual(runner.rollback_list,
+                         [["delete_city_aq", "-city", "ab"],
+                          ["delete_campus_aq", "-campus", "cd"]])
+
+    def test_110_output(self):
+        self.expect("show_campus -campus_name cd", fail=True,
+                    errstr="Some output\n")
+        with DSDBBatch(logger=self.logger) as batch:
+            with self.assertRaises(ProcessException) as cm:
+                batch.run(["show_campus", "-campus_name", "cd"])
+            # The process must survive a failed action
+            self.expect("add_campus_aq -campus_name cd")
+            self.assertEqual(batch.run(["add_campus_aq", "-campus_name",
+                                        "cd"]), "")
+        self.assertEqual(cm.exception.code, 255)
+        self.assertEqual(cm.exception.out, "Some output\n")
+        self.assertEqual(len(self.read_lines("issued_dsdb_batches")), 1)
+
+    def test_200_rollback(self):
+        self.expect("add_city_aq -city_symbol ab -country_symbol us "
+                    "-city_name ab")
+        self.expect("add_campus_aq -campus_name cd")
+        self.expect("delete_campus_aq -campus ef", fail=True,
+                    errstr="campus ef doesn't exist")
+        self.expect("delete_campus_aq -campus cd")
+        self.expect("delete_city_aq -city ab")
+        runner = self.make_runner()
+        runner.add_action(["add_city_aq", "-city_symbol", "ab",
+                           "-country_symbol", "us", "-city_name", "ab"],
+                          ["delete_city_aq", "-city", "ab"])
+        runner.add_action(["add_campus_aq", "-campus_name", "cd"],
+                          ["delete_campus_aq", "-campus", "cd"])
+        # Fails, but the error is filtered
+        runner.add_action(["delete_campus_aq", "-campus", "ef"], None,
+                          CAMPUS_NOT_FOUND, "Campus ef is not in DSDB.")
+        # Fails, and triggers the rollback
+        runner.add_action(["update_city_aq", "-city", "ab", "-campus", "gh"],
+                          ["update_city_aq", "-city", "ab", "-campus", "ij"])
+
+        with self.assertRaises(ArgumentError):
+            runner.commit_or_rollback("Adding the city failed.")
+
+        self.assertEqual(self.read_lines("issued_dsdb_cmds"),
+                         ["add_city_aq -city_symbol ab -country_symbol us "
+                          "-city_name ab",
+                          "add_campus_aq -campus_name cd",
+                          "delete_campus_aq -campus ef",
+                          "update_city_aq -city ab -campus gh",
+                          "delete_campus_aq -campus cd",
+                          "delete_city_aq -city ab"])
+        # One batch for the commit, one for the rollback
+        self.assertEqual(len(self.read_lines("issued_dsdb_batches")), 2)
+        self.assertIn("Campus ef is not in DSDB.", self.logger.warnings)
+        self.assertIn("DSDB rollback completed.", self.logger.messages)
+        self.assertEqual(runner.rollback_list, [])
+
+    def test_210_rollback_failure(self):
+        self.expect("add_campus_aq -campus_name cd")
+        self.expect("add_campus_aq -campus_name ef")
+        self.expect("delete_campus_aq -campus cd")
+        runner = self.make_runner()
+        runner.add_action(["add_campus_aq", "-campus_name", "cd"],
+                          ["delete_campus_aq", "-campus", "cd"])
+        runner.add_action(["add_campus_aq", "-campus_name", "ef"],
+                          ["delete_campus_aq", "-campus", "ef"])
+        runner.commit()
+
+        # The rollback of ef fails, the rollback of cd must still run
+        with self.assertRaises(AquilonError) as cm:
+            runner.rollback()
+        self.assertIn("DSDB rollback failed", str(cm.exception))
+        self.assertIn("delete_campus_aq -campus ef", str(cm.exception))
+        self.assertEqual(self.read_lines("issued_dsdb_cmds")[2:],
+                         ["delete_campus_aq -campus ef",
+                          "delete_campus_aq -campus cd"])
+
+    def test_300_bad_return_code(self):
+        tool = self.make_tool('while read -r line; do\n'
+                              '\techo "@@DSDB_STDERR@@"\n'
+                              '\techo "@@DSDB_RC@@ bogus"\n'
+                              'done\n')
+        with DSDBBatch(logger=self.logger) as batch:
+            batch.tool = tool
+            with self.assertRaises(ProcessException) as cm:
+                batch.run(["add_campus_aq", "-campus_name", "cd"])
+        self.assertIn("Invalid return code: 'bogus'", str(cm.exception))
+
+    def test_310_unexpected_exit(self):
+        tool = self.make_tool("exit 0\n")
+        with DSDBBatch(logger=self.logger) as batch:
+            batch.tool = tool
+            with self.assertRaises(ProcessException):
+                batch.run(["add_campus_aq", "-campus_name", "cd"])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDSDBBatch)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing streaming the output of commands."""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from aquilon.aqdb.model import Realm, Role, UserPrincipal
+from aquilon.worker.formats.formatters import ResponseFormatter
+from aquilon.worker.formats.list import StringAttributeQuery
+
+
+class TestStringAttributeQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        for table in [Realm.__table__, Role.__table__,
+                      UserPrincipal.__table__]:
+            table.create(self.engine)
+        self.engine.execute(Realm.__table__.insert(),
+                            {"id": 1, "name": "example.realm",
+                             "trusted": True})
+        self.names = ["role%02d" % i for i in range(50)]
+        self.engine.execute(Role.__table__.insert(),
+                            [{"id": i + 1, "name": name}
+                             for i, name in enumerate(self.names)])
+        self.session = sessionmaker(bind=self.engine)()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def stream(self, result, chunk_size=40):
+        return ResponseFormatter().format_stream("raw", result, None,
+                                                 chunk_size=chunk_size)
+
+    def test_100_output(self):
+        q = self.session.query(Role).order_by(Role.name)
+        result = StringAttributeQuery(q, "name", batch_size=7)
+        self.assertEqual("".join(self.stream(result)), "\n".join(self.names))
+        self.assertEqual(ResponseFormatter().format("raw", result, None),
+                         "\n".join(self.names))
+
+    def test_110_loaded_while_streaming(self):
+        q = self.session.query(Role).order_by(Role.name)
+        chunks = self.stream(StringAttributeQuery(q, "name", batch_size=5))
+        first = next(chunks)
+        self.assertTrue(first.startswith("role00\nrole01"))
+
+        # Objects already formatted are not kept alive
+        self.assertTrue(len(self.session.identity_map) < len(self.names))
+        self.assertEqual(first + "".join(chunks), "\n".join(self.names))
+
+    def test_200_duplicates(self):
+        # Every role has three users, so the join returns every role three
+        # times, in batches which do not line up with the duplicates
+        self.engine.execute(UserPrincipal.__table__.insert(),
+                            [{"id": i + 1, "name": "user%d" % i,
+                              "realm_id": 1, "role_id": i % 50 + 1}
+                             for i in range(150)])
+        q = self.session.query(Role)
+        q = q.join(UserPrincipal, UserPrincipal.role_id == Role.id)
+        q = q.order_by(Role.name)
+        result = StringAttributeQuery(q, "name", batch_size=4)
+        self.assertEqual("".join(self.stream(result)), "\n".join(self.names))
+
+    def test_300_empty(self):
+        q = self.session.query(Role).filter(Role.name == "no-such-role")
+        self.assertEqual("".join(self.stream(StringAttributeQuery(q, "name"))),
+                         "")
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStringAttributeQuery)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the allocation of MAC addresses."""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from six.moves.configparser import RawConfigParser  # pylint: disable=F0401
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from aquilon.exceptions_ import ArgumentError
+from aquilon.aqdb.model import Interface
+from aquilon.aqdb.types import MACAddress
+from aquilon.worker.dbwrappers.interface import allocate_macs
+
+MAC_START = MACAddress("02:00:00:00:00:00").value
+
+
+class TestAllocateMacs(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Interface.__table__.create(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.next_hw_id = 1
+
+        # Use a small range, so running out of addresses is easy to test
+        self.config = RawConfigParser()
+        self.config.add_section("broker")
+        self.config.set("broker", "auto_mac_start",
+                        str(MACAddress(value=MAC_START)))
+        self.config.set("broker", "auto_mac_end",
+                        str(MACAddress(value=MAC_START + 15)))
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def add_interfaces(self, *offsets):
+        for offset in offsets:
+            self.session.execute(Interface.__table__.insert().values(
+                name="eth0", mac=MACAddress(value=MAC_START + offset),
+                model_id=1, interface_type="public", bootable=False,
+                default_route=False, hardware_entity_id=self.next_hw_id))
+            self.next_hw_id += 1
+
+    def allocate(self, count=1):
+        macs = allocate_macs(self.session, self.config, count=count)
+        return [mac.value - MAC_START for mac in macs]
+
+    def free_mac_index(self):
+        keys = [key for key in self.session.info
+                if isinstance(key, tuple) and key[0] == "free_macs"]
+        self.assertTrue(len(keys) <= 1)
+        return self.session.info[keys[0]] if keys else None
+
+    def test_100_several_after_max_used(self):
+        self.add_interfaces(0, 1, 5)
+        self.assertEqual(self.allocate(count=3), [6, 7, 8])
+
+    def test_110_several_wrap_around(self):
+        # Once the end of the range is in use, the holes are filled from the
+        # bottom
+        self.add_interfaces(0, 2, 15)
+        self.assertEqual(self.allocate(count=3), [1, 3, 4])
+
+    def test_120_exhausted(self):
+        self.add_interfaces(*range(0, 14))
+        self.assertRaises(ArgumentError, self.allocate, count=3)
+
+    def test_200_twice_in_one_transaction(self):
+        self.add_interfaces(0, 1)
+        self.assertEqual(self.allocate(), [2])
+        index = self.free_mac_index()
+        self.assertTrue(index is not None)
+
+        # The first address was not stored in the database, but the index
+        # kept in the session must remember that it was handed out
+        self.assertEqual(self.allocate(count=2), [3, 4])
+        self.assertTrue(self.free_mac_index() is index)
+
+    def test_210_explicit_mac_after_index_built(self):
+        self.add_interfaces(0)
+        self.assertEqual(self.allocate(), [1])
+
+        # Someone assigns the next MAC explicitly in the same transaction
+        self.add_interfaces(2)
+        self.assertEqual(self.allocate(), [3])
+
+    def test_220_index_dropped_at_commit(self):
+        self.add_interfaces(0)
+        self.assertEqual(self.allocate(), [1])
+        self.session.commit()
+        self.assertTrue(self.free_mac_index() is None)
+
+        # The next transaction builds a new index from the database, which
+        # does not know about the address handed out but never used
+        self.assertEqual(self.allocate(), [1])
+
+    def test_230_index_kept_after_savepoint(self):
+        self.add_interfaces(0)
+        self.assertEqual(self.allocate(), [1])
+        index = self.free_mac_index()
+
+        # The lock is held until the end of the outermost transaction
+        self.session.begin_nested()
+        self.session.commit()
+        self.assertTrue(self.free_mac_index() is index)
+        self.assertEqual(self.allocate(), [2])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAllocateMacs)
+    unittest.TextTestRunner(verbosity=2).run(suite)
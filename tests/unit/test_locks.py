@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the lock queue."""
+
+from threading import Thread
+import time
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from aquilon.locks import LockQueue, LockKey
+
+
+class TestLockQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = LockQueue()
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def make_key(self, exclusive=(), shared=()):
+        key = LockKey(lock_queue=self.queue)
+        for name, item in exclusive:
+            key.exclusive[name].add(item)
+        for name, item in shared:
+            key.shared[name].add(item)
+        key.transition("initialized")
+        return key
+
+    def acquire_async(self, key):
+        thread = Thread(target=self.queue.acquire, args=(key,))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+        # Wait until the key is in the queue
+        deadline = time.time() + 5
+        while key.state == "initialized" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertNotEqual(key.state, "initialized")
+        return thread
+
+    def wait_acquired(self, thread, key):
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "%s was not woken up" % key)
+        self.assertEqual(key.state, "acquired")
+
+    def assertWaiting(self, key):
+        # Give a wrongly woken up thread the chance to run
+        time.sleep(0.05)
+        self.assertEqual(key.state, "acquiring")
+        self.assertTrue(self.queue.blocked(key))
+
+    def test_100_shared_shared(self):
+        key1 = self.make_key(shared=[("domain", "prod")])
+        key2 = self.make_key(shared=[("domain", "prod")])
+        self.queue.acquire(key1)
+        self.assertFalse(self.queue.blocked(key2))
+        self.queue.acquire(key2)
+        self.assertEqual(key2.state, "acquired")
+        self.assertEqual(self.queue.queue, [key1, key2])
+        self.queue.release(key1)
+        self.queue.release(key2)
+        self.assertEqual(self.queue.queue, [])
+        self.assertEqual(self.queue.exclusive_index, {})
+        self.assertEqual(self.queue.shared_index, {})
+
+    def test_110_exclusive_distinct(self):
+        key1 = self.make_key(exclusive=[("profile", "host1")])
+        key2 = self.make_key(exclusive=[("profile", "host2")])
+        self.queue.acquire(key1)
+        self.assertFalse(self.queue.blocked(key2))
+        self.queue.acquire(key2)
+        self.queue.release(key2)
+        self.queue.release(key1)
+
+    def test_120_exclusive_blocks_shared(self):
+        key1 = self.make_key(exclusive=[("domain", "prod")])
+        key2 = self.make_key(shared=[("domain", "prod")])
+        self.queue.acquire(key1)
+        self.assertTrue(self.queue.blocked(key2))
+        thread = self.acquire_async(key2)
+        self.assertWaiting(key2)
+        self.queue.release(key1)
+        self.wait_acquired(thread, key2)
+        self.queue.release(key2)
+
+    def test_130_shared_blocks_exclusive(self):
+        key1 = self.make_key(shared=[("domain", "prod")])
+        key2 = self.make_key(exclusive=[("domain", "prod")])
+        self.queue.acquire(key1)
+        self.assertTrue(self.queue.blocked(key2))
+        thread = self.acquire_async(key2)
+        self.assertWaiting(key2)
+        self.queue.release(key1)
+        self.wait_acquired(thread, key2)
+        self.queue.release(key2)
+
+    def test_140_same_item_other_namespace(self):
+        key1 = self.make_key(exclusive=[("profile", "prod")])
+        key2 = self.make_key(exclusive=[("domain", "prod")])
+        self.queue.acquire(key1)
+        self.assertFalse(self.queue.blocked(key2))
+        self.queue.acquire(key2)
+        self.queue.release(key1)
+        self.queue.release(key2)
+
+    def test_200_wakeup_order(self):
+        key1 = self.make_key(exclusive=[("profile", "host1")])
+        key2 = self.make_key(exclusive=[("profile", "host1")])
+        key3 = self.make_key(exclusive=[("profile", "host1")])
+        self.queue.acquire(key1)
+        thread2 = self.acquire_async(key2)
+        thread3 = self.acquire_async(key3)
+        self.assertWaiting(key2)
+        self.assertWaiting(key3)
+        self.assertEqual(self.queue.blocked_by[key3], set([key1, key2]))
+
+        # Releasing the first key must wake up only the next one in the queue
+        self.queue.release(key1)
+        self.wait_acquired(thread2, key2)
+        self.assertWaiting(key3)
+
+        self.queue.release(key2)
+        self.wait_acquired(thread3, key3)
+        self.queue.release(key3)
+        self.assertEqual(self.queue.queue, [])
+
+    def test_210_later_key_not_blocked_by_waiter(self):
+        # A later key which does not conflict with anything held may proceed,
+        # even if there is an unrelated waiter queued in front of it
+        key1 = self.make_key(exclusive=[("profile", "host1")])
+        key2 = self.make_key(exclusive=[("profile", "host1")])
+        key3 = self.make_key(exclusive=[("profile", "host2")])
+        self.queue.acquire(key1)
+        thread2 = self.acquire_async(key2)
+        self.assertWaiting(key2)
+        self.queue.acquire(key3)
+        self.assertEqual(key3.state, "acquired")
+        self.queue.release(key3)
+        self.assertWaiting(key2)
+        self.queue.release(key1)
+        self.wait_acquired(thread2, key2)
+        self.queue.release(key2)
+
+    def test_300_release_waiter_with_several_blockers(self):
+        key1 = self.make_key(exclusive=[("profile", "host1")])
+        key2 = self.make_key(exclusive=[("profile", "host2")])
+        key3 = self.make_key(exclusive=[("profile", "host1"),
+                                        ("profile", "host2")])
+        self.queue.acquire(key1)
+        self.queue.acquire(key2)
+        thread3 = self.acquire_async(key3)
+        self.assertWaiting(key3)
+
+        self.queue.release(key2)
+        self.assertWaiting(key3)
+        self.assertEqual(self.queue.blocked_by[key3], set([key1]))
+
+        self.queue.release(key1)
+        self.wait_acquired(thread3, key3)
+        self.assertNotIn(key3, self.queue.blocked_by)
+        self.assertNotIn(key3, self.queue.conditions)
+
+        # Releasing the former waiter must clean up all of its bookkeeping
+        self.queue.release(key3)
+        self.assertEqual(self.queue.queue, [])
+        self.assertEqual(dict(self.queue.waiters), {})
+        self.assertEqual(self.queue.exclusive_index, {})
+
+    def test_310_waiter_of_waiter(self):
+        key1 = self.make_key(exclusive=[("domain", "prod")])
+        key2 = self.make_key(shared=[("domain", "prod")])
+        key3 = self.make_key(shared=[("domain", "prod")])
+        key4 = self.make_key(exclusive=[("domain", "prod")])
+        self.queue.acquire(key1)
+        thread2 = self.acquire_async(key2)
+        thread3 = self.acquire_async(key3)
+        thread4 = self.acquire_async(key4)
+        self.assertWaiting(key4)
+
+        # Both shared waiters get the lock at the same time
+        self.queue.release(key1)
+        self.wait_acquired(thread2, key2)
+        self.wait_acquired(thread3, key3)
+        self.assertWaiting(key4)
+
+        self.queue.release(key3)
+        self.assertWaiting(key4)
+        self.queue.release(key2)
+        self.wait_acquired(thread4, key4)
+        self.queue.release(key4)
+
+    def test_400_stats(self):
+        key = self.make_key(exclusive=[("profile", "host1")],
+                            shared=[("domain", "prod")])
+        with key:
+            pass
+        stats = self.queue.stats.snapshot()
+        self.assertEqual([ns.namespace for ns in stats], ["domain", "profile"])
+        for ns in stats:
+            self.assertEqual(ns.wait.count, 1)
+            self.assertEqual(ns.hold.count, 1)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLockQueue)
+    unittest.TextTestRunner(verbosity=2).run(suite)
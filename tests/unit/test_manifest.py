@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the manifest of plenary templates."""
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from aquilon.worker.templates import manifest
+from aquilon.worker.templates.manifest import (PlenaryManifest, content_digest,
+                                               drop_manifests, get_manifest)
+
+
+class TestPlenaryManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.basedir = os.path.join(self.tmpdir, "plenary")
+        os.mkdir(self.basedir)
+        self.saved_threshold = manifest._COMPACT_THRESHOLD
+
+    def tearDown(self):
+        manifest._COMPACT_THRESHOLD = self.saved_threshold
+        rmtree(self.tmpdir)
+
+    def write(self, mf, name, content):
+        path = os.path.join(self.basedir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        mf.update(path, content)
+        return path
+
+    def journal(self):
+        with open(self.basedir + ".manifest") as f:
+            return f.read().splitlines()
+
+    def test_100_unchanged_file(self):
+        path = self.write(PlenaryManifest(self.basedir), "a.tpl", "content")
+
+        # Use a new instance, so the journal is read back
+        mf = PlenaryManifest(self.basedir)
+        self.assertEqual(mf.lookup(path), content_digest("content"))
+
+    def test_110_outside_of_basedir(self):
+        mf = PlenaryManifest(self.basedir)
+        self.assertEqual(mf.lookup(os.path.join(self.tmpdir, "a.tpl")), None)
+
+    def test_120_changed_behind_our_back(self):
+        mf = PlenaryManifest(self.basedir)
+        path = self.write(mf, "a.tpl", "content")
+        with open(path, "w") as f:
+            f.write("other content")
+        self.assertEqual(mf.lookup(path), None)
+
+        # Once dropped, the entry does not come back, even if the size and
+        # the timestamp happen to match again
+        self.assertNotIn("a.tpl", mf.entries)
+
+        # Writing the file again makes it known again
+        self.write(mf, "a.tpl", "new content")
+        self.assertEqual(mf.lookup(path), content_digest("new content"))
+
+    def test_130_touched_behind_our_back(self):
+        mf = PlenaryManifest(self.basedir)
+        path = self.write(mf, "a.tpl", "content")
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime - 10))
+        self.assertEqual(mf.lookup(path), None)
+
+    def test_140_removed_behind_our_back(self):
+        mf = PlenaryManifest(self.basedir)
+        path = self.write(mf, "a.tpl", "content")
+        os.unlink(path)
+        self.assertEqual(mf.lookup(path), None)
+
+    def test_150_discard(self):
+        mf = PlenaryManifest(self.basedir)
+        path = self.write(mf, "a.tpl", "content")
+        mf.discard(path)
+        self.assertEqual(PlenaryManifest(self.basedir).lookup(path), None)
+
+    def test_200_corrupt_journal(self):
+        path = self.write(PlenaryManifest(self.basedir), "a.tpl", "content")
+        with open(self.basedir + ".manifest", "a") as f:
+            f.write("0123abcd bad-size 12.5 b.tpl\n")
+
+        mf = PlenaryManifest(self.basedir)
+        self.assertEqual(mf.lookup(path), None)
+        # The damaged journal is thrown away
+        self.assertEqual(self.journal(), [])
+
+    def test_210_truncated_journal(self):
+        mf = PlenaryManifest(self.basedir)
+        path_a = self.write(mf, "a.tpl", "content")
+        path_b = self.write(mf, "b.tpl", "content")
+        with open(self.basedir + ".manifest") as f:
+            data = f.read()
+        with open(self.basedir + ".manifest", "w") as f:
+            f.write(data[:-len("b.tpl\n") - 3])
+
+        # The incomplete line is skipped, the lines before it are still good
+        mf = PlenaryManifest(self.basedir)
+        self.assertEqual(mf.lookup(path_a), content_digest("content"))
+        self.assertEqual(mf.lookup(path_b), None)
+
+    def test_220_truncated_path(self):
+        # A line cut within the path still parses, but refers to a file which
+        # does not exist
+        mf = PlenaryManifest(self.basedir)
+        path = self.write(mf, "abc.tpl", "content")
+        with open(self.basedir + ".manifest") as f:
+            data = f.read()
+        with open(self.basedir + ".manifest", "w") as f:
+            f.write(data[:-len("c.tpl\n")])
+
+        mf = PlenaryManifest(self.basedir)
+        self.assertEqual(mf.lookup(path), None)
+
+    def test_300_compaction(self):
+        manifest._COMPACT_THRESHOLD = 4
+        mf = PlenaryManifest(self.basedir)
+        self.write(mf, "a.tpl", "content")
+        for i in range(20):
+            self.write(mf, "b.tpl", "content %d" % i)
+            self.assertTrue(len(self.journal()) <= 6)
+
+        mf = PlenaryManifest(self.basedir)
+        self.assertEqual(mf.lookup(os.path.join(self.basedir, "b.tpl")),
+                         content_digest("content 19"))
+
+    def test_310_compaction_drops_stale_entries(self):
+        manifest._COMPACT_THRESHOLD = 2
+        mf = PlenaryManifest(self.basedir)
+        self.write(mf, "a.tpl", "content")
+        self.write(mf, "b.tpl", "content")
+        os.unlink(os.path.join(self.basedir, "a.tpl"))
+
+        self.write(mf, "b.tpl", "content 1")
+        self.write(mf, "b.tpl", "content 2")
+        self.assertEqual(len(self.journal()), 1)
+        self.assertTrue(self.journal()[0].endswith(" b.tpl"))
+
+    def test_400_drop_manifests(self):
+        mf = get_manifest(self.basedir)
+        self.assertTrue(get_manifest(self.basedir) is mf)
+        drop_manifests(self.tmpdir)
+        self.assertFalse(get_manifest(self.basedir) is mf)
+        drop_manifests(self.basedir)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPlenaryManifest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
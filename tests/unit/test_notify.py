@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing sending CDP notifications."""
+
+import socket
+import time
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from six.moves.configparser import RawConfigParser  # pylint: disable=F0401
+
+from aquilon.notify.index import (HostResolver, send_notification, CDB_NOTIF,
+                                  CDPPORT)
+
+BATCH_INTERVAL = 0.05
+
+
+class RecordingLogger(object):
+    """Minimal stand-in for the request logger."""
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg, *args):
+        self.messages.append(msg % args if args else msg)
+
+
+class FakeResolver(HostResolver):
+    """Resolve names using a fixed table instead of DNS."""
+
+    def __init__(self, addresses, errors=None, **kwargs):
+        super(FakeResolver, self).__init__(**kwargs)
+        self.addresses = addresses
+        self.errors = errors or {}
+        self.lookups = []
+
+    def _gethostbyname(self, host):
+        self.lookups.append(host)
+        if host in self.errors:
+            raise self.errors[host]
+        if host not in self.addresses:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return self.addresses[host]
+
+
+class RecordingSocket(object):
+    """Record the packets sent, failing for some of the addresses."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.packets = []
+
+    def sendto(self, packet, address):
+        self.packets.append((time.time(), address))
+        if address[0] in self.failing:
+            raise socket.error("Network is unreachable")
+
+
+class TestHostResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = {"host%d.example.com" % i: "192.168.0.%d" % i
+                          for i in range(1, 21)}
+        self.logger = RecordingLogger()
+
+    def resolve(self, resolver, hosts):
+        return resolver.resolve(hosts, logger=self.logger)
+
+    def test_100_resolve(self):
+        resolver = FakeResolver(self.addresses, threads=4)
+        resolved, unresolved, failed = self.resolve(resolver, self.addresses)
+        self.assertEqual(resolved, self.addresses)
+        self.assertEqual(unresolved, [])
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(resolver.lookups), sorted(self.addresses))
+
+    def test_110_cached(self):
+        resolver = FakeResolver(self.addresses)
+        hosts = ["host1.example.com", "unknown.example.com"]
+        first = self.resolve(resolver, hosts)
+        second = self.resolve(resolver, hosts)
+        self.assertEqual(first, second)
+        self.assertEqual(second, ({"host1.example.com": "192.168.0.1"},
+                                  ["unknown.example.com"], []))
+
+        # Unknown names are cached as well
+        self.assertEqual(sorted(resolver.lookups), sorted(hosts))
+
+    def test_120_expired(self):
+        resolver = FakeResolver(self.addresses, ttl=0)
+        self.resolve(resolver, ["host1.example.com"])
+        self.assertEqual(resolver.cache, {})
+
+        self.resolve(resolver, ["host1.example.com"])
+        self.assertEqual(resolver.lookups, ["host1.example.com"] * 2)
+
+    def test_130_error_not_cached(self):
+        errors = {"host2.example.com": socket.timeout("timed out")}
+        resolver = FakeResolver(self.addresses, errors=errors)
+        hosts = ["host1.example.com", "host2.example.com"]
+        resolved, unresolved, failed = self.resolve(resolver, hosts)
+        self.assertEqual(resolved, {"host1.example.com": "192.168.0.1"})
+        self.assertEqual(unresolved, [])
+        self.assertEqual(failed, ["host2.example.com"])
+        self.assertEqual(self.logger.messages,
+                         ["Error resolving host2.example.com: timed out"])
+
+        # The failed lookup is retried
+        del errors["host2.example.com"]
+        resolved, _, failed = self.resolve(resolver, hosts)
+        self.assertEqual(sorted(resolved), hosts)
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(resolver.lookups),
+                         ["host1.example.com", "host2.example.com",
+                          "host2.example.com"])
+
+
+class TestSendNotification(unittest.TestCase):
+
+    def setUp(self):
+        self.config = RawConfigParser()
+        self.config.add_section("broker")
+        self.config.set("broker", "cdp_batch_size", "2")
+        self.config.set("broker", "cdp_batch_interval", str(BATCH_INTERVAL))
+        self.addresses = {"host%d.example.com" % i: "192.168.0.%d" % i
+                          for i in range(1, 6)}
+        self.logger = RecordingLogger()
+
+    def send(self, objects, sock, resolver=None):
+        if not resolver:
+            resolver = FakeResolver(self.addresses)
+        return send_notification(CDB_NOTIF, objects, sock=sock,
+                                 logger=self.logger, config=self.config,
+                                 resolver=resolver)
+
+    def assertPaused(self, sock, batch_size=2):
+        # The first packet of every batch must be sent at least one interval
+        # after the last packet of the previous batch
+        times = [sent for sent, _ in sock.packets]
+        for idx in range(batch_size, len(times), batch_size):
+            self.assertTrue(times[idx] - times[idx - 1] >= BATCH_INTERVAL,
+                            "No pause before packet %d" % idx)
+
+    def test_200_batches(self):
+        sock = RecordingSocket()
+        stats = self.send(["ns/" + host for host in self.addresses], sock)
+        self.assertEqual(str(stats), "5 sent, 0 unresolved, 0 failed")
+        self.assertEqual([address for _, address in sock.packets],
+                         [("192.168.0.%d" % i, CDPPORT) for i in range(1, 6)])
+        self.assertPaused(sock)
+
+    def test_210_pause_after_failed_batch(self):
+        sock = RecordingSocket(failing=["192.168.0.1", "192.168.0.2"])
+        stats = self.send(self.addresses, sock)
+        self.assertEqual(str(stats), "3 sent, 0 unresolved, 2 failed")
+        self.assertEqual(len(sock.packets), 5)
+        self.assertPaused(sock)
+
+    def test_220_lookup_failures(self):
+        errors = {"host5.example.com": socket.timeout("timed out")}
+        resolver = FakeResolver(self.addresses, errors=errors)
+        sock = RecordingSocket()
+        stats = self.send(list(self.addresses) + ["unknown.example.com"],
+                          sock, resolver=resolver)
+        self.assertEqual(str(stats), "4 sent, 1 unresolved, 1 failed")
+        self.assertEqual(len(sock.packets), 4)
+
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    for test in [TestHostResolver, TestSendNotification]:
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(test))
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing bulk-loading the data needed by plenaries."""
+
+import logging
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from ipaddr import IPv4Address, IPv4Network
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from aquilon.aqdb.db_factory import StatementStats, stats_start, stats_stop
+from aquilon.aqdb.model import (Base, Organization, Hub, Continent, Country,
+                                City, Building, Rack, Vendor, Model, Machine,
+                                Host, Archetype, OperatingSystem, Grn,
+                                Personality, PersonalityStage, Domain,
+                                DnsDomain, DnsEnvironment, Fqdn, ARecord,
+                                Network, NetworkEnvironment, PublicInterface,
+                                AddressAssignment)
+from aquilon.aqdb.model.asset_lifecycle import Production
+from aquilon.aqdb.model.host_environment import (Production as
+                                                 ProductionEnvironment)
+from aquilon.aqdb.model.hostlifecycle import Ready
+from aquilon.aqdb.types import MACAddress
+from aquilon.worker.commands.flush import CommandFlush
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RenderingWriter(object):
+    """Generate the content of the plenaries without writing them out."""
+
+    def __init__(self):
+        self.templates = []
+
+    def write(self, plenary, describe=None):
+        for plen in plenary.plenaries:
+            plen._generate_content()
+            self.templates.append(plen.template_name(plen.dbobj))
+
+
+class Progress(object):
+    def step(self):
+        pass
+
+
+class TestPreloadHosts(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.hosts = 0
+
+        session = self.session
+        parent = None
+        for cls, name in [(Organization, "ms"), (Hub, "ny"),
+                          (Continent, "na"), (Country, "us"),
+                          (City, "ny")]:
+            parent = cls(name=name, fullname=name, parent=parent)
+            session.add(parent)
+            session.flush()
+        self.building = Building(name="ut", fullname="ut", address="ut",
+                                 parent=parent)
+        session.add(self.building)
+        session.flush()
+        self.rack = Rack(name="ut3", fullname="ut3", parent=self.building)
+
+        vendor = Vendor(name="hp")
+        self.model = Model(name="dl360g9", vendor=vendor,
+                           model_type="rackmount")
+        self.cpu = Model(name="e5-2660", vendor=vendor, model_type="cpu")
+        self.nic = Model(name="generic_nic", vendor=vendor, model_type="nic")
+
+        self.dns_env = DnsEnvironment(name="internal")
+        self.dns_domain = DnsDomain(name="example.com")
+        net_env = NetworkEnvironment(name="internal",
+                                     dns_environment=self.dns_env)
+        self.network = Network(network=IPv4Network("10.0.0.0/24"),
+                               name="ut_net", network_environment=net_env,
+                               location=self.building)
+
+        archetype = Archetype(name="aquilon", is_compileable=True)
+        self.os = OperatingSystem(name="linux", version="1.0",
+                                  archetype=archetype,
+                                  lifecycle=Production.get_instance(session))
+        self.grn = Grn(eon_id=1, grn="grn:/ut", disabled=False)
+        env = ProductionEnvironment.get_instance(session)
+        personality = Personality(name="unittest", archetype=archetype,
+                                  owner_grn=self.grn, host_environment=env)
+        self.stage = PersonalityStage(personality=personality,
+                                      name="current")
+        self.domain = Domain(name="prod", compiler="/none/panc.jar")
+        self.status = Ready.get_instance(session)
+
+        session.add_all([self.rack, self.model, self.cpu, self.nic,
+                         self.dns_domain, self.network, self.os, self.stage,
+                         self.domain])
+        session.commit()
+
+        event.listen(self.engine, "before_cursor_execute", stats_start)
+        event.listen(self.engine, "after_cursor_execute", stats_stop)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def add_hosts(self, count):
+        session = self.session
+        for _ in range(count):
+            idx = self.hosts
+            self.hosts += 1
+
+            dbmachine = Machine(label="ut3c1n%d" % idx, model=self.model,
+                                location=self.rack, cpu_model=self.cpu,
+                                cpu_quantity=2, memory=8192)
+            fqdn = Fqdn(name="host%d" % idx, dns_domain=self.dns_domain,
+                        dns_environment=self.dns_env)
+            session.add(fqdn)
+            dbdns_rec = ARecord(fqdn=fqdn, network=self.network,
+                                ip=IPv4Address("10.0.0.%d" % (idx + 10)))
+            dbmachine.primary_name = dbdns_rec
+            dbinterface = PublicInterface(name="eth0", model=self.nic,
+                                          hardware_entity=dbmachine,
+                                          bootable=True,
+                                          mac=MACAddress(value=idx + 1))
+            dbinterface.assignments.append(
+                AddressAssignment(ip=dbdns_rec.ip, network=self.network,
+                                  interface=dbinterface))
+            session.add(Host(hardware_entity=dbmachine, branch=self.domain,
+                             personality_stage=self.stage,
+                             operating_system=self.os, status=self.status,
+                             owner_grn=self.grn))
+        session.commit()
+
+    def flush_hosts(self):
+        # Start from an empty identity map, like a new request would
+        session = sessionmaker(bind=self.engine)()
+        cmd = object.__new__(CommandFlush)
+        writer = RenderingWriter()
+        failed = []
+        try:
+            with StatementStats() as stats:
+                cmd.flush_hosts(session, LOGGER, writer, failed, Progress())
+        finally:
+            session.close()
+        self.assertEqual(failed, [])
+        self.assertEqual(len(writer.templates), 2 * self.hosts)
+        return stats
+
+    def test_100_statement_count_constant(self):
+        self.add_hosts(2)
+        few = self.flush_hosts()
+
+        self.add_hosts(6)
+        many = self.flush_hosts()
+
+        self.assertEqual(few.count, many.count,
+                         "Repeated statements: %r" %
+                         many.worst_offenders(5))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPreloadHosts)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing running external processes."""
+
+from signal import SIGKILL
+from threading import Lock
+import time
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from aquilon.exceptions_ import ProcessException
+from aquilon.worker.processes import run_command, run_parallel
+from aquilon.worker.commands.poll_network_device import \
+    CommandPollNetworkDevice
+
+
+class DummyKey(object):
+    """Stand-in for the ExternalKey of a network device."""
+
+    def __init__(self):
+        self.held = False
+
+    def __enter__(self):
+        self.held = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.held = False
+
+
+class TestRunCommand(unittest.TestCase):
+
+    def test_100_output(self):
+        out = run_command(["/bin/echo", "hello"], timeout=10)
+        self.assertEqual(out, "hello\n")
+
+    def test_110_failure(self):
+        with self.assertRaises(ProcessException) as cm:
+            run_command(["/bin/false"])
+        self.assertEqual(cm.exception.code, 1)
+
+    def test_200_timeout_kills(self):
+        start = time.time()
+        with self.assertRaises(ProcessException) as cm:
+            run_command(["/bin/sleep", "60"], timeout=0.5)
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(cm.exception.signalNum, SIGKILL)
+        self.assertIsNone(cm.exception.code)
+
+
+class TestRunParallel(unittest.TestCase):
+
+    def test_100_order(self):
+        # Later tasks finish first, the results must still follow the order
+        # of the tasks
+        def make_task(idx):
+            def task():
+                time.sleep(0.05 * (5 - idx))
+                return idx
+            return task
+
+        results = run_parallel([make_task(idx) for idx in range(5)], 5)
+        self.assertEqual(results, [(idx, None) for idx in range(5)])
+
+    def test_110_exceptions(self):
+        def fail():
+            raise ValueError("boom")
+
+        results = run_parallel([lambda: 1, fail, lambda: 3], 2)
+        self.assertEqual(results[0], (1, None))
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], ValueError)
+        self.assertEqual(str(results[1][1]), "boom")
+        self.assertEqual(results[2], (3, None))
+
+    def test_120_bounded(self):
+        lock = Lock()
+        state = {"running": 0, "max": 0}
+
+        def task():
+            with lock:
+                state["running"] += 1
+                state["max"] = max(state["max"], state["running"])
+            time.sleep(0.1)
+            with lock:
+                state["running"] -= 1
+
+        results = run_parallel([task] * 10, 3)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(state["max"], 3)
+
+    def test_130_empty(self):
+        self.assertEqual(run_parallel([], 4), [])
+
+
+class TestPollDiscover(unittest.TestCase):
+
+    def test_100_outputs(self):
+        key = DummyKey()
+        elapsed, outputs = CommandPollNetworkDevice.discover(
+            key, [["/bin/echo", "cam"], ["/bin/false"]], 10)
+        self.assertFalse(key.held)
+        self.assertGreaterEqual(elapsed, 0)
+        self.assertEqual(outputs[0], "cam\n")
+        self.assertIsInstance(outputs[1], ProcessException)
+
+    def test_200_deadline_per_device(self):
+        # The first tool uses up the whole time of the device, so the second
+        # one must not be started at all
+        start = time.time()
+        elapsed, outputs = CommandPollNetworkDevice.discover(
+            DummyKey(), [["/bin/sleep", "60"], ["/bin/echo", "vlan"]], 1)
+        self.assertLess(time.time() - start, 30)
+        self.assertGreaterEqual(elapsed, 1)
+        self.assertIsInstance(outputs[0], ProcessException)
+        self.assertEqual(outputs[0].signalNum, SIGKILL)
+        self.assertIsInstance(outputs[1], ProcessException)
+        self.assertIn("did not finish in 1 seconds", str(outputs[1]))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRunParallel)
+    unittest.TextTestRunner(verbosity=2).run(suite)
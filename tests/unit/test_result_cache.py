@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the result cache."""
+
+import unittest
+from uuid import uuid4
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from aquilon.aqdb.model import Xtn
+from aquilon.worker import result_cache
+from aquilon.worker.exporter import Exporter
+from aquilon.worker.result_cache import ResultCache
+
+SHOW_A = ("show_a", (("name", "x"),))
+SHOW_A2 = ("show_a", (("name", "y"),))
+SHOW_B = ("show_b", ())
+
+
+class DepA(object):
+    pass
+
+
+class DepSubA(DepA):
+    pass
+
+
+class DepB(object):
+    pass
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(max_entries=100, max_bytes=1000, ttl=300)
+
+    def store(self, key, value, dependencies=(DepA,)):
+        _, generation = self.cache.lookup(key, dependencies)
+        self.cache.store(key, value, generation)
+
+    def cached(self, key, dependencies=(DepA,)):
+        return self.cache.lookup(key, dependencies)[0]
+
+    def test_100_hit(self):
+        self.assertEqual(self.cache.lookup(SHOW_A, (DepA,)), (None, 0))
+        self.cache.store(SHOW_A, "result", 0)
+        self.assertEqual(self.cached(SHOW_A), "result")
+        # Different arguments are different entries
+        self.assertEqual(self.cached(SHOW_A2), None)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats.entries, 1)
+        self.assertEqual(stats.size, len("result"))
+        self.assertEqual(stats.hits, 1)
+        self.assertEqual(stats.misses, 2)
+        self.assertEqual(stats.stores, 1)
+
+    def test_110_expired(self):
+        self.cache = ResultCache(max_entries=100, max_bytes=1000, ttl=-1)
+        self.store(SHOW_A, "result")
+        self.assertEqual(self.cached(SHOW_A), None)
+        self.assertEqual(self.cache.stats().entries, 0)
+
+    def test_200_invalidate(self):
+        self.store(SHOW_A, "a1")
+        self.store(SHOW_A2, "a2")
+        self.store(SHOW_B, "b", dependencies=(DepB,))
+
+        # Subclasses of a dependency count as well
+        self.cache.invalidate(DepSubA)
+        self.assertEqual(self.cached(SHOW_A), None)
+        self.assertEqual(self.cached(SHOW_A2), None)
+        self.assertEqual(self.cached(SHOW_B, (DepB,)), "b")
+        self.assertEqual(self.cache.stats().invalidations, 2)
+
+    def test_210_invalidate_while_running(self):
+        self.store(SHOW_A, "old")
+        self.cache.invalidate(DepA)
+
+        _, generation = self.cache.lookup(SHOW_A, (DepA,))
+        # The data changes while the command is computing the result
+        self.cache.invalidate(DepA)
+        self.cache.store(SHOW_A, "stale", generation)
+        self.assertEqual(self.cached(SHOW_A), None)
+
+    def test_220_invalidate_during_first_run(self):
+        # The command has never stored anything, so the invalidation can
+        # only be noticed if lookup() registered the dependencies
+        _, generation = self.cache.lookup(SHOW_A, (DepA,))
+        self.cache.invalidate(DepA)
+        self.cache.store(SHOW_A, "stale", generation)
+        self.assertEqual(self.cached(SHOW_A), None)
+
+        # Other commands are not affected
+        _, generation = self.cache.lookup(SHOW_B, (DepB,))
+        self.cache.invalidate(DepA)
+        self.cache.store(SHOW_B, "b", generation)
+        self.assertEqual(self.cached(SHOW_B, (DepB,)), "b")
+
+    def test_300_evict_entries(self):
+        self.cache = ResultCache(max_entries=2, max_bytes=1000, ttl=300)
+        self.store(SHOW_A, "a1")
+        self.store(SHOW_A2, "a2")
+        # Use the first entry, so the second one is the least recently used
+        self.assertEqual(self.cached(SHOW_A), "a1")
+        self.store(SHOW_B, "b", dependencies=(DepB,))
+
+        self.assertEqual(self.cached(SHOW_A2), None)
+        self.assertEqual(self.cached(SHOW_A), "a1")
+        self.assertEqual(self.cached(SHOW_B, (DepB,)), "b")
+        self.assertEqual(self.cache.stats().evictions, 1)
+
+    def test_310_evict_size(self):
+        self.cache = ResultCache(max_entries=100, max_bytes=10, ttl=300)
+        self.store(SHOW_A, "1234")
+        self.store(SHOW_A2, "5678")
+        self.store(SHOW_B, "abcd", dependencies=(DepB,))
+        self.assertEqual(self.cached(SHOW_A), None)
+        self.assertEqual(self.cache.stats().size, 8)
+
+        # Results larger than the whole cache are not stored at all
+        self.store(SHOW_A, "x" * 11)
+        self.assertEqual(self.cached(SHOW_A), None)
+        self.assertEqual(self.cache.stats().entries, 2)
+
+
+class TestResultCacheExporter(unittest.TestCase):
+
+    def setUp(self):
+        # The cache is disabled by the test configuration, so install one
+        # for the exporter to find
+        self.cache = ResultCache(max_entries=100, max_bytes=1000, ttl=300)
+        result_cache._result_cache = self.cache
+
+        self.engine = create_engine("sqlite://")
+        Xtn.__table__.create(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.exporter = Exporter()
+        event.listen(self.session, "after_flush",
+                     self.exporter.event_after_flush)
+
+    def tearDown(self):
+        result_cache._result_cache = None
+        self.session.close()
+        self.engine.dispose()
+
+    def test_100_flush_and_commit(self):
+        _, generation = self.cache.lookup(SHOW_A, (Xtn,))
+        self.cache.store(SHOW_A, "result", generation)
+
+        self.session.add(Xtn(id=uuid4(), command="show_a", username="user",
+                             is_readonly=False))
+        self.session.flush()
+        self.assertEqual(self.cache.lookup(SHOW_A, (Xtn,))[0], None)
+
+        # A command running between the flush and the commit can store a
+        # result computed from the old data, the commit must drop it
+        _, generation = self.cache.lookup(SHOW_A, (Xtn,))
+        self.cache.store(SHOW_A, "stale", generation)
+        with self.exporter:
+            self.session.commit()
+        self.assertEqual(self.cache.lookup(SHOW_A, (Xtn,))[0], None)
+
+    def test_110_unrelated_flush(self):
+        _, generation = self.cache.lookup(SHOW_B, (DepB,))
+        self.cache.store(SHOW_B, "result", generation)
+
+        self.session.add(Xtn(id=uuid4(), command="show_b", username="user",
+                             is_readonly=False))
+        with self.exporter:
+            self.session.commit()
+        self.assertEqual(self.cache.lookup(SHOW_B, (DepB,))[0], "result")
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestResultCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
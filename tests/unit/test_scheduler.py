@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the request scheduler."""
+
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from twisted.python.failure import Failure
+
+from aquilon.exceptions_ import TransientError
+from aquilon.worker.scheduler import (RequestQueue, RequestQueueStats,
+                                      request_scheduler)
+from aquilon.worker.broker import BrokerCommand
+from aquilon.worker.messages import StatusCatalog
+from aquilon.worker.resources import ResponsePage
+from aquilon.worker.commands.make import CommandMake
+from aquilon.worker.commands.reconfigure import CommandReconfigure
+from aquilon.worker.commands.show_host_list import CommandShowHostList
+
+
+class FakeThreadPool(object):
+    """Keep the submitted calls until the test decides to run them."""
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kwargs):
+        self.calls.append((onResult, func, args, kwargs))
+
+    def run_next(self):
+        onResult, func, args, kwargs = self.calls.pop(0)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+
+    def stop(self):
+        pass
+
+
+class FakeReactor(object):
+    """Run the callbacks from the worker threads immediately."""
+
+    def callFromThread(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+class FakeLogger(object):
+
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def info(self, msg, *args):
+        self.messages.append(msg % args)
+
+    def close_handlers(self):
+        self.closed = True
+
+
+class FakeCommand(object):
+
+    request_class = "readonly"
+
+    def invoke_render(self, **arguments):
+        return arguments["name"]
+
+
+class LoggedCommand(BrokerCommand):
+    """Use the real add_logger(), without setting up the database."""
+
+    request_class = "readonly"
+    module_logger = None
+
+    def __init__(self):  # pylint: disable=W0231
+        self.catalog = StatusCatalog()
+        self.command = "show_host"
+
+    def invoke_render(self, user=None, logger=None, request=None,
+                      **arguments):
+        logger.close_handlers()
+        return (user, arguments["hostname"])
+
+
+class FakeRequest(object):
+
+    def __init__(self, auditid):
+        self.status = StatusCatalog().create_request_status(auditid)
+
+    def getPrincipal(self):
+        return "alice@EXAMPLE.COM"
+
+
+class TestRequestQueue(unittest.TestCase):
+
+    def make_queue(self, concurrency=1, max_queued=0):
+        self.pool = FakeThreadPool()
+        return RequestQueue("readonly", concurrency, max_queued,
+                            pool=self.pool, reactor=FakeReactor())
+
+    def submit(self, queue, user, name):
+        d = queue.submit(user, lambda: name)
+        d.addCallback(self.results.append)
+        return d
+
+    def setUp(self):
+        self.results = []
+
+    def test_100_round_robin(self):
+        queue = self.make_queue()
+        for user, name in [("alice", "a1"), ("alice", "a2"), ("alice", "a3"),
+                           ("bob", "b1"), ("bob", "b2"), ("carol", "c1")]:
+            self.submit(queue, user, name)
+
+        self.assertEqual(queue.running, 1)
+        self.assertEqual(queue.queued, 5)
+        self.assertEqual(RequestQueueStats(queue).users, 3)
+
+        while self.pool.calls:
+            self.pool.run_next()
+
+        # alice was first in line, then every user gets one request at a
+        # time, in the order they started waiting
+        self.assertEqual(self.results, ["a1", "a2", "b1", "c1", "a3", "b2"])
+        self.assertEqual(queue.running, 0)
+        self.assertEqual(queue.queued, 0)
+        self.assertEqual(queue.started, 6)
+        self.assertEqual(len(queue.waiting), 0)
+
+    def test_110_late_user_not_starved(self):
+        queue = self.make_queue()
+        for name in ["a1", "a2", "a3", "a4"]:
+            self.submit(queue, "alice", name)
+        self.pool.run_next()
+        self.submit(queue, "bob", "b1")
+
+        while self.pool.calls:
+            self.pool.run_next()
+
+        # alice was already waiting when bob arrived, so bob only waits for
+        # one more request of alice, not for all of them
+        self.assertEqual(self.results, ["a1", "a2", "a3", "b1", "a4"])
+
+    def test_120_concurrency(self):
+        queue = self.make_queue(concurrency=2)
+        for name in ["a1", "a2", "a3"]:
+            self.submit(queue, "alice", name)
+        self.assertEqual(len(self.pool.calls), 2)
+        self.assertEqual(queue.running, 2)
+        self.assertEqual(queue.queued, 1)
+
+        self.pool.run_next()
+        self.assertEqual(len(self.pool.calls), 2)
+        self.assertEqual(queue.running, 2)
+        self.assertEqual(queue.queued, 0)
+
+    def test_130_failure(self):
+        queue = self.make_queue()
+        errors = []
+
+        def fail():
+            raise ValueError("boom")
+
+        queue.submit("alice", fail).addErrback(errors.append)
+        self.submit(queue, "alice", "a2")
+        self.pool.run_next()
+
+        # The failure is delivered to the caller, and the next request runs
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].check(ValueError))
+        self.assertEqual(queue.running, 1)
+        self.pool.run_next()
+        self.assertEqual(self.results, ["a2"])
+
+    def test_200_max_queued(self):
+        queue = self.make_queue(max_queued=2)
+        for name in ["a1", "a2", "a3"]:
+            self.submit(queue, "alice", name)
+        self.assertRaises(TransientError, queue.submit, "bob", lambda: "b1")
+        self.assertEqual(queue.rejected, 1)
+        self.assertEqual(queue.queued, 2)
+
+        # Once there is room, requests are accepted again
+        self.pool.run_next()
+        self.submit(queue, "bob", "b1")
+        while self.pool.calls:
+            self.pool.run_next()
+        self.assertEqual(self.results, ["a1", "a2", "a3", "b1"])
+
+
+class TestScheduleRender(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeThreadPool()
+        self.queue = RequestQueue("readonly", 1, 1, pool=self.pool,
+                                  reactor=FakeReactor())
+        self.saved_queue = request_scheduler.queues.get("readonly")
+        request_scheduler.queues["readonly"] = self.queue
+        self.page = ResponsePage("", None)
+
+    def tearDown(self):
+        if self.saved_queue:
+            request_scheduler.queues["readonly"] = self.saved_queue
+        else:
+            del request_scheduler.queues["readonly"]
+
+    def schedule(self, name):
+        logger = FakeLogger()
+        arguments = {"user": "alice", "logger": logger, "name": name}
+        d = self.page.scheduleRender(arguments, FakeCommand())
+        return d, logger
+
+    def test_100_scheduled(self):
+        results = []
+        d, logger = self.schedule("first")
+        d.addCallback(results.append)
+        self.pool.run_next()
+        self.assertEqual(results, ["first"])
+        self.assertFalse(logger.closed)
+
+    def test_200_rejected(self):
+        self.schedule("running")
+        self.schedule("queued")
+
+        # The request logger is never handed to invoke_render(), so it must
+        # be closed when the request is rejected
+        logger = FakeLogger()
+        arguments = {"user": "alice", "logger": logger, "name": "rejected"}
+        self.assertRaises(TransientError, self.page.scheduleRender,
+                          arguments, FakeCommand())
+        self.assertTrue(logger.closed)
+        self.assertEqual(len(logger.messages), 1)
+        self.assertIn("TransientError", logger.messages[0])
+        self.assertEqual(self.queue.rejected, 1)
+
+    def test_300_add_logger_arguments(self):
+        # The arguments built by add_logger() contain "user", which must not
+        # clash with the parameters of the scheduler
+        command = LoggedCommand()
+        arguments = command.add_logger(request=FakeRequest(300),
+                                       style="raw", hostname="host1")
+        self.assertIn("user", arguments)
+
+        results = []
+        d = self.page.scheduleRender(arguments, command)
+        d.addCallback(results.append)
+        self.pool.run_next()
+        self.assertEqual(results, [("alice@EXAMPLE.COM", "host1")])
+
+
+class TestRequestClass(unittest.TestCase):
+
+    def test_100_is_class_compiling(self):
+        self.assertTrue(CommandMake.is_class_compiling())
+        self.assertFalse(CommandShowHostList.is_class_compiling())
+
+    def test_110_is_class_compiling_inherited(self):
+        # reconfigure.py does not use TemplateDomain itself, CommandMake does
+        self.assertTrue(CommandReconfigure.is_class_compiling())
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRequestQueue)
+    unittest.TextTestRunner(verbosity=2).run(suite)
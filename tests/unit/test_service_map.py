@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the service map index."""
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import unittest
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from aquilon.aqdb.model import Location, ServiceInstance, ServiceMap
+from aquilon.aqdb.model.service_map import ServiceMapIndex, service_map_index
+from aquilon.worker.exporter import Exporter
+
+SERVICE = 1
+OTHER_SERVICE = 2
+BUILDING = 10
+RACK = 11
+NETWORK = 20
+PERSONALITY = 30
+DEV = 40
+QA = 41
+
+
+class TestServiceMapIndex(unittest.TestCase):
+
+    def setUp(self):
+        # Use a file, so several sessions can see the same database
+        self.tmpdir = mkdtemp(prefix="service_map_")
+        self.engine = create_engine("sqlite:///" +
+                                    os.path.join(self.tmpdir, "aqdb.db"))
+        for table in [Location.__table__, ServiceInstance.__table__,
+                      ServiceMap.__table__]:
+            table.create(self.engine)
+        self.sessionmaker = sessionmaker(bind=self.engine)
+        self.session = self.sessionmaker()
+        self.index = ServiceMapIndex()
+
+        self.session.execute(Location.__table__.insert(), [
+            {"id": BUILDING, "name": "ut", "fullname": "ut",
+             "location_type": "building"},
+            {"id": RACK, "name": "ut3", "fullname": "ut3",
+             "location_type": "rack"}])
+        self.session.execute(ServiceInstance.__table__.insert(), [
+            {"id": si_id, "service_id": service_id, "name": "si%d" % si_id}
+            for si_id, service_id in [(1, SERVICE), (2, SERVICE),
+                                      (3, SERVICE), (4, SERVICE),
+                                      (5, OTHER_SERVICE)]])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        rmtree(self.tmpdir, ignore_errors=True)
+
+    def add_map(self, si_id, session=None, **kwargs):
+        session = session or self.session
+        values = {"service_instance_id": si_id}
+        values.update(kwargs)
+        result = session.execute(ServiceMap.__table__.insert().values(values))
+        return result.inserted_primary_key[0]
+
+    def lookup(self, index=None, personality_id=PERSONALITY, psli_envs=None,
+               default_env_id=DEV, location_ids=(BUILDING, RACK),
+               network_id=None):
+        index = index or self.index
+        result = index.lookup(self.session, [SERVICE, OTHER_SERVICE],
+                              personality_id, psli_envs or {}, default_env_id,
+                              location_ids, network_id)
+        return dict((service_id, sorted(ids))
+                    for service_id, ids in result.items())
+
+    def test_100_scope_precedence(self):
+        self.add_map(1, location_id=BUILDING)
+        self.assertEqual(self.lookup(), {SERVICE: [1]})
+
+        self.add_map(2, location_id=RACK)
+        self.index.invalidate()
+        self.assertEqual(self.lookup(), {SERVICE: [2]})
+
+        self.add_map(3, network_id=NETWORK)
+        self.index.invalidate()
+        self.assertEqual(self.lookup(network_id=NETWORK), {SERVICE: [3]})
+        # Other networks and locations outside the path are not used
+        self.assertEqual(self.lookup(network_id=NETWORK + 1), {SERVICE: [2]})
+        self.assertEqual(self.lookup(location_ids=[BUILDING]),
+                         {SERVICE: [1]})
+
+    def test_110_target_precedence(self):
+        self.add_map(1, location_id=RACK)
+        self.add_map(2, location_id=BUILDING, host_environment_id=DEV)
+        self.add_map(3, location_id=BUILDING, host_environment_id=QA)
+        self.add_map(4, location_id=BUILDING, personality_id=PERSONALITY)
+
+        # A personality map beats an environment map, which beats a global
+        # map, even if the global map has a narrower scope
+        self.assertEqual(self.lookup(), {SERVICE: [4]})
+        self.assertEqual(self.lookup(personality_id=PERSONALITY + 1),
+                         {SERVICE: [2]})
+        self.assertEqual(self.lookup(personality_id=PERSONALITY + 1,
+                                     psli_envs={SERVICE: QA}),
+                         {SERVICE: [3]})
+        self.assertEqual(self.lookup(personality_id=PERSONALITY + 1,
+                                     default_env_id=QA + 1),
+                         {SERVICE: [1]})
+
+    def test_120_priority_ties(self):
+        self.add_map(1, location_id=BUILDING)
+        self.add_map(2, location_id=RACK)
+        self.add_map(3, location_id=RACK)
+        self.add_map(5, location_id=BUILDING)
+
+        # All instances with the best priority are returned, services are
+        # resolved independently
+        self.assertEqual(self.lookup(), {SERVICE: [2, 3], OTHER_SERVICE: [5]})
+
+        # Environment maps at the same scope tie as well
+        self.add_map(1, location_id=BUILDING, host_environment_id=DEV)
+        self.add_map(4, location_id=BUILDING, host_environment_id=DEV)
+        self.index.invalidate()
+        self.assertEqual(self.lookup(), {SERVICE: [1, 4], OTHER_SERVICE: [5]})
+
+    def test_200_index_reused(self):
+        self.add_map(1, location_id=BUILDING)
+        self.session.commit()
+        self.assertEqual(self.lookup(), {SERVICE: [1]})
+        by_location = self.index.by_location
+
+        # A new transaction checks the fingerprint, but does not rebuild an
+        # index which is still valid
+        self.session.commit()
+        self.assertEqual(self.lookup(), {SERVICE: [1]})
+        self.assertTrue(self.index.by_location is by_location)
+
+    def test_210_external_insert(self):
+        self.add_map(1, location_id=BUILDING)
+        self.session.commit()
+        self.assertEqual(self.lookup(), {SERVICE: [1]})
+        self.session.commit()
+
+        other = self.sessionmaker()
+        self.add_map(2, session=other, location_id=RACK)
+        other.commit()
+        other.close()
+
+        self.assertEqual(self.lookup(), {SERVICE: [2]})
+
+    def test_220_external_replace(self):
+        map_id = self.add_map(1, location_id=BUILDING)
+        self.add_map(2, location_id=BUILDING)
+        self.session.commit()
+        self.assertEqual(self.lookup(), {SERVICE: [1, 2]})
+        self.session.commit()
+
+        # Deleting a map and adding another one keeps the count the same,
+        # the highest ID still changes
+        other = self.sessionmaker()
+        other.execute(ServiceMap.__table__.delete()
+                      .where(ServiceMap.__table__.c.id == map_id))
+        self.add_map(3, session=other, location_id=BUILDING)
+        other.commit()
+        other.close()
+
+        self.assertEqual(self.lookup(), {SERVICE: [2, 3]})
+
+    def test_230_checked_once_per_transaction(self):
+        self.add_map(1, location_id=BUILDING)
+        self.assertEqual(self.lookup(), {SERVICE: [1]})
+
+        # Within a transaction, only the exporter can invalidate the index
+        self.add_map(2, location_id=RACK)
+        self.assertEqual(self.lookup(), {SERVICE: [1]})
+
+        self.session.commit()
+        self.assertEqual(self.lookup(), {SERVICE: [2]})
+
+    def test_300_exporter_invalidates(self):
+        service_map_index.invalidate()
+        try:
+            self.add_map(1, location_id=BUILDING)
+            self.assertEqual(self.lookup(index=service_map_index),
+                             {SERVICE: [1]})
+
+            # Change a map within the same transaction, the way a broker
+            # command does
+            map_id = self.add_map(2, location_id=RACK)
+            self.assertEqual(self.lookup(index=service_map_index),
+                             {SERVICE: [1]})
+
+            dbmap = self.session.query(ServiceMap).get(map_id)
+            Exporter().create(dbmap)
+            self.assertEqual(self.lookup(index=service_map_index),
+                             {SERVICE: [2]})
+
+            Exporter().delete(dbmap)
+            self.assertTrue(service_map_index.by_location is None)
+        finally:
+            service_map_index.invalidate()
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestServiceMapIndex)
+    unittest.TextTestRunner(verbosity=2).run(suite)
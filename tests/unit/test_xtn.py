@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Module for testing the asynchronous audit writer."""
+
+import time
+import unittest
+from uuid import uuid4
+
+if __name__ == "__main__":
+    import utils
+    utils.import_depends()
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.pool import StaticPool
+
+from aquilon.aqdb.model.xtn import (Xtn, XtnEnd, XtnDetail, AuditWriter,
+                                    xtn_records)
+
+
+class RecordingAuditWriter(AuditWriter):
+    """Remember the size of every batch written."""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingAuditWriter, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    def _write(self, batch):
+        self.batches.append(len(batch))
+        super(RecordingAuditWriter, self)._write(batch)
+
+
+class TestAuditWriter(unittest.TestCase):
+
+    def setUp(self):
+        # The writer uses its own thread, so all threads must share the same
+        # in-memory database
+        self.engine = create_engine("sqlite://", poolclass=StaticPool,
+                                    connect_args={"check_same_thread": False})
+        for table in [Xtn.__table__, XtnEnd.__table__, XtnDetail.__table__]:
+            table.create(self.engine)
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.stop()
+        self.engine.dispose()
+
+    def make_writer(self, interval=60, batch_size=1000):
+        writer = RecordingAuditWriter(self.engine, interval=interval,
+                                      batch_size=batch_size)
+        self.writers.append(writer)
+        return writer
+
+    def submit(self, writer, xtn_id=None, return_code=0):
+        records = xtn_records(xtn_id or uuid4(), "user", "show_host", True,
+                              {"hostname": "unittest00.one-nyp.ms.com"}, [])
+        writer.submit(records, return_code, results=[("count", 1)])
+
+    def count(self, table):
+        with self.engine.connect() as conn:
+            return conn.execute(select([func.count()])
+                                .select_from(table)).scalar()
+
+    def wait_written(self, writer, count, timeout=10):
+        deadline = time.time() + timeout
+        while writer.written + writer.dropped < count and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(writer.written + writer.dropped, count)
+
+    def test_100_batch_size_triggers_write(self):
+        writer = self.make_writer(batch_size=3)
+        for _ in range(3):
+            self.submit(writer)
+        self.wait_written(writer, 3)
+
+        self.assertEqual(writer.batches, [3])
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(writer.dropped, 0)
+        self.assertEqual(self.count(Xtn.__table__), 3)
+        self.assertEqual(self.count(XtnEnd.__table__), 3)
+        # One argument and one result for every command
+        self.assertEqual(self.count(XtnDetail.__table__), 6)
+
+    def test_110_interval_triggers_write(self):
+        writer = self.make_writer(interval=0.1)
+        self.submit(writer)
+        self.submit(writer)
+        self.wait_written(writer, 2)
+        self.assertEqual(self.count(XtnEnd.__table__), 2)
+
+    def test_200_retry_one_by_one(self):
+        writer = self.make_writer()
+        duplicate = uuid4()
+        self.submit(writer, xtn_id=duplicate)
+        writer.flush()
+        self.assertEqual(writer.batches, [1])
+
+        # The second record clashes with the one written above, so the batch
+        # fails as a whole; the other records must still be written
+        self.submit(writer)
+        self.submit(writer, xtn_id=duplicate)
+        self.submit(writer)
+        writer.flush()
+
+        self.assertEqual(writer.batches, [1, 3, 1, 1, 1])
+        self.assertEqual(writer.written, 3)
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(self.count(Xtn.__table__), 3)
+        self.assertEqual(self.count(XtnEnd.__table__), 3)
+
+    def test_210_flush_empty(self):
+        writer = self.make_writer()
+        writer.flush()
+        self.assertEqual(writer.batches, [])
+
+    def test_300_flush_on_stop(self):
+        writer = self.make_writer()
+        self.submit(writer)
+        self.submit(writer, return_code=4)
+        self.assertEqual(self.count(Xtn.__table__), 0)
+
+        writer.stop()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(writer.written, 2)
+        self.assertEqual(self.count(Xtn.__table__), 2)
+        with self.engine.connect() as conn:
+            codes = sorted(row[0] for row in
+                           conn.execute(select([XtnEnd.return_code])))
+        self.assertEqual(codes, [0, 4])
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAuditWriter)
+    unittest.TextTestRunner(verbosity=2).run(suite)
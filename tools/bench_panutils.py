@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- cpy-indent-level: 4; indent-tabs-mode: nil -*-
+# ex: set expandtab softtabstop=4 shiftwidth=4:
+#
+# Copyright (C) 2017  Contributor
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Measure the speed of the PAN serializer used for generating plenaries."""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import sys
+import timeit
+
+# -- begin path_setup --
+BINDIR = os.path.dirname(os.path.realpath(sys.argv[0]))
+LIBDIR = os.path.join(BINDIR, "..", "lib")
+
+if LIBDIR not in sys.path:
+    sys.path.append(LIBDIR)
+# -- end path_setup --
+
+from aquilon.worker.templates.panutils import (pan, pan_create, PanMetric,
+                                               PanValue, StructureTemplate)
+
+
+def host_structure(nics=4, disks=2):
+    """Hardware and system data, similar to PlenaryHostData."""
+    interfaces = {}
+    for i in range(nics):
+        interfaces["eth%d" % i] = {
+            "hwaddr": "00:50:56:01:20:%02x" % i,
+            "bootproto": "static",
+            "ip": "192.168.%d.10" % i,
+            "netmask": "255.255.255.0",
+            "broadcast": "192.168.%d.255" % i,
+            "gateway": "192.168.%d.1" % i,
+            "fqdn": "host-eth%d.example.com" % i,
+            "network_type": "unknown",
+            "network_environment": "internal",
+            "route": [{"address": "10.%d.0.0" % i,
+                       "netmask": "255.255.0.0",
+                       "gateway": "192.168.%d.1" % i}],
+        }
+    harddisks = {}
+    for i in range(disks):
+        harddisks["sd%s" % chr(ord("a") + i)] = StructureTemplate(
+            "hardware/harddisk/generic/scsi",
+            {"boot": i == 0, "capacity": PanMetric(68, "GB"),
+             "interface": "scsi", "address": "0:0:%d:0" % i,
+             "wwn": "600508b112233445566778899aabbcc%d" % i})
+    return {
+        "hardware": StructureTemplate("machine/americas/ut/ut3/ut3c1n3",
+                                      {"ram": [{"size": PanMetric(8192,
+                                                                  "MB")}]}),
+        "system": {
+            "network": {"hostname": "unittest02",
+                        "domainname": "one-nyp.ms.com",
+                        "default_gateway": "4.2.1.1",
+                        "interfaces": interfaces},
+            "advertise_status": False,
+            "owner_eon_id": 3,
+            "build": "ready",
+            "personality": {"name": "compileserver",
+                            "archetype": "aquilon",
+                            "host_environment": "dev"},
+            "os": {"version": "6.2", "name": "linux"},
+            "cluster": None,
+        },
+        "harddisks": harddisks,
+    }
+
+
+def personality_structure(services=30):
+    """Service bindings and owner data, similar to PlenaryPersonality."""
+    return {
+        "required_services": ["service%d" % i for i in range(services)],
+        "optional_services": ["optservice%d" % i for i in range(services // 3)],
+        "owner_grn": "grn:/ms/ei/aquilon/unittest",
+        "grns": {"esp": ["grn:/ms/ei/aquilon/aqd",
+                         "grn:/ms/ei/aquilon/unittest"]},
+        "root_users": ["user%d" % i for i in range(10)],
+        "root_netgroups": ["netgroup%d" % i for i in range(5)],
+        "cluster_required": False,
+        "threshold": 0.75,
+        "config_override": PanValue("/system/personality/config_override"),
+    }
+
+
+def parameter_structure(depth=4, width=6):
+    """Deeply nested feature parameters, similar to PlenaryParameterized."""
+    if depth == 0:
+        return ["value with \"quotes\"", 1024, 3.5, True, None]
+    return dict(("key_%d" % i, parameter_structure(depth - 1, width))
+                for i in range(width))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=200,
+                        help="Number of calls in a single measurement")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of measurements, the best one is used")
+    opts = parser.parse_args()
+
+    cases = [
+        ("host", pan, host_structure()),
+        ("host (32 nics)", pan, host_structure(nics=32, disks=16)),
+        ("personality", pan, personality_structure()),
+        ("parameters", pan, parameter_structure()),
+        ("create", lambda params: pan_create("hardware/machine", params),
+         host_structure()),
+    ]
+
+    print("%-20s %12s %10s  %s" % ("case", "usec/call", "bytes",
+                                   "sha1 of output"))
+    for name, func, data in cases:
+        output = func(data)
+        timer = timeit.Timer(lambda: func(data))
+        best = min(timer.repeat(repeat=opts.repeat, number=opts.number))
+        # The digest makes it easy to check that the output did not change
+        digest = hashlib.sha1(output.encode("utf-8")).hexdigest()
+        print("%-20s %12.1f %10d  %s" % (name, best * 1e6 / opts.number,
+                                         len(output), digest))
+
+
+if __name__ == '__main__':
+    main()